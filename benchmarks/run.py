@@ -0,0 +1,240 @@
+# coding: utf-8
+"""
+Time exports and reports on synthetic submissions, and compare the results
+with a stored baseline.
+
+Run from the root of the repository, with formpack installed (e.g. with
+`pip install -e .`):
+
+    python -m benchmarks.run --rows 10000 100000 --save baseline.json
+    # ...change things, then...
+    python -m benchmarks.run --rows 10000 100000 --compare baseline.json
+
+Submissions are generated from the last version of each test fixture by
+`formpack.utils.synthetic.SubmissionGenerator`. At most `--pool-size`
+distinct submissions are generated and cycled through to reach the number
+of rows, so even 1M rows do not need to fit in memory at once.
+
+With `--compare`, the command exits with status 1 if any benchmark is
+slower than its baseline by more than `--tolerance`. Differences under
+`NOISE_SECONDS` are ignored, whatever the ratio.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import tempfile
+import time
+from itertools import cycle, islice
+
+from formpack import FormPack
+from formpack.utils.synthetic import SubmissionGenerator
+from tests.fixtures import build_fixture
+
+DEFAULT_FIXTURES = (
+    'grouped_repeatable',
+    'nested_grouped_repeatable',
+    'literacy_test',
+    'all_geo_types',
+)
+DEFAULT_ROWS = (10000, 100000, 1000000)
+DEFAULT_POOL_SIZE = 10000
+DEFAULT_TOLERANCE = 0.1
+NOISE_SECONDS = 0.01
+# Number of times `FormPack` is built for one timing
+FORMPACK_REPEAT = 100
+
+
+def _consume(iterator):
+    for _ in iterator:
+        pass
+
+
+def bench_formpack(title, schemas, pack, submissions):
+    for _ in range(FORMPACK_REPEAT):
+        FormPack(schemas, title)
+
+
+def bench_to_csv(title, schemas, pack, submissions):
+    _consume(_get_export(pack).to_csv(submissions))
+
+
+def bench_to_xlsx(title, schemas, pack, submissions):
+    with tempfile.NamedTemporaryFile(suffix='.xlsx') as xlsx:
+        _get_export(pack).to_xlsx(xlsx.name, submissions)
+
+
+def bench_to_geojson(title, schemas, pack, submissions):
+    _consume(_get_export(pack).to_geojson(submissions))
+
+
+def bench_to_table(title, schemas, pack, submissions):
+    _get_export(pack).to_table(submissions)
+
+
+def bench_get_stats(title, schemas, pack, submissions):
+    _consume(
+        pack.autoreport(versions=pack.versions.keys()).get_stats(submissions)
+    )
+
+
+def bench_get_stats_split_by(title, schemas, pack, submissions):
+    split_by = _get_split_by_field(pack)
+    report = pack.autoreport(versions=pack.versions.keys())
+    _consume(report.get_stats(submissions, split_by=split_by.name))
+
+
+# Name: (function, whether it times submissions, whether it applies)
+BENCHMARKS = {
+    'formpack': (bench_formpack, False, lambda pack: True),
+    'to_csv': (bench_to_csv, True, lambda pack: True),
+    'to_xlsx': (bench_to_xlsx, True, lambda pack: True),
+    'to_geojson': (
+        bench_to_geojson,
+        True,
+        lambda pack: bool(
+            pack.get_fields_for_versions(
+                pack.versions.keys(),
+                data_types=['geopoint', 'geotrace', 'geoshape'],
+            )
+        ),
+    ),
+    'to_table': (bench_to_table, True, lambda pack: True),
+    'get_stats': (bench_get_stats, True, lambda pack: True),
+    'get_stats_split_by': (
+        bench_get_stats_split_by,
+        True,
+        lambda pack: _get_split_by_field(pack) is not None,
+    ),
+}
+
+
+def _get_export(pack):
+    return pack.export(versions=pack.versions.keys())
+
+
+def _get_split_by_field(pack):
+    fields = pack.get_fields_for_versions(
+        pack.versions.keys(), data_types=['select_one']
+    )
+    return fields[0] if fields else None
+
+
+def run_benchmarks(fixtures, rows, benchmarks, repeat=1, pool_size=None):
+    """
+    Return `{'<fixture>/<benchmark>/<rows>': seconds}`, the best time of
+    `repeat` runs of each benchmark. Benchmarks that do not depend on
+    submissions are only run once per fixture, with `0` rows.
+    """
+    pool_size = pool_size or DEFAULT_POOL_SIZE
+    results = {}
+    for fixture in fixtures:
+        title, schemas, _ = build_fixture(fixture)
+        pack = FormPack(schemas, title)
+        version = list(pack.versions.values())[-1]
+        generator = SubmissionGenerator(version)
+        pool = list(islice(generator, min(pool_size, max(rows))))
+
+        for name in benchmarks:
+            function, uses_submissions, applies = BENCHMARKS[name]
+            if not applies(pack):
+                continue
+            for count in rows if uses_submissions else (0,):
+                timings = []
+                for _ in range(repeat):
+                    submissions = islice(cycle(pool), count)
+                    start = time.perf_counter()
+                    function(title, schemas, pack, submissions)
+                    timings.append(time.perf_counter() - start)
+                key = f'{fixture}/{name}/{count}'
+                results[key] = min(timings)
+                print(f'{key}: {results[key]:.3f}s', file=sys.stderr)
+    return results
+
+
+def compare_results(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Return `[(key, seconds, baseline_seconds, ratio)]` for the benchmarks
+    of `results` found in `baseline`, and the list of those more than
+    `tolerance` (and `NOISE_SECONDS`) slower than their baseline
+    """
+    comparisons = []
+    regressions = []
+    for key, seconds in results.items():
+        baseline_seconds = baseline.get(key)
+        if not baseline_seconds:
+            continue
+        ratio = seconds / baseline_seconds
+        comparison = (key, seconds, baseline_seconds, ratio)
+        comparisons.append(comparison)
+        if ratio > 1 + tolerance and seconds - baseline_seconds > NOISE_SECONDS:
+            regressions.append(comparison)
+    return comparisons, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Time formpack exports and reports'
+    )
+    parser.add_argument('--fixtures', nargs='+', default=DEFAULT_FIXTURES)
+    parser.add_argument('--rows', nargs='+', type=int, default=DEFAULT_ROWS)
+    parser.add_argument(
+        '--benchmarks',
+        nargs='+',
+        choices=list(BENCHMARKS),
+        default=list(BENCHMARKS),
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=1, help='Keep the best of N runs'
+    )
+    parser.add_argument(
+        '--pool-size',
+        type=int,
+        default=DEFAULT_POOL_SIZE,
+        help='Number of distinct submissions to generate',
+    )
+    parser.add_argument('--save', help='Write the results to this JSON file')
+    parser.add_argument(
+        '--compare', help='Compare the results with this JSON file'
+    )
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help='Slowdown ratio above which a benchmark has regressed',
+    )
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(
+        args.fixtures, args.rows, args.benchmarks, args.repeat, args.pool_size
+    )
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(
+                {'python': platform.python_version(), 'results': results},
+                f,
+                indent=2,
+            )
+
+    if not args.compare:
+        return 0
+
+    with open(args.compare) as f:
+        baseline = json.load(f)['results']
+    comparisons, regressions = compare_results(
+        results, baseline, args.tolerance
+    )
+    for comparison in comparisons:
+        key, seconds, baseline_seconds, ratio = comparison
+        flag = '  REGRESSION' if comparison in regressions else ''
+        print(
+            f'{key}: {baseline_seconds:.3f}s -> {seconds:.3f}s '
+            f'({ratio:.2f}x){flag}'
+        )
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
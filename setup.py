@@ -14,6 +14,15 @@ requirements = [
     'geojson-rewind',
 ]
 
+extras_require = {
+    # Arrow and Parquet exports
+    'columnar': ['pyarrow'],
+    # Faster numeric stats on large reports
+    'stats': ['numpy'],
+    # zstd-compressed CSV exports
+    'zstd': ['zstandard'],
+}
+
 dep_links = [
 ]
 
@@ -27,6 +36,7 @@ setup(
     packages=[str(pkg) for pkg in find_packages('src')],
     package_dir={'': 'src'},
     install_requires=requirements,
+    extras_require=extras_require,
     dependency_links=dep_links,
     include_package_data=True,
     zip_safe=False,
@@ -0,0 +1,359 @@
+# coding: utf-8
+"""
+Read submissions from files, one at a time, to feed `Export` and
+`AutoReport` without loading whole data sets in memory.
+
+JSON (newline-delimited or arrays) and XML dumps of many instances are
+supported.
+
+Readers accept a path or a binary file object, read it in large blocks,
+decompress gzip on the fly and, for paths, can memory-map the file. With
+`keys`, e.g. `Export.get_submission_keys()`, submissions only keep the
+top-level keys that the export or report reads.
+"""
+
+import codecs
+import gzip
+import json
+import mmap
+import os
+from contextlib import contextmanager, ExitStack
+from itertools import chain
+
+from lxml import etree
+
+DEFAULT_BLOCK_SIZE = 1 << 20
+
+GZIP_MAGIC = b'\x1f\x8b'
+WHITESPACE = ' \t\n\r'
+# Bytes to skip to find the first character of a file
+LEADING_BYTES = codecs.BOM_UTF8 + WHITESPACE.encode()
+NDJSON = 'ndjson'
+JSON_ARRAY = 'json'
+FORMATS = (NDJSON, JSON_ARRAY)
+
+
+@contextmanager
+def open_source(source, compression='infer', use_mmap=False):
+    """
+    Yield a binary file object reading `source`, a path or a binary file
+    object, which is left open.
+
+    :param compression: 'gzip', None, or 'infer' to detect gzip from the
+        first bytes of paths
+    :param use_mmap: bool. Memory-map `source`, which must be a path
+    """
+    with ExitStack() as stack:
+        if isinstance(source, (str, os.PathLike)):
+            fileobj = stack.enter_context(open(source, 'rb'))
+            if compression == 'infer':
+                compression = 'gzip' if fileobj.read(2) == GZIP_MAGIC else None
+                fileobj.seek(0)
+            if use_mmap and os.fstat(fileobj.fileno()).st_size:
+                fileobj = stack.enter_context(
+                    mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+                )
+        else:
+            if use_mmap:
+                raise ValueError('Only paths can be memory-mapped')
+            fileobj = source
+            if compression == 'infer':
+                compression = None
+
+        if compression == 'gzip':
+            fileobj = stack.enter_context(
+                gzip.GzipFile(fileobj=fileobj, mode='rb')
+            )
+        elif compression is not None:
+            raise ValueError(f'Unknown compression `{compression}`')
+        yield fileobj
+
+
+def _iter_blocks(fileobj, block_size):
+    while True:
+        block = fileobj.read(block_size)
+        if not block:
+            return
+        yield block
+
+
+def _project(record, keys):
+    if keys is None:
+        return record
+    return {key: value for key, value in record.items() if key in keys}
+
+
+def _iter_ndjson(blocks, keys):
+    loads = json.loads
+    # Parts of a line longer than a block, joined once it ends
+    leftover = []
+    for block in blocks:
+        lines = block.split(b'\n')
+        if len(lines) == 1:
+            leftover.append(block)
+            continue
+        if leftover:
+            leftover.append(lines[0])
+            lines[0] = b''.join(leftover)
+        leftover = [lines.pop()]
+        for line in lines:
+            if line.strip():
+                yield _project(loads(line), keys)
+    leftover = b''.join(leftover)
+    if leftover.strip():
+        yield _project(loads(leftover), keys)
+
+
+# Longest text a submission cut at the end of a block can leave after the
+# position of its decoding error, e.g. `-Infinit` or a `\uXXXX` escape
+MAX_CUT_TOKEN_LENGTH = 9
+
+
+def _is_cut(error, buffer):
+    """
+    Return whether `error`, raised by decoding `buffer`, may only be due to
+    the buffer ending in the middle of a submission
+    """
+    if error.msg.startswith('Unterminated string'):
+        return True
+    return len(buffer.rstrip(WHITESPACE)) - error.pos <= MAX_CUT_TOKEN_LENGTH
+
+
+class _JSONArrayReader:
+    """
+    Decode the submissions of a top-level JSON array from an iterator of
+    binary blocks, holding at most about twice the largest submission in
+    memory.
+    """
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        self.buffer = ''
+        self.position = 0
+        self.exhausted = False
+
+    def read(self):
+        """
+        Replace the consumed part of the buffer with at least as much new
+        text as is left, so that a long submission is decoded again a
+        logarithmic number of times. Return `False` at the end of the data.
+        """
+        if self.exhausted:
+            return False
+        position = self.position
+        parts = [self.buffer[position:]]
+        size = wanted = len(parts[0])
+        while not self.exhausted and size <= wanted:
+            block = next(self.blocks, None)
+            self.exhausted = block is None
+            text = self.text_decoder.decode(block or b'', self.exhausted)
+            parts.append(text)
+            size += len(text)
+        self.buffer = ''.join(parts)
+        self.position = 0
+        return True
+
+    def next_char(self):
+        """
+        Skip whitespace and return the next character, or '' at the end
+        """
+        while True:
+            buffer = self.buffer
+            position = self.position
+            while position < len(buffer) and buffer[position] in WHITESPACE:
+                position += 1
+            self.position = position
+            if position < len(buffer):
+                return buffer[position]
+            if not self.read():
+                return ''
+
+    def decode(self):
+        """
+        Return the submission at the current position and move past it
+        """
+        while True:
+            try:
+                record, end = self.decoder.raw_decode(
+                    self.buffer, self.position
+                )
+            except json.JSONDecodeError as e:
+                # Only a submission cut at the end of the buffer may be
+                # completed by the next blocks
+                if not _is_cut(e, self.buffer) or not self.read():
+                    raise
+                continue
+            # Numbers may continue in the next block
+            if end == len(self.buffer) and self.read():
+                continue
+            self.position = end
+            return record
+
+    def __iter__(self):
+        if self.next_char() != '[':
+            raise ValueError('Expected a JSON array of submissions')
+        self.position += 1
+        char = self.next_char()
+        while char != ']':
+            yield self.decode()
+            char = self.next_char()
+            if char == ',':
+                self.position += 1
+                self.next_char()
+            elif char != ']':
+                raise ValueError(
+                    f'Expected `,` or `]` after a submission, not `{char}`'
+                )
+        self.position += 1
+        if self.next_char():
+            raise ValueError('Unexpected data after the JSON array')
+
+
+def _iter_json_array(blocks, keys):
+    for record in _JSONArrayReader(blocks):
+        yield _project(record, keys)
+
+
+def read_submissions(
+    source,
+    keys=None,
+    format='infer',
+    compression='infer',
+    use_mmap=False,
+    block_size=DEFAULT_BLOCK_SIZE,
+):
+    """
+    Yield the submissions of `source`, a path or a binary file object,
+    either newline-delimited JSON (one submission per line) or a top-level
+    JSON array, which is streamed rather than loaded at once.
+
+    :param keys: set or None. Only keep these top-level keys, e.g.
+        `Export.get_submission_keys()`; repeat groups are kept whole
+    :param format: 'ndjson', 'json' or 'infer' to tell from the first byte
+    :param compression: 'gzip', None, or 'infer'; see `open_source()`
+    :param use_mmap: bool. Memory-map `source`, which must be a path
+    :param block_size: int. Number of bytes read at once
+    """
+    if format not in FORMATS + ('infer',):
+        raise ValueError(f'Unknown format `{format}`')
+    if keys is not None:
+        keys = frozenset(keys)
+
+    with open_source(source, compression, use_mmap) as fileobj:
+        blocks = _iter_blocks(fileobj, block_size)
+        if format == 'infer':
+            head = b''
+            for block in blocks:
+                head += block
+                if head.lstrip(LEADING_BYTES):
+                    break
+            start = head.lstrip(LEADING_BYTES)[:1]
+            format = JSON_ARRAY if start == b'[' else NDJSON
+            blocks = chain([head], blocks)
+
+        if format == NDJSON:
+            yield from _iter_ndjson(blocks, keys)
+        else:
+            yield from _iter_json_array(blocks, keys)
+
+
+def read_ndjson(source, keys=None, **kwargs):
+    """
+    Yield the submissions of a newline-delimited JSON `source`; see
+    `read_submissions()`
+    """
+    return read_submissions(source, keys, format=NDJSON, **kwargs)
+
+
+def read_json_array(source, keys=None, **kwargs):
+    """
+    Yield the submissions of a JSON array `source`, one at a time; see
+    `read_submissions()`
+    """
+    return read_submissions(source, keys, format=JSON_ARRAY, **kwargs)
+
+
+def get_repeat_paths(versions):
+    """
+    Return the paths of the repeat groups of `versions`, a mapping of
+    `FormVersion`s such as `FormPack.versions`
+    """
+    repeat_paths = set()
+    for version in versions.values():
+        sections = list(version.sections.values())
+        repeat_paths.update(section.path for section in sections[1:])
+    return repeat_paths
+
+
+def _get_local_name(tag):
+    if tag[0] == '{':
+        return tag.rpartition('}')[2]
+    return tag
+
+
+def _add_xml_children(entry, element, prefix, repeat_paths):
+    """
+    Add the responses found under `element` to `entry`, flattening groups
+    into `group/question` keys and collecting repeat groups into lists of
+    entries, like JSON submissions
+    """
+    for child in element:
+        tag = child.tag
+        # Skip comments and processing instructions
+        if not isinstance(tag, str):
+            continue
+        path = prefix + _get_local_name(tag)
+        if path in repeat_paths:
+            repeat_entry = {}
+            _add_xml_children(repeat_entry, child, path + '/', repeat_paths)
+            entry.setdefault(path, []).append(repeat_entry)
+        elif len(child):
+            _add_xml_children(entry, child, path + '/', repeat_paths)
+        elif child.text is not None:
+            entry[path] = child.text
+
+
+def read_xml_submissions(
+    source,
+    repeat_paths=(),
+    version_id_key='__version__',
+    compression='infer',
+    use_mmap=False,
+):
+    """
+    Yield the submissions of an XML dump of many instances, i.e. the
+    children of the root element of `source`, a path or a binary file
+    object, as flat dicts like JSON submissions.
+
+    Elements are discarded as soon as their instance is read, so memory use
+    does not grow with the size of the dump.
+
+    :param repeat_paths: set. Paths of repeat groups, e.g.
+        `get_repeat_paths(formpack.versions)`, which come out as lists of
+        entries even when they hold a single one
+    :param version_id_key: str. Key under which to put the `version`
+        attribute of instances
+    :param compression: 'gzip', None, or 'infer'; see `open_source()`
+    :param use_mmap: bool. Memory-map `source`, which must be a path
+    """
+    repeat_paths = frozenset(repeat_paths)
+    with open_source(source, compression, use_mmap) as fileobj:
+        for _, element in etree.iterparse(fileobj, remove_comments=True):
+            # Only instances, the children of the root, are of interest
+            root = element.getparent()
+            if root is None or root.getparent() is not None:
+                continue
+
+            submission = {}
+            version_id = element.get('version')
+            if version_id is not None:
+                submission[version_id_key] = version_id
+            _add_xml_children(submission, element, '', repeat_paths)
+            yield submission
+
+            # Free the instance, and the references the root keeps to it
+            element.clear()
+            while element.getprevious() is not None:
+                del root[0]
@@ -1,17 +1,25 @@
 # coding: utf-8
 import difflib
+import inspect
 import json
-from collections import OrderedDict
+import pickle
+import zlib
+from collections import OrderedDict, defaultdict
 from copy import deepcopy
 from typing import Dict
 
 from formpack.schema.fields import CopyField
-from .version import FormVersion, AnalysisForm
+from .version import FormVersion, AnalysisForm, LazyFormVersions
 from .reporting import Export, AutoReport
+from .reporting.progress import DEFAULT_PROGRESS_EVERY
 from .utils.expand_content import expand_content
+from .utils.json_hash import json_hash
 from .utils.replace_aliases import replace_aliases
 from .constants import UNSPECIFIED_TRANSLATION
 
+# Bump whenever the classes stored in snapshots change in an incompatible way
+SNAPSHOT_FORMAT = 1
+
 
 class FormPack:
     def __init__(
@@ -24,12 +32,15 @@ class FormPack:
         root_node_name='data',
         asset_type=None,
         submissions_xml=None,
+        lazy=False,
     ):
         """
         :param versions: list. Versions of the asset. It must be sorted in ascending order. From oldest to newest.
         :param title: string. The human readable name of the form.
         :param id_string: The human readable id of the form.
         :param default_version_id_key: string. The name of the field in submissions which stores the version ID
+        :param lazy: bool. Build versions on first access, when their schema
+            errors are raised. Schemas must not be modified afterwards.
         """
         # @TODO: Complete the signature for __init__
 
@@ -39,8 +50,35 @@ class FormPack:
         # accept a single version, but normalize it to an iterable
         if isinstance(versions, dict):
             versions = [versions]
+        versions = list(versions)
+
+        # Arguments hashed into `content_hash`, besides the versions
+        self._content_hash_options = {
+            'title': title,
+            'id_string': id_string,
+            'default_version_id_key': default_version_id_key,
+            'strict_schema': strict_schema,
+            'root_node_name': root_node_name,
+            'asset_type': asset_type,
+        }
+        self._content_hash = None
+        if not lazy:
+            # Schemas are about to be copied and built, which costs much
+            # more than hashing them. Lazy FormPacks keep the raw schemas
+            # anyway, and only hash them on first access.
+            try:
+                self._content_hash = self.get_content_hash(
+                    versions, **self._content_hash_options
+                )
+            except (TypeError, ValueError):
+                # Not JSON serializable; only matters to `content_hash`
+                pass
 
-        self.versions = OrderedDict()
+        self.lazy = lazy
+        if lazy:
+            self.versions = LazyFormVersions(self._build_lazy_version)
+        else:
+            self.versions = OrderedDict()
 
         # the name of the field in submissions which stores the version ID
         self.default_version_id_key = default_version_id_key
@@ -55,6 +93,9 @@ class FormPack:
 
         self.analysis_form = None
 
+        # Memoized results of `get_fields_for_versions()`
+        self._fields_for_versions = {}
+
         self.load_all_versions(versions)
 
     # FIXME: Find a safe way to use this. Wrapping with try/except isn't enough
@@ -68,12 +109,34 @@ class FormPack:
         if _versions is None:
             _versions = self.versions
         _id_keys = []
-        for version in self.versions.values():
-            _id_key = version.version_id_key
+        for version_id in self.versions:
+            # Read from the schema so that lazy versions do not get built
+            _id_key = self._get_version_schema(version_id).get(
+                'version_id_key', self.default_version_id_key
+            )
             if _id_key not in _id_keys:
                 _id_keys.append(_id_key)
         return _id_keys
 
+    @property
+    def content_hash(self):
+        """
+        Hash of the arguments this FormPack was built with; see
+        `get_content_hash()`. Lazy FormPacks hash their raw schemas on first
+        access, so these must not be modified before.
+        """
+        if self._content_hash is not None:
+            return self._content_hash
+        if not self.lazy:
+            raise ValueError(
+                'FormPack schemas must be JSON serializable to be hashed'
+            )
+        self._content_hash = self.get_content_hash(
+            [self.versions.get_schema(v) for v in self.versions],
+            **self._content_hash_options,
+        )
+        return self._content_hash
+
     @property
     def available_translations(self):
         translations = []
@@ -93,7 +156,7 @@ class FormPack:
     def __getitem__(self, index):
         try:
             if isinstance(index, int):
-                return tuple(self.versions.values())[index]
+                return self.versions[tuple(self.versions)[index]]
             else:
                 return self.versions[index]
         except KeyError:
@@ -115,7 +178,10 @@ class FormPack:
 
     def load_all_versions(self, versions):
         for schema in versions:
-            self.load_version(deepcopy(schema))
+            if not self.lazy:
+                # Lazy versions get copied when they are built
+                schema = deepcopy(schema)
+            self.load_version(schema)
 
     def load_version(self, schema):
         """
@@ -133,51 +199,82 @@ class FormPack:
         Each version can be distinguish by its version_id, which is
         unique accross an entire FormPack. It can be None, but only for
         one version in the FormPack.
+
+        In lazy mode, the version is only checked against the metadata
+        above, and built when first accessed.
         """
+        if self.lazy:
+            version_id = schema.get('version')
+            self._check_version_metadata(
+                version_id,
+                schema.get('id_string'),
+                schema.get('title', self.title),
+            )
+            self.versions.add_schema(version_id, schema)
+            return
+
+        form_version = self._build_version(schema)
+        self._check_version_metadata(
+            form_version.id, form_version.id_string, form_version.title
+        )
+        self.versions[form_version.id] = form_version
+
+    def _build_version(self, schema):
         replace_aliases(schema['content'], in_place=True)
         expand_content(schema['content'], in_place=True)
 
         if self.strict_schema:
             FormVersion.verify_schema_structure(schema)
 
-        form_version = FormVersion(self, schema)
+        return FormVersion(self, schema)
+
+    def _build_lazy_version(self, schema):
+        return self._build_version(deepcopy(schema))
 
+    def _get_version_schema(self, version_id):
+        if self.lazy:
+            return self.versions.get_schema(version_id)
+        return self.versions[version_id].schema
+
+    def _check_version_metadata(self, version_id, id_string, title):
+        """
+        Validate the ids of a new version, and update the id_string and the
+        title of this FormPack from them
+        """
         # NB: id_string are readable string unique to the form
         # while version id are id unique to one of the versions of the form
 
         # Avoid duplicate versions id
-        if form_version.id in self.versions:
-            if form_version.id is None:
+        if version_id in self.versions:
+            if version_id is None:
                 raise ValueError(
                     'cannot have two versions without '
                     'a "version" id specified'
                 )
 
             raise ValueError(
-                'cannot have duplicate version id: %s' % form_version.id
+                'cannot have duplicate version id: %s' % version_id
             )
 
         # If the form pack doesn't have an id_string, we get it from the
         # first form version. We also avoid heterogenenous id_string in versions
-        if form_version.id_string:
-            if self.id_string and self.id_string != form_version.id_string:
+        if id_string:
+            if self.id_string and self.id_string != id_string:
                 raise ValueError(
                     'Versions must of the same form must '
                     'share an id_string: %s != %s'
                     % (
                         self.id_string,
-                        form_version.id_string,
+                        id_string,
                     )
                 )
 
-            self.id_string = form_version.id_string
+            self.id_string = id_string
 
         # If the form pack doesn't have an title, we get it from the
         # first form version.
-        if form_version.title and not self.title:
-            self.title = form_version.version_title
-
-        self.versions[form_version.id] = form_version
+        if title and not self.title:
+            self.title = title
 
     def extend_survey(self, analysis_form: Dict) -> None:
         self.analysis_form = AnalysisForm(self, analysis_form)
@@ -201,24 +298,33 @@ class FormPack:
         return ''.join(out)
 
     @staticmethod
-    def _combine_field_choices(old_field, new_field):
+    def _combine_fields_choices(latest_field, old_fields):
         """
-        Update `new_field.choice` so that it contains everything from
-        `old_field.choice`. In the event of a conflict, `new_field.choice`
-        wins. If either field does not have a `choice` attribute, do nothing.
+        Update `latest_field.choice` so that it contains everything from the
+        `choice` of each of `old_fields`. In the event of a conflict, the
+        newest field wins. Fields without a `choice` attribute are ignored.
 
-        :param old_field: FormField
-        :param new_field: FormField
-        :return: FormField. Updated new_field
+        :param latest_field: FormField
+        :param old_fields: list of FormField. From the oldest to the newest
+        :return: FormField. Updated latest_field
         """
-        try:
-            old_choice = old_field.choice
-            new_choice = new_field.choice
-            new_field.merge_choice(old_choice)
-        except AttributeError:
-            pass
-
-        return new_field
+        old_choices = [
+            field.choice for field in old_fields if hasattr(field, 'choice')
+        ]
+        if old_choices and hasattr(latest_field, 'choice'):
+            try:
+                latest_field.merge_choices(old_choices)
+            except AttributeError:
+                pass
+
+        return latest_field
+
+    def clear_fields_cache(self):
+        """
+        Forget the results of `get_fields_for_versions()`. This must be called
+        after adding or removing fields of a version.
+        """
+        self._fields_for_versions.clear()
 
     def get_fields_for_versions(self, versions=-1, data_types=None):
 
@@ -233,6 +339,8 @@ class FormPack:
 
             Labels are used as column headers.
 
+            Results are memoized per set of versions and data types.
+
         :param versions: list
         :param data_types: list
         :return: list
@@ -242,6 +350,16 @@ class FormPack:
             if isinstance(data_types, str):
                 data_types = [data_types]
 
+        versions = self._get_versions(versions)
+        cache_key = (
+            tuple(versions),
+            tuple(data_types) if data_types is not None else None,
+        )
+        try:
+            return list(self._fields_for_versions[cache_key])
+        except KeyError:
+            pass
+
         # tmp2 is a 2 dimensions list of `field`.
         # First dimension is the position of fields where they should be in the latest version
         # Second dimension is their position in the stack at the same position.
@@ -261,8 +379,13 @@ class FormPack:
         #       `positions[f'{section.name}_{field2.name}']` would be `(0, 1)`
         positions = {}
 
+        # Older versions of the fields in tmp2d, by position, from the newest
+        # to the oldest. Their choices are merged into the latest version of
+        # the field once all versions have been seen.
+        old_fields = defaultdict(list)
+
         # Create the initial field mappings from the first form version
-        versions_desc = list(reversed(self._get_versions(versions).values()))
+        versions_desc = list(reversed(versions.values()))
 
         # Copy fields need to be pushed at the end. So let's process them separately.
         copy_fields = []
@@ -284,17 +407,11 @@ class FormPack:
                     section_field_name = f'{section_name}_{field_name}'
                     if not isinstance(field_object, CopyField):
                         if section_field_name in positions:
-                            position = positions[section_field_name]
-                            latest_field_object = tmp2d[position[0]][
-                                position[1]
-                            ]
                             # Because versions_desc are ordered from latest to oldest,
                             # we use current field object as the old one and the one already
                             # in position as the latest one.
-                            new_object = self._combine_field_choices(
-                                field_object, latest_field_object
-                            )
-                            tmp2d[position[0]][position[1]] = new_object
+                            position = positions[section_field_name]
+                            old_fields[position].append(field_object)
                         else:
                             try:
                                 current_index_list = tmp2d[index]
@@ -313,6 +430,11 @@ class FormPack:
 
                         index += 1
 
+        for position, fields in old_fields.items():
+            self._combine_fields_choices(
+                tmp2d[position[0]][position[1]], reversed(fields)
+            )
+
         all_fields = []
 
         # We need to flatten the 2d list before returning it.
@@ -339,7 +461,8 @@ class FormPack:
         # Finally, add copy fields at the end
         all_fields += copy_fields
 
-        return all_fields
+        self._fields_for_versions[cache_key] = all_fields
+        return list(all_fields)
 
     def to_dict(self, **kwargs):
         out = {
@@ -356,6 +479,68 @@ class FormPack:
     def to_json(self, **kwargs):
         return json.dumps(self.to_dict(), **kwargs)
 
+    @classmethod
+    def get_content_hash(cls, *args, **kwargs):
+        """
+        Return the `content_hash` a FormPack built with these arguments would
+        have, without building it
+        """
+        arguments = inspect.signature(cls.__init__).bind(None, *args, **kwargs)
+        arguments.apply_defaults()
+        arguments = dict(arguments.arguments)
+        # Those do not change the result
+        for name in ('self', 'lazy', 'submissions_xml'):
+            arguments.pop(name)
+
+        versions = arguments['versions'] or []
+        if isinstance(versions, dict):
+            versions = [versions]
+        arguments['versions'] = list(versions)
+
+        return json_hash([SNAPSHOT_FORMAT, arguments], size=32)
+
+    def snapshot(self):
+        """
+        Return a compressed binary snapshot of this FormPack, with all its
+        versions compiled, to be restored by `from_snapshot()`.
+
+        Snapshots store the `content_hash` of the FormPack, so they can be
+        stored under that key and looked up with `get_content_hash()`.
+        """
+        # Compile all lazy versions so that they end up in the snapshot
+        for version_id in self.versions:
+            self.versions[version_id]
+
+        state = {
+            'format': SNAPSHOT_FORMAT,
+            'content_hash': self.content_hash,
+            'formpack': self,
+        }
+        return zlib.compress(pickle.dumps(state, pickle.HIGHEST_PROTOCOL))
+
+    @classmethod
+    def from_snapshot(cls, snapshot, content_hash=None):
+        """
+        Restore a FormPack from the output of `snapshot()`. If `content_hash`
+        is given, the snapshot must have been taken from a FormPack with
+        that hash.
+
+        Snapshots are pickles: only load snapshots from a trusted source.
+        """
+        try:
+            state = pickle.loads(zlib.decompress(snapshot))
+        except (zlib.error, pickle.UnpicklingError) as e:
+            raise ValueError(f'Invalid FormPack snapshot: {e}')
+
+        if state.get('format') != SNAPSHOT_FORMAT:
+            raise ValueError('Unsupported FormPack snapshot format')
+        if content_hash is not None and state['content_hash'] != content_hash:
+            raise ValueError(
+                'FormPack snapshot does not match content hash %s'
+                % content_hash
+            )
+        return state['formpack']
+
     def export(
         self,
         lang=UNSPECIFIED_TRANSLATION,
@@ -370,6 +555,13 @@ class FormPack:
         filter_fields=(),
         xls_types_as_text=True,
         include_media_url=False,
+        compile_sections=False,
+        cache=None,
+        profile=False,
+        on_progress=None,
+        progress_every=DEFAULT_PROGRESS_EVERY,
+        progress_interval=None,
+        where=None,
     ):
         """
         Create an export for given versions of the form.
@@ -391,13 +583,32 @@ class FormPack:
             filter_fields=filter_fields,
             xls_types_as_text=xls_types_as_text,
             include_media_url=include_media_url,
+            compile_sections=compile_sections,
+            cache=cache,
+            profile=profile,
+            on_progress=on_progress,
+            progress_every=progress_every,
+            progress_interval=progress_interval,
+            where=where,
         )
 
-    def autoreport(self, versions=-1):
+    def autoreport(
+        self,
+        versions=-1,
+        on_progress=None,
+        progress_every=DEFAULT_PROGRESS_EVERY,
+        progress_interval=None,
+    ):
         """
         Create an automatic report for given versions of the form.
         """
-        return AutoReport(self, self._get_versions(versions))
+        return AutoReport(
+            self,
+            self._get_versions(versions),
+            on_progress=on_progress,
+            progress_every=progress_every,
+            progress_interval=progress_interval,
+        )
 
     def _get_versions(self, versions):
 
@@ -1,3 +1,6 @@
 # coding: utf-8
-from .autoreport import AutoReport
+from .autoreport import AutoReport, AutoReportMetrics  # noqa
+from .cache import ReportCache  # noqa
 from .export import Export  # noqa
+from .filters import SubmissionFilter  # noqa
+from .router import VersionRouter  # noqa
@@ -1,10 +1,18 @@
 # coding: utf-8
+import json
 import logging
 from collections import defaultdict
 
 from ..constants import UNSPECIFIED_TRANSLATION
-from ..submission import FormSubmission
 from ..utils.ordered_collection import OrderedCounter
+from ..utils.sketches import DEFAULT_ERROR, FrequencySketch, sketch_from_dict
+from .filters import SubmissionFilter
+from .progress import DEFAULT_PROGRESS_EVERY, ProgressTracker
+from .router import VersionRouter
+
+# Maximum number of consecutive submissions of the same version counted at
+# once
+RUN_SIZE = 1000
 
 
 class AutoReportStats:
@@ -20,168 +28,348 @@ class AutoReportStats:
         return self.stats
 
 
-class AutoReport:
-    def __init__(self, formpack, form_versions):
-        self.formpack = formpack
-        self.versions = form_versions
+class AutoReportMetrics:
+    """
+    Per-field counters behind `AutoReport.get_stats()`.
 
-    def _get_version_id_from_submission(self, submission):
-        """
-        Get the version ID from the provided submission, or `None` if not found.
+    Metrics can be updated as new submissions arrive, merged with metrics
+    computed separately on another shard of the same data, and serialized.
+    Building the stats does not consume them.
 
-        :param dict submission: An individual data submission.
-        :rtype: str or NoneType
-        """
-        version_id_keys = set(self.formpack.version_id_keys()).intersection(
-            set(submission.keys())
-        )
-        if len(version_id_keys) == 0:
-            return None
-        elif len(version_id_keys) > 1:
-            possible_versions_dict = {
-                v_id_ky: submission[v_id_ky] for v_id_ky in version_id_keys
-            }
-            raise ValueError(
-                f'Submission version ambiguous. '
-                f'Multiple possible version ID keys: {possible_versions_dict}'
-            )
-        version_id_key = version_id_keys.pop()
+    When `error` is set, fields that support it (numbers and text) are
+    summarized by bounded-memory sketches instead of exact counters, with
+    a relative error of about `error` on reported counts and ranks.
+    """
 
-        version_id = submission.get(version_id_key)
-        return version_id
+    SERIALIZATION_FORMAT = 1
 
-    def _calculate_stats(self, submissions, fields, versions, lang):
+    def __init__(self, autoreport, fields, split_by_field=None, error=None):
+        self.autoreport = autoreport
+        self.split_by_field = split_by_field
+        self.error = error
 
-        metrics = {field.name: OrderedCounter() for field in fields}
+        if split_by_field is None:
+            self.fields = fields
+            self.metrics = {
+                field.name: self._get_counter(field) for field in fields
+            }
+        elif error is not None:
+            raise ValueError('Approximate stats cannot be split by a field')
+        else:
+            # Then we map fields, values and splitters:
+            #          {field_name1: {
+            #                  'value1': OrderedCounter(
+            #                      (splitter1, x),
+            #                      (splitter2, y)
+            #                       ...
+            #                  ),
+            #                  value2: ...
+            #              },
+            #              field_name2...},
+            #         ...}
+            #
+            self.fields = [f for f in fields if f != split_by_field]
+            self.metrics = {
+                f.name: defaultdict(OrderedCounter) for f in self.fields
+            }
 
-        submissions_count = 0
-        submission_counts_by_version = OrderedCounter()
+        # We want only the most used values of the split_by field so we build
+        # a separate counter for it to filter them
+        self.splitters_rank = OrderedCounter()
 
-        for entry in submissions:
+        self.submissions_count = 0
+        self.submission_counts_by_version = OrderedCounter()
 
-            version_id = self._get_version_id_from_submission(entry)
-            if version_id not in versions:
-                continue
+    def _get_counter(self, field):
+        sketch = None
+        if self.error is not None:
+            sketch = field.get_sketch(self.error)
+        if sketch is None:
+            return OrderedCounter()
+        return sketch
 
-            submissions_count += 1
-            submission_counts_by_version[version_id] += 1
+    @property
+    def _signature(self):
+        split_by = getattr(self.split_by_field, 'name', None)
+        return [field.name for field in self.fields], split_by, self.error
 
-            # TODO: do we really need FormSubmission ?
-            entry = FormSubmission(entry).data
-            for field in fields:
-                if field.has_stats:
-                    counter = metrics[field.name]
-                    raw_value = entry.get(field.path)
-                    if raw_value is not None:
-                        try:
-                            values = list(field.parse_values(raw_value))
-                        except ValueError as e:
-                            # TODO: Remove try/except when
-                            # https://github.com/kobotoolbox/formpack/issues/151
-                            # is fixed?
-                            logging.warning(str(e), exc_info=True)
-                            # Treat the bad value as a blank response
-                            counter[None] += 1
-                        else:
-                            counter.update(values)
-                            counter['__submissions__'] += 1
-                    else:
-                        counter[None] += 1
+    @property
+    def _run_size(self):
+        """
+        Maximum number of submissions counted at once, small enough for
+        progress events to be sent as often as requested
+        """
+        progress = self.autoreport.progress
+        if progress is None:
+            return RUN_SIZE
+        return max(1, min(RUN_SIZE, progress.every))
 
-        def stats_generator():
-            for field in fields:
-                yield (
-                    field,
-                    field.get_labels(lang)[0],
-                    field.get_stats(metrics[field.name], lang=lang),
-                )
+    def update(self, submissions):
+        """
+        Add `submissions` to the metrics and return `self`
+        """
+        progress = self.autoreport.progress
+        if progress is not None:
+            progress.begin()
+        try:
+            if self.split_by_field is None:
+                self._update(submissions)
+            else:
+                self._update_disaggregated(submissions)
+        finally:
+            if progress is not None:
+                progress.end()
+        return self
+
+    def _update(self, submissions):
+        progress = self.autoreport.progress
+        for version_id, version, run in self.autoreport.router.iter_runs(
+            submissions, self._run_size
+        ):
+            # Skip unrequested versions
+            if version is None:
+                if progress is not None:
+                    progress.skip(len(run))
+                continue
 
-        return AutoReportStats(
-            self,
-            stats_generator(),
-            submissions_count,
-            submission_counts_by_version,
-        )
+            self.submissions_count += len(run)
+            self.submission_counts_by_version[version_id] += len(run)
+            if progress is not None:
+                progress.add(submissions=len(run))
 
-    def _disaggregate_stats(
-        self, submissions, fields, versions, lang, split_by_field
-    ):
+            for entry in run:
+                self._count_entry(entry)
 
-        # We want only the most used values so we build a separate counter
-        # for it to filter them
-        splitters_rank = OrderedCounter()
-        # Extract the split_by field from the values to get stats on
-
-        # total number of submissions
-        submissions_count = 0
-        submission_counts_by_version = OrderedCounter()
-
-        fields = [f for f in fields if f != split_by_field]
-
-        # Then we map fields, values and splitters:
-        #          {field_name1: {
-        #                  'value1': OrderedCounter(
-        #                      (splitter1, x),
-        #                      (splitter2, y)
-        #                       ...
-        #                  ),
-        #                  value2: ...
-        #              },
-        #              field_name2...},
-        #         ...}
-        #
-        metrics = {f.name: defaultdict(OrderedCounter) for f in fields}
-
-        for sbmssn in submissions:
+    def _update_disaggregated(self, submissions):
+        split_by_field = self.split_by_field
 
+        progress = self.autoreport.progress
+        for version_id, version, run in self.autoreport.router.iter_runs(
+            submissions, self._run_size
+        ):
             # Skip unrequested versions
-            version_id = self._get_version_id_from_submission(sbmssn)
-            if version_id not in versions:
+            if version is None:
+                if progress is not None:
+                    progress.skip(len(run))
                 continue
 
             # TODO: change this to use __version__
 
-            submissions_count += 1
-            submission_counts_by_version.update([version_id])
+            self.submissions_count += len(run)
+            self.submission_counts_by_version[version_id] += len(run)
+            if progress is not None:
+                progress.add(submissions=len(run))
 
-            # TODO: do we really need FormSubmission ?
+            split_by_path = split_by_field.path
+            for entry in run:
+                splitter = entry.get(split_by_path)
+                self._count_entry(entry, splitter)
 
-            # since we are going to pop one entry, we make a copy
-            # of it to avoid side effect
-            entry = dict(FormSubmission(sbmssn).data)
-            splitter = entry.pop(split_by_field.path, None)
+                # collect stats for the split_by field
+                if splitter is not None:
+                    values = split_by_field.parse_values(splitter)
+                else:
+                    values = (None,)
 
-            for field in fields:
+                self.splitters_rank.update(values)
 
-                if field.has_stats:
+    def _count_entry(self, entry, splitter=None):
+        """
+        Count the responses of `entry` to each field, in the counter (or
+        sketch) of the field, or with `split_by`, in the counter of each
+        response value, under `splitter`
+        """
+        split_by_path = getattr(self.split_by_field, 'path', None)
+        for field in self.fields:
+            if not field.has_stats:
+                continue
 
-                    raw_value = entry.get(field.path)
+            # The split_by field is only counted as a splitter
+            if field.path == split_by_path:
+                values = None
+            else:
+                values = self._parse_values(field, entry.get(field.path))
+
+            counter = self.metrics[field.name]
+            if split_by_path is None:
+                if values is None:
+                    counter[None] += 1
+                else:
+                    counter.update(values)
+                    counter['__submissions__'] += 1
+                continue
 
-                    if raw_value is not None:
-                        values = field.parse_values(raw_value)
-                    else:
-                        values = (None,)
+            if values is None:
+                values = (None,)
+            for value in values:
+                counters = counter[value]
+                counters[splitter] += 1
+                if value is not None:
+                    counters['__submissions__'] += 1
+
+    @staticmethod
+    def _parse_values(field, raw_value):
+        """
+        Return the list of values of `raw_value`, a response to `field`, or
+        `None` if it is blank or invalid
+        """
+        if raw_value is None:
+            return None
+        try:
+            return list(field.parse_values(raw_value))
+        except ValueError as e:
+            # TODO: Remove try/except when
+            # https://github.com/kobotoolbox/formpack/issues/151
+            # is fixed?
+            logging.warning(str(e), exc_info=True)
+            # Treat the bad value as a blank response
+            return None
 
-                    value_metrics = metrics[field.name]
+    def merge(self, other):
+        """
+        Add the counts of `other`, computed for the same fields and
+        `split_by`, to these metrics and return `self`
+        """
+        if other._signature != self._signature:
+            raise ValueError(
+                'Cannot merge metrics computed for different fields'
+            )
 
-                    for value in values:
-                        counters = value_metrics[value]
-                        counters[splitter] += 1
+        self.submissions_count += other.submissions_count
+        self.submission_counts_by_version.update(
+            other.submission_counts_by_version
+        )
+        self.splitters_rank.update(other.splitters_rank)
+
+        for field_name, other_metrics in other.metrics.items():
+            if isinstance(other_metrics, FrequencySketch):
+                self.metrics[field_name].merge(other_metrics)
+            elif self.split_by_field is None:
+                self.metrics[field_name].update(other_metrics)
+            else:
+                value_metrics = self.metrics[field_name]
+                for value, counters in other_metrics.items():
+                    value_metrics[value].update(counters)
+
+        return self
+
+    def to_bytes(self):
+        """
+        Serialize the metrics as UTF-8 encoded JSON. Counters are stored as
+        lists of `[key, count]` pairs to preserve the type of their keys.
+        """
+        if self.split_by_field is None:
+            metrics = {
+                name: (
+                    {'sketch': counter.to_dict()}
+                    if isinstance(counter, FrequencySketch)
+                    else list(counter.items())
+                )
+                for name, counter in self.metrics.items()
+            }
+        else:
+            metrics = {
+                name: [
+                    [value, list(counters.items())]
+                    for value, counters in value_metrics.items()
+                ]
+                for name, value_metrics in self.metrics.items()
+            }
+
+        field_names, split_by, error = self._signature
+        return json.dumps(
+            {
+                'format': self.SERIALIZATION_FORMAT,
+                'fields': field_names,
+                'split_by': split_by,
+                'error': error,
+                'submissions_count': self.submissions_count,
+                'submission_counts_by_version': list(
+                    self.submission_counts_by_version.items()
+                ),
+                'splitters_rank': list(self.splitters_rank.items()),
+                'metrics': metrics,
+            }
+        ).encode('utf-8')
 
-                        if value is not None:
-                            counters['__submissions__'] += 1
+    @classmethod
+    def from_bytes(cls, autoreport, data):
+        """
+        Rebuild metrics serialized by `to_bytes()`. Fields are looked up by
+        name in the versions of `autoreport`.
+        """
+        state = json.loads(data)
+        if state.get('format') != cls.SERIALIZATION_FORMAT:
+            raise ValueError('Unsupported metrics serialization format')
 
-            # collect stats for the split_by field
-            if splitter is not None:
-                values = split_by_field.parse_values(splitter)
+        split_by = state['split_by']
+        fields, split_by_field = autoreport._get_fields(
+            state['fields'], split_by
+        )
+        fields_by_name = {field.name: field for field in fields}
+        try:
+            fields = [fields_by_name[name] for name in state['fields']]
+        except KeyError as e:
+            raise ValueError(f'Unknown field in serialized metrics: {e}')
+        if split_by_field is not None:
+            fields.append(split_by_field)
+
+        metrics = cls(autoreport, fields, split_by_field, state.get('error'))
+        metrics.submissions_count = state['submissions_count']
+        metrics.submission_counts_by_version.update(
+            dict(state['submission_counts_by_version'])
+        )
+        metrics.splitters_rank.update(dict(state['splitters_rank']))
+
+        for name, items in state['metrics'].items():
+            if isinstance(items, dict):
+                metrics.metrics[name] = sketch_from_dict(items['sketch'])
+            elif split_by_field is None:
+                metrics.metrics[name].update(dict(items))
             else:
-                values = (None,)
+                value_metrics = metrics.metrics[name]
+                for value, counters in items:
+                    value_metrics[value].update(dict(counters))
 
-            splitters_rank.update(values)
+        return metrics
+
+    def get_stats(self, lang=UNSPECIFIED_TRANSLATION):
+        """
+        Return an `AutoReportStats` for the current metrics. Fields consume
+        the counters they are given, so each one gets a copy.
+        """
+        if self.split_by_field is None:
+            return self._get_stats(lang)
+        return self._get_disaggregated_stats(lang)
+
+    def _get_stats(self, lang):
+        fields = self.fields
+        metrics = self.metrics
+
+        def stats_generator():
+            for field in fields:
+                counter = metrics[field.name]
+                if isinstance(counter, FrequencySketch):
+                    stats = field.get_approximate_stats(counter, lang=lang)
+                else:
+                    stats = field.get_stats(OrderedCounter(counter), lang=lang)
+                yield (field, field.get_labels(lang)[0], stats)
+
+        return AutoReportStats(
+            self.autoreport,
+            stats_generator(),
+            self.submissions_count,
+            OrderedCounter(self.submission_counts_by_version),
+        )
+
+    def _get_disaggregated_stats(self, lang):
+        fields = self.fields
+        metrics = self.metrics
+        split_by_field = self.split_by_field
 
         # keep the 5 most encountered split_by value
         top_splitters = []
-        for val, _ in splitters_rank.most_common(6):
+        for val, _ in self.splitters_rank.most_common(6):
             if val is None:
                 continue
             if hasattr(split_by_field, 'get_translation'):
@@ -198,26 +386,78 @@ class AutoReport:
 
         def stats_generator():
             for field in fields:
+                value_metrics = defaultdict(OrderedCounter)
+                for value, counters in metrics[field.name].items():
+                    value_metrics[value] = OrderedCounter(counters)
                 stats = field.get_disaggregated_stats(
-                    metrics[field.name], lang=lang, top_splitters=top_splitters
+                    value_metrics, lang=lang, top_splitters=top_splitters
                 )
                 yield (field, field.get_labels(lang)[0], stats)
 
         return AutoReportStats(
-            self,
+            self.autoreport,
             stats_generator(),
-            submissions_count,
-            submission_counts_by_version,
+            self.submissions_count,
+            OrderedCounter(self.submission_counts_by_version),
         )
 
-    def get_stats(
+
+class AutoReport:
+    def __init__(
         self,
-        submissions,
-        fields=(),
-        lang=UNSPECIFIED_TRANSLATION,
-        split_by=None,
+        formpack,
+        form_versions,
+        on_progress=None,
+        progress_every=DEFAULT_PROGRESS_EVERY,
+        progress_interval=None,
     ):
+        """
+        :param formpack: FormPack
+        :param form_versions: OrderedDict
+        :param on_progress: callable. Called with progress events while
+            submissions are counted; see `ProgressTracker`
+        :param progress_every: int. Number of submissions between events
+        :param progress_interval: float or None. Maximum number of seconds
+            between events
+        """
+        self.formpack = formpack
+        self.versions = form_versions
+        self.router = VersionRouter(
+            form_versions, formpack.version_id_keys(), strict=True
+        )
+        self.progress = None
+        if on_progress is not None:
+            self.progress = ProgressTracker(
+                on_progress, progress_every, progress_interval
+            )
 
+    def _get_version_id_from_submission(self, submission):
+        """
+        Get the version ID from the provided submission, or `None` if not found.
+
+        :param dict submission: An individual data submission.
+        :rtype: str or NoneType
+        """
+        return self.router.get_version_id(submission)
+
+    def get_submission_keys(self, fields=(), split_by=None):
+        """
+        Return the set of top-level submission keys read by `get_stats()`
+        for these `fields` and `split_by`, e.g. to only load those with
+        `formpack.io` readers
+        """
+        fields, split_by_field = self._get_fields(fields, split_by)
+        keys = set(self.router.version_id_keys)
+        keys.update(field.path for field in fields)
+        if split_by_field is not None:
+            keys.add(split_by_field.path)
+        return keys
+
+    def _get_fields(self, fields=(), split_by=None):
+        """
+        Return the fields to get stats on, and the `split_by` field (or
+        `None`)
+        """
         all_fields = self.formpack.get_fields_for_versions(self.versions)
         all_fields = [field for field in all_fields if field.has_stats]
 
@@ -228,6 +468,7 @@ class AutoReport:
             fields.add(split_by)
             fields = [field for field in all_fields if field.name in fields]
 
+        split_by_field = None
         if split_by:
             try:
                 split_by_field = next(f for f in fields if f.name == split_by)
@@ -236,8 +477,65 @@ class AutoReport:
                     'No field matching name "%s" ' 'for split_by' % split_by
                 )
 
-            return self._disaggregate_stats(
-                submissions, fields, self.versions, lang, split_by_field
-            )
+        return fields, split_by_field
+
+    def get_metrics(
+        self, fields=(), split_by=None, approximate=False, error=DEFAULT_ERROR
+    ):
+        """
+        Return an empty `AutoReportMetrics` for these fields. Feed it with
+        `update()`, combine it with `merge()`, store it with `to_bytes()`,
+        and call its `get_stats()` whenever a report is needed.
+
+        See `get_stats()` for `approximate` and `error`.
+        """
+        fields, split_by_field = self._get_fields(fields, split_by)
+        return AutoReportMetrics(
+            self, fields, split_by_field, error if approximate else None
+        )
 
-        return self._calculate_stats(submissions, fields, self.versions, lang)
+    def load_metrics(self, data):
+        """
+        Return the `AutoReportMetrics` serialized in `data` by
+        `AutoReportMetrics.to_bytes()`
+        """
+        return AutoReportMetrics.from_bytes(self, data)
+
+    def get_stats(
+        self,
+        submissions,
+        fields=(),
+        lang=UNSPECIFIED_TRANSLATION,
+        split_by=None,
+        approximate=False,
+        error=DEFAULT_ERROR,
+        cache=None,
+        where=None,
+    ):
+        """
+        Return an `AutoReportStats` for `submissions`.
+
+        With `approximate=True`, numeric and text fields use a fixed amount
+        of memory whatever the number of distinct responses: frequencies are
+        limited to the most common values, medians and percentiles come from
+        a quantile sketch, and a `distinct_count` estimate is added. Counts
+        and ranks are off by about `error` (relative) at most. Approximate
+        stats cannot be split by a field.
+
+        With a `ReportCache`, metrics of previous calls are reused and only
+        submissions above the cached watermark are counted.
+
+        With `where`, only submissions matching these conditions are
+        counted; see `SubmissionFilter`. They are checked on the raw
+        submissions, before anything else.
+        """
+        metrics = self.get_metrics(fields, split_by, approximate, error)
+        if where is not None:
+            where = SubmissionFilter(where)
+        if cache is not None:
+            metrics = cache.update_metrics(metrics, submissions, where)
+        else:
+            if where is not None:
+                submissions = where.filter(submissions)
+            metrics.update(submissions)
+        return metrics.get_stats(lang)
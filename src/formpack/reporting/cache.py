@@ -0,0 +1,229 @@
+# coding: utf-8
+"""
+Opt-in on-disk cache for exports and reports of append-only data sets.
+
+Results are stored under a key computed from the version schemas and the
+options of the export or report, along with a watermark: the highest value
+of `watermark_key` (e.g. `_id` or `_submission_time`) among submissions
+already processed. Next time, only submissions above the watermark are
+processed; the rest comes from the cache.
+"""
+
+import json
+import os
+import pickle
+
+from ..utils.json_hash import json_hash
+
+# Bump when the format of cached data changes
+CACHE_FORMAT = 1
+
+KEY_SIZE = 32
+
+
+class ReportCache:
+    """
+    Cache formatted export rows and report metrics in `directory`.
+
+    Submissions must come in ascending order of `watermark_key`, and
+    submissions at or below the cached watermark must not have changed;
+    call `clear()` after editing or deleting submissions. The cache is not
+    safe to share between processes writing at the same time.
+
+    Cached rows are pickles: only use a `directory` that untrusted users
+    cannot write to.
+    """
+
+    def __init__(self, directory, watermark_key='_id'):
+        self.directory = directory
+        self.watermark_key = watermark_key
+        os.makedirs(directory, exist_ok=True)
+
+    def _get_key(self, kind, versions, analysis_form, options):
+        return json_hash(
+            {
+                'format': CACHE_FORMAT,
+                'kind': kind,
+                'watermark_key': self.watermark_key,
+                'schemas': [version.schema for version in versions.values()],
+                'analysis_form': getattr(analysis_form, 'schema', None),
+                'options': options,
+            },
+            size=KEY_SIZE,
+        )
+
+    def get_export_key(self, export):
+        return self._get_key(
+            'export',
+            export.versions,
+            export.analysis_form,
+            {
+                'lang': export.lang,
+                'group_sep': export.group_sep,
+                'hierarchy_in_labels': export.herarchy_in_labels,
+                'title': export.title,
+                'multiple_select': export.multiple_select,
+                'copy_fields': export.copy_field_names,
+                'force_index': export.force_index,
+                'version_id_keys': export.version_id_keys,
+                'tag_cols_for_header': export.tag_cols_for_header,
+                'filter_fields': export.filter_fields,
+                'xls_types_as_text': export.xls_types_as_text,
+                'include_media_url': export.include_media_url,
+                # Compiled plans drop cells that have no column
+                'compile_sections': export.compile_sections,
+                **self._get_where_option(export.where),
+            },
+        )
+
+    def get_metrics_key(self, metrics, where=None):
+        field_names, split_by, error = metrics._signature
+        return self._get_key(
+            'metrics',
+            metrics.autoreport.versions,
+            None,
+            {
+                'fields': field_names,
+                'split_by': split_by,
+                'error': error,
+                **self._get_where_option(where),
+            },
+        )
+
+    @staticmethod
+    def _get_where_option(where):
+        # Keys of unfiltered results are left as they were before filters
+        if where is None:
+            return {}
+        return {'where': where.get_key()}
+
+    def _get_path(self, key, extension):
+        return os.path.join(self.directory, f'{key}.{extension}')
+
+    def _read_meta(self, key, extension='json'):
+        try:
+            with open(self._get_path(key, extension)) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+        if meta.get('format') != CACHE_FORMAT:
+            return None
+        return meta
+
+    def _write_meta(self, key, meta, extension='json'):
+        meta = dict(meta, format=CACHE_FORMAT)
+        path = self._get_path(key, extension)
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, path)
+
+    def _iter_new_submissions(self, submissions, watermark, state):
+        """
+        Yield submissions above `watermark`, and keep the highest watermark
+        seen in `state['watermark']`
+        """
+        key = self.watermark_key
+        for submission in submissions:
+            try:
+                value = submission[key]
+            except KeyError:
+                raise ValueError(
+                    f'Cannot cache submissions without a `{key}` watermark'
+                )
+            if watermark is not None and value <= watermark:
+                continue
+            if state['watermark'] is None or value > state['watermark']:
+                state['watermark'] = value
+            yield submission
+
+    def parse_submissions(self, export, submissions):
+        """
+        Like `Export.parse_submissions()`: yield the cached chunks first,
+        then format, cache and yield the chunks of new submissions.
+        The cache is only updated once `submissions` is exhausted.
+        """
+        key = self.get_export_key(export)
+        meta = self._read_meta(key) or {
+            'watermark': None,
+            'indexes': None,
+            'size': 0,
+        }
+        rows_path = self._get_path(key, 'pickle')
+
+        export.reset()
+        if meta['size']:
+            with open(rows_path, 'rb') as f:
+                while f.tell() < meta['size']:
+                    yield pickle.load(f)
+            export._indexes.update(meta['indexes'])
+
+        state = {'watermark': meta['watermark']}
+        mode = 'r+b' if os.path.exists(rows_path) else 'wb'
+        with open(rows_path, mode) as f:
+            # Drop whatever a previous, interrupted run wrote after the last
+            # complete update
+            f.seek(meta['size'])
+            f.truncate()
+            for formatted_chunks in export._parse_runs(
+                self._iter_new_submissions(
+                    submissions, meta['watermark'], state
+                )
+            ):
+                pickle.dump(
+                    formatted_chunks, f, protocol=pickle.HIGHEST_PROTOCOL
+                )
+                yield formatted_chunks
+            size = f.tell()
+
+        self._write_meta(
+            key,
+            {
+                'watermark': state['watermark'],
+                'indexes': export._indexes,
+                'size': size,
+            },
+        )
+
+    def update_metrics(self, metrics, submissions, where=None):
+        """
+        Load the cached counterpart of the empty `metrics`, update it with
+        the new submissions, cache it and return it
+
+        :param where: SubmissionFilter or None. Only count the new
+            submissions it keeps
+        """
+        key = self.get_metrics_key(metrics, where)
+        meta = self._read_meta(key, 'metrics')
+        if meta is not None:
+            metrics = metrics.autoreport.load_metrics(meta['metrics'])
+            watermark = meta['watermark']
+        else:
+            watermark = None
+
+        state = {'watermark': watermark}
+        new_submissions = self._iter_new_submissions(
+            submissions, watermark, state
+        )
+        if where is not None:
+            new_submissions = where.filter(new_submissions)
+        metrics.update(new_submissions)
+
+        # Metrics and their watermark are replaced at once
+        self._write_meta(
+            key,
+            {
+                'watermark': state['watermark'],
+                'metrics': metrics.to_bytes().decode('utf-8'),
+            },
+            'metrics',
+        )
+        return metrics
+
+    def clear(self):
+        """
+        Remove all cached data
+        """
+        for filename in os.listdir(self.directory):
+            if filename.endswith(('.json', '.pickle', '.metrics', '.tmp')):
+                os.remove(os.path.join(self.directory, filename))
@@ -0,0 +1,297 @@
+# coding: utf-8
+"""
+Typed columnar (Apache Arrow / Parquet) output for `Export`.
+
+`pyarrow` is an optional dependency: it is only imported when one of these
+exports is requested.
+"""
+
+import datetime
+import os
+
+from dateutil import parser
+
+from ..schema.fields import (
+    DateField,
+    DateTimeField,
+    FormChoiceFieldWithMultipleSelect,
+    FormGPSField,
+    IdCopyField,
+    NumField,
+    SubmissionTimeCopyField,
+)
+from ..utils.text import get_unique_filenames
+
+# Kinds of columns, mapped to Arrow types by `_get_arrow_type()`
+STRING = 'string'
+INT64 = 'int64'
+FLOAT64 = 'float64'
+UINT8 = 'uint8'
+DATE = 'date'
+TIMESTAMP = 'timestamp'
+
+AUTO_COLUMN_KINDS = {
+    '_index': INT64,
+    '_parent_index': INT64,
+    '_parent_table_name': STRING,
+}
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet  # noqa
+    except ImportError:
+        raise ImportError(
+            'pyarrow is required for Arrow and Parquet exports; install it '
+            'with `pip install pyarrow`'
+        )
+    return pyarrow
+
+
+def get_column_kind(field, value_name):
+    """
+    Return the kind of data stored in the column `value_name` produced by
+    `field`
+    """
+    if isinstance(field, NumField):
+        return INT64 if field.data_type == 'integer' else FLOAT64
+    if isinstance(field, DateTimeField):
+        return TIMESTAMP
+    if isinstance(field, DateField):
+        return DATE
+    if isinstance(field, IdCopyField):
+        return INT64
+    if isinstance(field, SubmissionTimeCopyField):
+        return TIMESTAMP
+    if isinstance(field, FormGPSField):
+        return STRING if value_name == field.name else FLOAT64
+    if isinstance(field, FormChoiceFieldWithMultipleSelect):
+        # Literacy test parameters are not 0/1 details
+        if value_name == field.name or value_name in getattr(
+            field, 'parameter_value_names', ()
+        ):
+            return STRING
+        return UINT8
+    return STRING
+
+
+def get_section_columns(export):
+    """
+    Return `{section_name: [(column_name, kind), ...]}`, aligned with the
+    rows produced by `export.parse_submissions()`.
+
+    Column names are the export labels. When several versions disagree on
+    the kind of a column, it falls back to a string column.
+    """
+    kinds = {}
+    for field in export.get_fields_for_all_versions():
+        section_kinds = kinds.setdefault(field.section.name, {})
+        value_names = field.get_value_names(
+            multiple_select=export.multiple_select,
+            include_media_url=export.include_media_url,
+        )
+        for value_name in value_names:
+            kind = get_column_kind(field, value_name)
+            if section_kinds.setdefault(value_name, kind) != kind:
+                section_kinds[value_name] = STRING
+
+    section_columns = {}
+    for section_name, row in export._row_cache.items():
+        labels = dict(
+            zip(export.sections[section_name], export.labels[section_name])
+        )
+        section_kinds = kinds.get(section_name, {})
+        columns = []
+        used_labels = set()
+        for value_name in row:
+            label = labels.get(value_name, value_name)
+            if label in used_labels:
+                label = value_name
+            used_labels.add(label)
+            kind = section_kinds.get(
+                value_name, AUTO_COLUMN_KINDS.get(value_name, STRING)
+            )
+            columns.append((label, kind))
+        section_columns[section_name] = columns
+
+    return section_columns
+
+
+def _to_string(value):
+    if value is None:
+        return None
+    return str(value)
+
+
+def _to_int(value):
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            # e.g. '5.0' or '1e3', as typed in text cells
+            value = float(value)
+    if isinstance(value, float) and not value.is_integer():
+        raise ValueError('not an integer')
+    return int(value)
+
+
+def _to_float(value):
+    return float(value)
+
+
+def _to_datetime(value):
+    if isinstance(value, datetime.datetime):
+        return value
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        pass
+    try:
+        return parser.parse(value)
+    except OverflowError:
+        raise ValueError(f'{value!r} is out of range')
+
+
+def _to_date(value):
+    if isinstance(value, datetime.date) and not isinstance(
+        value, datetime.datetime
+    ):
+        return value
+    return _to_datetime(value).date()
+
+
+def _to_timestamp(value):
+    value = _to_datetime(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value
+
+
+CONVERTERS = {
+    STRING: _to_string,
+    INT64: _to_int,
+    FLOAT64: _to_float,
+    UINT8: _to_int,
+    DATE: _to_date,
+    TIMESTAMP: _to_timestamp,
+}
+
+
+def _get_arrow_type(pa, kind):
+    return {
+        STRING: pa.string(),
+        INT64: pa.int64(),
+        FLOAT64: pa.float64(),
+        UINT8: pa.uint8(),
+        DATE: pa.date32(),
+        TIMESTAMP: pa.timestamp('us', tz='UTC'),
+    }[kind]
+
+
+def get_arrow_schemas(export):
+    """
+    Return `{section_name: pyarrow.Schema}` for all sections of `export`
+    """
+    pa = import_pyarrow()
+    return {
+        section_name: pa.schema(
+            [(label, _get_arrow_type(pa, kind)) for label, kind in columns]
+        )
+        for section_name, columns in get_section_columns(export).items()
+    }
+
+
+def _convert_cell(convert, kind, column, value):
+    if value == '' or value is None:
+        return None
+    try:
+        return convert(value)
+    except (TypeError, ValueError) as e:
+        raise ValueError(
+            f'Cannot convert {value!r} in column `{column}` to {kind}: {e}'
+        )
+
+
+def rows_to_record_batch(pa, rows, schema, kinds):
+    """
+    Build a `pyarrow.RecordBatch` from formatted export rows. Empty cells
+    become nulls, except in string columns. Values that cannot be converted
+    to the column type raise a `ValueError` rather than being lost.
+    """
+    arrays = []
+    for index, (kind, arrow_field) in enumerate(zip(kinds, schema)):
+        convert = CONVERTERS[kind]
+        if kind == STRING:
+            values = [convert(row[index]) for row in rows]
+        else:
+            values = [
+                _convert_cell(convert, kind, arrow_field.name, row[index])
+                for row in rows
+            ]
+        arrays.append(pa.array(values, type=arrow_field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def iter_record_batches(export, submissions, batch_size, **parse_kwargs):
+    """
+    Yield `(section_name, pyarrow.RecordBatch)` tuples with at most
+    `batch_size` rows each. Sections are flushed independently, so batches
+    of different sections are interleaved.
+    """
+    pa = import_pyarrow()
+    schemas = get_arrow_schemas(export)
+    kinds = {
+        section_name: [kind for _, kind in columns]
+        for section_name, columns in get_section_columns(export).items()
+    }
+    buffers = {section_name: [] for section_name in schemas}
+
+    for chunk in export.parse_submissions(submissions, **parse_kwargs):
+        for section_name, rows in chunk.items():
+            buffer = buffers[section_name]
+            buffer.extend(rows)
+            while len(buffer) >= batch_size:
+                yield section_name, rows_to_record_batch(
+                    pa,
+                    buffer[:batch_size],
+                    schemas[section_name],
+                    kinds[section_name],
+                )
+                del buffer[:batch_size]
+
+    for section_name, buffer in buffers.items():
+        if buffer:
+            yield section_name, rows_to_record_batch(
+                pa, buffer, schemas[section_name], kinds[section_name]
+            )
+
+
+def write_parquet(export, path, submissions, batch_size, **parse_kwargs):
+    """
+    Write one Parquet file per section of `export` into the directory
+    `path`, and return `{section_name: file_path}`
+    """
+    pa = import_pyarrow()
+    os.makedirs(path, exist_ok=True)
+    schemas = get_arrow_schemas(export)
+    file_paths = {
+        section_name: os.path.join(path, filename)
+        for section_name, filename in get_unique_filenames(
+            schemas, 'parquet'
+        ).items()
+    }
+    writers = {
+        section_name: pa.parquet.ParquetWriter(file_paths[section_name], schema)
+        for section_name, schema in schemas.items()
+    }
+    try:
+        for section_name, batch in iter_record_batches(
+            export, submissions, batch_size, **parse_kwargs
+        ):
+            writers[section_name].write_batch(batch)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    return file_paths
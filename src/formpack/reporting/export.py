@@ -1,14 +1,21 @@
 # coding: utf-8
 import json
+import pickle
 import re
+import tempfile
 import zipfile
 from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+from functools import partial
 from inspect import isclass
+from time import perf_counter
 from typing import (
     Dict,
     Generator,
+    Iterable,
     Iterator,
     Optional,
+    Sequence,
 )
 
 import xlsxwriter
@@ -21,15 +28,142 @@ from ..constants import (
     UNSPECIFIED_TRANSLATION,
 )
 from ..schema import CopyField, FormField
-from ..submission import FormSubmission
 from ..utils.exceptions import FormPackGeoJsonError
 from ..utils.flatten_content import flatten_tag_list
-from ..utils.geojson import field_and_response_to_geometry
+from ..utils.geojson import (
+    GEOMETRY_TYPES,
+    bounds_intersect_bbox,
+    field_and_response_to_geometry,
+    get_geometry_bounds,
+)
 from ..utils.iterator import get_first_occurrence
-from ..utils.replace_aliases import EXTENDED_MEDIA_TYPES
 from ..utils.spss import spss_labels_from_variables_dict
 from ..utils.string import unique_name_for_xls
-from ..utils.text import get_valid_filename
+from ..utils.text import get_unique_filenames
+from .columnar import iter_record_batches, write_parquet
+from .parallel import parse_submissions_in_parallel
+from .plan import (
+    SectionPlan,
+    get_attachment,
+    get_value_from_supplemental_details,
+)
+from .filters import SubmissionFilter
+from .profiler import ExportProfiler
+from .progress import DEFAULT_PROGRESS_EVERY, ProgressTracker
+from .router import VersionRouter
+from .streams import DEFAULT_BUFFER_SIZE, BlockWriter, compressed_stream
+from .zipstream import DEFAULT_SPOOL_SIZE, ZipStreamWriter
+
+
+class AttachmentIndex:
+    """
+    Attachments of a submission by file basename. The index is built on
+    the first lookup, and shared with the entries of nested repeat groups.
+    """
+
+    def __init__(self, attachments):
+        self.attachments = attachments
+        self._by_basename = None
+
+    def __len__(self):
+        return len(self.attachments)
+
+    def get(self, basename):
+        if self._by_basename is None:
+            self._by_basename = {}
+            for attachment in self.attachments:
+                _, sep, _basename = attachment['filename'].rpartition('/')
+                # Only filenames with a directory part have ever matched
+                if sep:
+                    self._by_basename.setdefault(_basename, []).append(
+                        attachment
+                    )
+        return self._by_basename.get(basename, [])
+
+
+def _get_attachment_index(entry, attachments):
+    """
+    Return an `AttachmentIndex` of the attachments of `entry`, or the one
+    of its parent entries, `attachments`, if it has none
+    """
+    entry_attachments = entry.get('_attachments')
+    if entry_attachments:
+        return AttachmentIndex(entry_attachments)
+    if attachments and not isinstance(attachments, AttachmentIndex):
+        return AttachmentIndex(attachments)
+    return attachments
+
+
+def _get_value_from_entry(
+    entry: Dict, field: FormField, supplemental_details: Dict
+) -> Optional[str]:
+    if field.analysis_question and supplemental_details:
+        return get_value_from_supplemental_details(field, supplemental_details)
+
+    suffix = 'meta/' if field.data_type == 'audit' else ''
+    return entry.get(f'{suffix}{field.path}')
+
+
+def _profile_field(
+    profiler, field, entry, attachments, supplemental_details, format_field
+):
+    """
+    Return the cells of `field` for `entry`, like
+    `Export.format_one_submission()`, and record the time of each step in
+    `profiler`, an `ExportProfiler`
+
+    :param format_field: `field.format` with the export formatting options
+    """
+    start = perf_counter()
+    if field.analysis_question and supplemental_details:
+        val = get_value_from_supplemental_details(field, supplemental_details)
+        value_step = 'supplemental_details'
+    else:
+        val = _get_value_from_entry(entry, field, None)
+        value_step = 'value'
+    got_value = perf_counter()
+    attachment = get_attachment(val, field, attachments)
+    got_attachment = perf_counter()
+    cells = format_field(val=val, attachment=attachment)
+    end = perf_counter()
+
+    profiler.add_field(
+        field,
+        **{value_step: got_value - start},
+        attachment=got_attachment - got_value,
+        format=end - got_attachment,
+    )
+    return cells
+
+
+def _escape_quote(value, quote):
+    """
+    According to https://www.ietf.org/rfc/rfc4180.txt,
+
+        If double-quotes are used to enclose fields, then a
+        double-quote appearing inside a field must be escaped by
+        preceding it with another double quote.
+
+    We will follow this convention by doubling `quote` wherever it
+    appears in `value`, regardless of what `quote` is. Perhaps this
+    is not the best idea.
+    """
+    return value.replace(quote, quote * 2)
+
+
+def _iter_feature_lines(features):
+    """
+    Yield GeoJSON `features` as JSON, separated by commas, each on a new line
+    """
+    separator = '\n'
+    for feature in features:
+        yield separator + json.dumps(feature)
+        separator = ',\n'
+
+
+def _format_csv_line(line, sep, quote):
+    line = [_escape_quote(str(x), quote) for x in line]
+    return quote + (quote + sep + quote).join(line) + quote
 
 
 class Export:
@@ -49,6 +183,13 @@ class Export:
         filter_fields=(),
         xls_types_as_text=True,
         include_media_url=False,
+        compile_sections=False,
+        cache=None,
+        profile=False,
+        on_progress=None,
+        progress_every=DEFAULT_PROGRESS_EVERY,
+        progress_interval=None,
+        where=None,
     ):
         """
         :param formpack: FormPack
@@ -68,6 +209,20 @@ class Export:
         :param filter_fields: list
         :param xls_types_as_text: bool
         :param include_media_url: bool
+        :param compile_sections: bool. Build a formatting plan for each
+            section once, instead of resolving fields on every entry
+        :param cache: ReportCache. Reuse rows formatted by previous exports
+            with the same options, and only format newer submissions
+        :param profile: bool. Time the formatting of each field and section;
+            see `profile()`
+        :param on_progress: callable. Called with progress events while
+            submissions are parsed; see `ProgressTracker`
+        :param progress_every: int. Number of submissions between events
+        :param progress_interval: float or None. Maximum number of seconds
+            between events
+        :param where: dict or callable. Only export submissions matching
+            these conditions, checked before formatting; see
+            `SubmissionFilter`
         """
 
         self.formpack = formpack
@@ -81,9 +236,19 @@ class Export:
         self.force_index = force_index
         self.herarchy_in_labels = hierarchy_in_labels
         self.version_id_keys = version_id_keys
+        self.router = VersionRouter(form_versions, version_id_keys)
         self.filter_fields = filter_fields
         self.xls_types_as_text = xls_types_as_text
         self.include_media_url = include_media_url
+        self.compile_sections = compile_sections
+        self.cache = cache
+        self.profiler = ExportProfiler() if profile else None
+        self.where = SubmissionFilter(where) if where is not None else None
+        self.progress = None
+        if on_progress is not None:
+            self.progress = ProgressTracker(
+                on_progress, progress_every, progress_interval
+            )
         self.__r_groups_submission_mapping_values = {}
 
         if tag_cols_for_header is None:
@@ -109,6 +274,7 @@ class Export:
                             copy_field, section=first_section
                         )
                     first_section.fields[dumb_field.name] = dumb_field
+            formpack.clear_fields_cache()
 
         # Some copy fields are classes, some strings -- collect their field
         # names for later use
@@ -117,6 +283,11 @@ class Export:
             for copy_field in self.copy_fields
         ]
 
+        # Fields to format for each section, and names of the sections to
+        # export, with `filter_fields` applied
+        self._section_fields = {}
+        self._projected_sections = self._compile_projection()
+
         # this deals with merging all form versions headers and labels
         res = self.get_fields_labels_tags_for_all_versions(
             lang,
@@ -136,21 +307,120 @@ class Export:
             self._row_cache[section_name] = OrderedDict.fromkeys(fields, '')
             self._empty_row[section_name] = dict(self._row_cache[section_name])
 
+        self._section_plans = None
+        if self.compile_sections:
+            self._compile_section_plans()
+
+    def _compile_section_plans(self):
+        """
+        Build one `SectionPlan` per section of each version. Plans capture the
+        current formatting options, so they must be rebuilt if those change.
+        """
+        format_kwargs = {
+            'lang': self.lang,
+            'multiple_select': self.multiple_select,
+            'xls_types_as_text': self.xls_types_as_text,
+            'include_media_url': self.include_media_url,
+        }
+        self._section_plans = {}
+        for version in self.versions.values():
+            for section in version.sections.values():
+                if section.name not in self._projected_sections:
+                    continue
+                self._section_plans[section] = SectionPlan(
+                    section,
+                    self._row_cache[section.name].keys(),
+                    self._get_section_fields(section),
+                    format_kwargs,
+                    self.copy_field_names,
+                    child_sections=[
+                        child
+                        for child in section.children
+                        if child.name in self._projected_sections
+                    ],
+                )
+
+    def _get_section_fields(self, section):
+        """
+        Return the fields of `section` to format, with analysis fields
+        inserted and `filter_fields` applied. Computed once per section.
+        """
+        try:
+            return self._section_fields[section]
+        except KeyError:
+            pass
+
+        fields = tuple(section.fields.values())
+        if self.analysis_form:
+            fields = self.analysis_form.insert_analysis_fields(fields)
+        if self.filter_fields:
+            filter_fields = set(self.filter_fields)
+            fields = tuple(
+                field for field in fields if field.path in filter_fields
+            )
+        self._section_fields[section] = fields
+        return fields
+
+    def _compile_projection(self):
+        """
+        Return the names of the sections to export. Without `filter_fields`,
+        that is all of them. Otherwise, it is the first section and the
+        repeat groups with selected fields or with nested repeat groups that
+        have some: other repeat groups are neither formatted nor read.
+        """
+        projected_sections = set()
+        for version in self.versions.values():
+            sections = list(version.sections.values())
+            projected_sections.add(sections[0].name)
+            for section in sections:
+                if self.filter_fields and not self._get_section_fields(section):
+                    continue
+                while section is not None:
+                    projected_sections.add(section.name)
+                    section = section.parent
+        return projected_sections
+
+    def profile(self):
+        """
+        Return the formatting timings collected so far by an export created
+        with `profile=True`; see `ExportProfiler.report()`
+        """
+        if self.profiler is None:
+            raise ValueError('Profiling requires an export with `profile=True`')
+        return self.profiler.report()
+
+    def get_submission_keys(self):
+        """
+        Return the set of top-level submission keys this export reads, e.g.
+        to only load those with `formpack.io` readers. Repeat groups are
+        read whole. Returns `None`, for all keys, when submissions are
+        filtered by a callable.
+        """
+        keys = set(self.version_id_keys)
+        keys.update(('_attachments', '_supplementalDetails'))
+        if self.where is not None:
+            try:
+                keys.update(self.where.get_key())
+            except ValueError:
+                # A callable may read anything
+                return None
+        for version in self.versions.values():
+            section = get_first_occurrence(version.sections.values())
+            for field in self._get_section_fields(section):
+                keys.add(field.path)
+                # Audit logs are stored under `meta/`
+                keys.add(f'meta/{field.path}')
+            for child_section in section.children:
+                if child_section.name in self._projected_sections:
+                    keys.add(child_section.path)
+        return keys
+
     def get_version_for_submission(self, submission):
         """
         Return the `FormVersion` for this submission, or `None` if none can be
         found
         """
-        version_id = None
-        # find the first version_id present in the submission
-        for _key in self.version_id_keys:
-            if _key in submission:
-                version_id = submission.get(_key)
-                break
-        try:
-            return self.versions[version_id]
-        except KeyError:
-            return None
+        return self.router.get_version(submission)
 
     def parse_one_submission(self, submission, version=None):
         """
@@ -167,24 +437,98 @@ class Export:
         if not version:
             # TODO: somehow include this submission anyway; see
             # https://github.com/kobotoolbox/formpack/issues/164
+            if self.progress is not None:
+                self.progress.skip()
             return None
         # `format_one_submission()` will recurse through all the sections; get
         # the first one to start
         section = get_first_occurrence(version.sections.values())
-        submission = FormSubmission(submission)
-        return self.format_one_submission([submission.data], section)
+        return self.format_one_submission([submission], section)
 
-    def parse_submissions(self, submissions):
+    def parse_submissions(self, submissions, processes=None, batch_size=1000):
         """
         Return a generator yielding formatted 'chunks' for each submission from
         the data set
+
+        If `processes` is greater than 1, batches of `batch_size` submissions
+        are formatted by a pool of worker processes, each with its own copy of
+        this export. Chunks still come out in order, with the same `_index`
+        and `_parent_index` values as a single-process run. Rows are the
+        same too, with one exception without `compile_sections`. Cells that
+        have no column, such as multiple select details of choices missing
+        from the form, stay in the row cache of each process. Rows may then
+        end with different extra cells. Compiled plans drop those cells.
+
+        With a `cache`, rows of submissions seen by a previous export come
+        from the cache, and new submissions are formatted in this process.
+
+        With `on_progress`, submissions and rows are counted as chunks are
+        yielded, along with submissions skipped for lack of a known version.
+        """
+        if self.where is not None:
+            submissions = self.where.filter(submissions)
+        chunks = self._parse_submissions(submissions, processes, batch_size)
+        if self.progress is None:
+            return chunks
+        return self._track_progress(chunks)
+
+    def _track_progress(self, chunks):
+        with self._progress_run():
+            for formatted_chunks in chunks:
+                self.progress.add_chunks(formatted_chunks)
+                yield formatted_chunks
+
+    @contextmanager
+    def _progress_run(self):
         """
+        Report progress, if requested, for what happens within the block
+        """
+        if self.progress is None:
+            yield
+            return
+        self.progress.begin()
+        try:
+            yield
+        finally:
+            self.progress.end()
+
+    def _get_block_writer(self, stream, encoding, buffer_size):
+        on_flush = None
+        if self.progress is not None:
+            on_flush = self.progress.add_bytes
+        return BlockWriter(stream, encoding, buffer_size, on_flush)
+
+    def _parse_submissions(self, submissions, processes, batch_size):
+        if self.cache is not None:
+            yield from self.cache.parse_submissions(self, submissions)
+            return
+
+        if processes is not None and processes > 1:
+            yield from parse_submissions_in_parallel(
+                self, submissions, processes, batch_size
+            )
+            return
+
         self.reset()
-        for submission in submissions:
-            formatted_chunks = self.parse_one_submission(submission)
-            if not formatted_chunks:
+        yield from self._parse_runs(submissions)
+
+    def _parse_runs(self, submissions):
+        """
+        Yield the chunks of each submission of a known version, like
+        `parse_one_submission()`, but resolve the version and its first
+        section once per run of consecutive submissions of the same version
+        """
+        format_one_submission = self.format_one_submission
+        progress = self.progress
+        for _, version, run in self.router.iter_runs(submissions):
+            if version is None:
+                if progress is not None:
+                    for _ in run:
+                        progress.skip()
                 continue
-            yield formatted_chunks
+            section = get_first_occurrence(version.sections.values())
+            for submission in run:
+                yield format_one_submission([submission], section)
 
     def reset(self):
         """
@@ -199,6 +543,27 @@ class Export:
         self.__r_groups_submission_mapping_values = {}
         # N.B: indexes are not affected by form versions
 
+    def get_fields_for_all_versions(self):
+        """
+        Return the fields of all the exported versions, with analysis fields
+        inserted and `filter_fields` applied
+        """
+        all_fields = self.formpack.get_fields_for_versions(self.versions)
+
+        # Ensure that fields are filtered if they've been specified, otherwise
+        # carry on as usual
+        if self.analysis_form:
+            all_fields = self.analysis_form.insert_analysis_fields(all_fields)
+
+        if self.filter_fields:
+            all_fields = [
+                field
+                for field in all_fields
+                if field.path in self.filter_fields
+            ]
+
+        return all_fields
+
     def get_fields_labels_tags_for_all_versions(
         self,
         lang=UNSPECIFIED_TRANSLATION,
@@ -235,24 +600,18 @@ class Export:
                 '{} is not in TAG_COLUMNS_AND_SEPARATORS'.format(e.message)
             )
 
-        all_fields = self.formpack.get_fields_for_versions(self.versions)
-
-        # Ensure that fields are filtered if they've been specified, otherwise
-        # carry on as usual
-        if self.analysis_form:
-            all_fields = self.analysis_form.insert_analysis_fields(all_fields)
-
-        if self.filter_fields:
-            all_fields = [
-                field
-                for field in all_fields
-                if field.path in self.filter_fields
-            ]
+        all_fields = self.get_fields_for_all_versions()
 
-        # Collect all the sections regardless if they contain any fields
+        # Collect all the sections regardless if they contain any fields,
+        # unless none of their fields or those of their repeat groups are
+        # in `filter_fields`
         all_sections = {}
         for version in self.versions.values():
-            all_sections.update(version.sections)
+            all_sections.update(
+                (name, section)
+                for name, section in version.sections.items()
+                if name in self._projected_sections
+            )
 
         # {section: [field_object, field_object, …], …}
         # {section: [field_label, field_label, …], …}
@@ -280,7 +639,10 @@ class Export:
         for section_name, section in all_sections.items():
             # Append optional additional fields
             auto_field_names = auto_fields[section_name] = []
-            if section.children or self.force_index:
+            if self.force_index or any(
+                child.name in self._projected_sections
+                for child in section.children
+            ):
                 auto_field_names.append('_index')
 
             if section.parent:
@@ -340,7 +702,34 @@ class Export:
         attachments=None,
         supplemental_details=None,
     ):
+        if self._section_plans is not None:
+            format_entries = self._format_one_submission_compiled
+        else:
+            format_entries = self._format_one_submission
+
+        if self.profiler is None:
+            return format_entries(
+                submission, current_section, attachments, supplemental_details
+            )
+
+        self.profiler.start_section()
+        start = perf_counter()
+        try:
+            return format_entries(
+                submission, current_section, attachments, supplemental_details
+            )
+        finally:
+            self.profiler.end_section(
+                current_section, len(submission), perf_counter() - start
+            )
 
+    def _format_one_submission(
+        self,
+        submission,
+        current_section,
+        attachments=None,
+        supplemental_details=None,
+    ):
         # 'current_section' is the name of what will become sheets in xls.
         # If you don't have repeat groups, there is only one section
         # containing all the formatted data.
@@ -378,70 +767,16 @@ class Export:
         _empty_row = self._empty_row[_section_name]
         _indexes = self._indexes
         row = self._row_cache[_section_name]
-        _fields = tuple(current_section.fields.values())
-
-        def _get_attachment(val, field, attachments):
-            """
-            Filter attachments for filenames that match the submission field's
-            value
-            """
-            # Not all submissions will have attachments and we only want to
-            # consider media types
-            if (
-                field.data_type not in EXTENDED_MEDIA_TYPES
-                or not attachments
-                or val is None
-            ):
-                return []
-
-            _val = get_valid_filename(val)
-            return [
-                f
-                for f in attachments
-                if re.match(fr'^.*/{_val}$', f['filename']) is not None
-            ]
-
-        def _get_value_from_supplemental_details(
-            field: FormField, supplemental_details: Dict
-        ) -> Optional[str]:
-            source, name = field.analysis_path
-            _sup_details = supplemental_details.get(source, {})
-
-            if not _sup_details:
-                return
-
-            # The names for translation and transcript fields are in the format
-            # of `translated_<language code>` which must be stripped to get the
-            # value from the supplemental details dict
-            if _name := re.match(r'^(translation|transcript)_', name):
-                name = _name.groups()[0]
-
-            val = _sup_details.get(name)
-            if val is None:
-                return ''
-
-            return val
-
-        def _get_value_from_entry(
-            entry: Dict, field: FormField, supplemental_details: Dict
-        ) -> Optional[str]:
-            if field.analysis_question and supplemental_details:
-                return _get_value_from_supplemental_details(
-                    field, supplemental_details
-                )
-
-            suffix = 'meta/' if field.data_type == 'audit' else ''
-            return entry.get(f'{suffix}{field.path}')
-
-        if self.analysis_form:
-            _fields = self.analysis_form.insert_analysis_fields(_fields)
-
-        # Ensure that fields are filtered if they've been specified, otherwise
-        # carry on as usual
-        if self.filter_fields:
-            _fields = tuple(
-                field for field in _fields if field.path in self.filter_fields
-            )
+        _fields = self._get_section_fields(current_section)
+        _projected_sections = self._projected_sections
+        profiler = self.profiler
+        if profiler is not None:
+            format_kwargs = {
+                'lang': _lang,
+                'multiple_select': self.multiple_select,
+                'xls_types_as_text': self.xls_types_as_text,
+                'include_media_url': self.include_media_url,
+            }
 
         # 'rows' will contain all the formatted entries for the current
         # section. If you don't have repeat-group, there is only one section
@@ -470,20 +805,32 @@ class Export:
             # previous one, but we reset it, to gain some perfs.
             row.update(_empty_row)
 
-            attachments = entry.get('_attachments') or attachments
+            attachments = _get_attachment_index(entry, attachments)
             supplemental_details = (
                 entry.get('_supplementalDetails') or supplemental_details
             )
 
             for field in _fields:
                 # TODO: pass a context to fields so they can all format ?
-                if field.can_format:
+                if not field.can_format:
+                    continue
+
+                if profiler is not None:
+                    cells = _profile_field(
+                        profiler,
+                        field,
+                        entry,
+                        attachments,
+                        supplemental_details,
+                        partial(field.format, **format_kwargs),
+                    )
+                else:
                     # get submission value for this field
                     val = _get_value_from_entry(
                         entry, field, supplemental_details
                     )
                     # get the attachment for this field
-                    attachment = _get_attachment(val, field, attachments)
+                    attachment = get_attachment(val, field, attachments)
                     # get a mapping of {"col_name": "val", ...}
                     cells = field.format(
                         val=val,
@@ -494,22 +841,22 @@ class Export:
                         include_media_url=self.include_media_url,
                     )
 
-                    # save fields value if they match parent mapping fields.
-                    # Useful to map children to their parent when flattening groups.
-                    if field.path in self.copy_field_names:
-                        if (
-                            _section_name
-                            not in self.__r_groups_submission_mapping_values
-                        ):
-                            self.__r_groups_submission_mapping_values[
-                                _section_name
-                            ] = {}
+                # save fields value if they match parent mapping fields.
+                # Useful to map children to their parent when flattening groups.
+                if field.path in self.copy_field_names:
+                    if (
+                        _section_name
+                        not in self.__r_groups_submission_mapping_values
+                    ):
                         self.__r_groups_submission_mapping_values[
                             _section_name
-                        ].update(cells)
+                        ] = {}
+                    self.__r_groups_submission_mapping_values[
+                        _section_name
+                    ].update(cells)
 
-                    # fill in the canvas
-                    row.update(cells)
+                # fill in the canvas
+                row.update(cells)
 
             # Link between the parent and its children in a sub-section.
             # Indeed, with repeat groups, entries are nested. Since we flatten
@@ -537,6 +884,9 @@ class Export:
 
             # Process all repeat groups of this level
             for child_section in current_section.children:
+                # Repeat groups without exported columns are not even read
+                if child_section.name not in _projected_sections:
+                    continue
                 # Because submissions are nested, we flatten them out by reading
                 # the whole submission tree recursively, formatting the entries,
                 # and adding the results to the list of rows for this section.
@@ -558,6 +908,103 @@ class Export:
 
         return chunks
 
+    def _format_one_submission_compiled(
+        self,
+        submission,
+        current_section,
+        attachments=None,
+        supplemental_details=None,
+    ):
+        """
+        Same output as `format_one_submission()`, but driven by the
+        `SectionPlan` compiled for `current_section`: each row is a copy of a
+        preallocated list and each field writes its cells into fixed slots.
+
+        Cells that have no matching column in the export headers are dropped.
+        """
+        chunks = OrderedDict()
+
+        _section_name = current_section.name
+        _indexes = self._indexes
+        _mapping_values = self.__r_groups_submission_mapping_values
+        profiler = self.profiler
+        plan = self._section_plans[current_section]
+        empty_row = plan.empty_row
+        writers = plan.writers
+        child_sections = plan.child_sections
+
+        rows = chunks[_section_name] = []
+
+        for entry in submission:
+            row = empty_row.copy()
+
+            attachments = _get_attachment_index(entry, attachments)
+            supplemental_details = (
+                entry.get('_supplementalDetails') or supplemental_details
+            )
+
+            for writer in writers:
+                if profiler is not None:
+                    cells = _profile_field(
+                        profiler,
+                        writer.field,
+                        entry,
+                        attachments,
+                        supplemental_details,
+                        writer.format,
+                    )
+                    writer.write_cells(row, cells)
+                else:
+                    cells = writer.write(
+                        row, entry, attachments, supplemental_details
+                    )
+
+                if writer.maps_copy_field:
+                    _mapping_values.setdefault(_section_name, {}).update(cells)
+
+            self._write_compiled_indexes(row, plan, current_section)
+            rows.append(row)
+
+            for child_section in child_sections:
+                nested_data = entry.get(child_section.path)
+                if nested_data:
+                    chunk = self.format_one_submission(
+                        nested_data,
+                        child_section,
+                        attachments=attachments,
+                        supplemental_details=supplemental_details,
+                    )
+                    for key, value in chunk.items():
+                        if key in chunks:
+                            chunks[key].extend(value)
+                        else:
+                            chunks[key] = value
+
+            _indexes[_section_name] += 1
+
+        return chunks
+
+    def _write_compiled_indexes(self, row, plan, current_section):
+        """
+        Write the `_index` of the current entry of `current_section` into
+        `row`, and for repeat groups, the index and copied fields of the
+        parent entry
+        """
+        _indexes = self._indexes
+        if plan.index_slot is not None:
+            row[plan.index_slot] = _indexes[current_section.name]
+
+        if plan.parent_table_slot is not None:
+            parent_name = current_section.parent.name
+            row[plan.parent_table_slot] = parent_name
+            row[plan.parent_index_slot] = _indexes[parent_name]
+            extra_mapping_values = self.__get_extra_mapping_values(
+                current_section.parent
+            )
+            if extra_mapping_values:
+                for name, slot in plan.copy_field_slots:
+                    row[slot] = extra_mapping_values.get(name, '')
+
     def get_header_rows_for_tag_cols(self, section_name):
         rows = []
         for tag_col in self.tag_cols_for_header:
@@ -594,12 +1041,21 @@ class Export:
 
         return d
 
-    def to_csv(self, submissions, sep=';', quote='"'):
+    def to_csv(
+        self,
+        submissions,
+        sep=';',
+        quote='"',
+        processes=None,
+        batch_size=1000,
+    ):
         """
         Return a generator yielding csv lines.
 
         We don't use the csv module to avoid buffering the lines
         in memory.
+
+        See `parse_submissions()` for `processes` and `batch_size`.
         """
 
         sections = list(self.labels.items())
@@ -607,43 +1063,124 @@ class Export:
         # if len(sections) > 1:
         #     raise RuntimeError("CSV export does not support repeatable groups")
 
-        def escape_quote(value, quote):
-            """
-            According to https://www.ietf.org/rfc/rfc4180.txt,
-
-                If double-quotes are used to enclose fields, then a
-                double-quote appearing inside a field must be escaped by
-                preceding it with another double quote.
-
-            We will follow this convention by doubling `quote` wherever it
-            appears in `value`, regardless of what `quote` is. Perhaps this
-            is not the best idea.
-            """
-            return value.replace(quote, quote * 2)
-
-        def format_line(line, sep, quote):
-            line = [escape_quote(str(x), quote) for x in line]
-            return quote + (quote + sep + quote).join(line) + quote
-
         section, labels = sections[0]
-        yield format_line(labels, sep, quote)
+        yield _format_csv_line(labels, sep, quote)
 
         # Include specified tag columns as extra header rows
         tag_rows = self.get_header_rows_for_tag_cols(section)
         for tag_row in tag_rows:
-            yield format_line(tag_row, sep, quote)
+            yield _format_csv_line(tag_row, sep, quote)
 
-        for chunk in self.parse_submissions(submissions):
+        for chunk in self.parse_submissions(submissions, processes, batch_size):
             for section_name, rows in chunk.items():
                 if section == section_name:
                     for row in rows:
-                        yield format_line(row, sep, quote)
+                        yield _format_csv_line(row, sep, quote)
+
+    def write_csv(
+        self,
+        fileobj,
+        submissions,
+        sep=';',
+        quote='"',
+        compression=None,
+        encoding='utf-8',
+        line_terminator='\r\n',
+        buffer_size=DEFAULT_BUFFER_SIZE,
+        processes=None,
+        batch_size=1000,
+    ):
+        """
+        Write the lines of `to_csv()` to the binary file object `fileobj`.
+
+        Lines are encoded and written in blocks of about `buffer_size`
+        characters, and compressed on the fly if `compression` is one of
+        'gzip', 'bz2' or 'zstd' (which requires the `zstandard` package).
+        `fileobj` is left open.
+
+        :param fileobj: binary file object, e.g. `open(path, 'wb')`
+        :param compression: str or None
+        :return: int, the number of bytes of CSV, before compression
+        """
+        with self._progress_run(), compressed_stream(
+            fileobj, compression
+        ) as stream:
+            writer = self._get_block_writer(stream, encoding, buffer_size)
+            for line in self.to_csv(
+                submissions, sep, quote, processes, batch_size
+            ):
+                writer.write(line)
+                writer.write(line_terminator)
+            writer.flush()
+        return writer.bytes_written
+
+    def write_csv_zip(
+        self,
+        fileobj,
+        submissions,
+        sep=';',
+        quote='"',
+        encoding='utf-8',
+        line_terminator='\r\n',
+        buffer_size=DEFAULT_BUFFER_SIZE,
+        processes=None,
+        batch_size=1000,
+        spool_size=DEFAULT_SPOOL_SIZE,
+    ):
+        """
+        Write a ZIP archive with one CSV file per section, repeat groups
+        included, to the binary file object `fileobj`, parsing submissions
+        only once. `fileobj` is left open and does not need to be seekable.
+
+        The CSV of the main section is streamed to `fileobj`; as ZIP members
+        cannot be interleaved, those of repeat groups are compressed and
+        held until the previous ones are complete: in memory up to
+        `spool_size` bytes each, then in temporary files. Memory use is
+        thus bounded, but disk use grows with the size of repeat groups.
+
+        See `parse_submissions()` for `processes` and `batch_size`.
+
+        :return: dict, `{section_name: filename}` of the archive members
+        """
+        filenames = get_unique_filenames(self.labels, 'csv')
+        with self._progress_run(), ZipStreamWriter(
+            fileobj, spool_size=spool_size
+        ) as archive:
+            writers = {}
+            for section_name, labels in self.labels.items():
+                writer = self._get_block_writer(
+                    archive.open(filenames[section_name]),
+                    encoding,
+                    buffer_size,
+                )
+                writers[section_name] = writer
+                # Include specified tag columns as extra header rows
+                tag_rows = self.get_header_rows_for_tag_cols(section_name)
+                for row in [labels] + tag_rows:
+                    writer.write(_format_csv_line(row, sep, quote))
+                    writer.write(line_terminator)
+
+            for chunk in self.parse_submissions(
+                submissions, processes, batch_size
+            ):
+                for section_name, rows in chunk.items():
+                    writer = writers[section_name]
+                    for row in rows:
+                        writer.write(_format_csv_line(row, sep, quote))
+                        writer.write(line_terminator)
+
+            for writer in writers.values():
+                writer.flush()
+                writer.stream.close()
+        return filenames
 
     def to_geojson(
         self,
         submissions: Iterator,
         flatten: bool = True,
         geo_question_name: Optional[str] = None,
+        bbox: Optional[Sequence[float]] = None,
+        geometry_types: Optional[Iterable[str]] = None,
     ) -> Generator:
         """
         Returns a GeoJSON `FeatureCollection` as a generator object, where each
@@ -659,6 +1196,12 @@ class Export:
         `FeatureCollection` and all geo responses within that survey will be
         `Feature`s within that.
 
+        `bbox`, a `(west, south, east, north)` bounding box, and
+        `geometry_types`, e.g. `['Point', 'Polygon']`, restrict the export
+        to features whose geometry intersects `bbox`, or is of one of
+        `geometry_types`. Submissions without any such feature are left out
+        entirely, before their responses are formatted.
+
         Example:
 
         If `flatten=True`:
@@ -688,15 +1231,7 @@ class Export:
             }
         """
 
-        # Force to text otherwise might fail JSON serializing
-        self.xls_types_as_text = True
-        # Format as summary for multiple select question types
-        self.multiple_select = 'summary'
-
-        # Consider the first section only (discard repeating groups)
-        first_section_name = get_first_occurrence(self.sections.keys())
-        labels = self.labels[first_section_name]
-        sections = self.sections[first_section_name]
+        first_section_name = self._prepare_geojson(bbox, geometry_types)
 
         # Set up some convenient properties when `yield`ing
         feature_array_preamble = '\n'.join(
@@ -708,125 +1243,276 @@ class Export:
             ]
         )
         feature_array_epilogue = '\n]\n}'
-        array_preamble = '[\n'
-        array_epilogue = '\n]'
-        comma_newline = ',\n'
-        newline = '\n'
+        features_per_submission = self._iter_geojson_features(
+            submissions,
+            first_section_name,
+            geo_question_name,
+            bbox,
+            geometry_types,
+        )
 
         if flatten:
             yield feature_array_preamble
-        else:
-            yield array_preamble
+            yield from _iter_feature_lines(
+                feature
+                for features in features_per_submission
+                for feature in features or ()
+            )
+            yield feature_array_epilogue
+            return
+
+        yield '[\n'
+        separator = ''
+        for features in features_per_submission:
+            yield separator + feature_array_preamble
+            separator = ',\n'
+            if features is None:
+                continue
+            yield from _iter_feature_lines(features)
+            yield feature_array_epilogue
+        yield '\n]'
+
+    def to_geojson_seq(
+        self,
+        submissions: Iterator,
+        geo_question_name: Optional[str] = None,
+        bbox: Optional[Sequence[float]] = None,
+        geometry_types: Optional[Iterable[str]] = None,
+    ) -> Generator:
+        """
+        Returns a GeoJSON Text Sequence (RFC 8142) as a generator object: the
+        `Feature`s of `to_geojson()`, one per line, each starting with an
+        ASCII record separator. Every line is a complete GeoJSON object, so
+        the output can be split and loaded in parallel.
+        """
+        first_section_name = self._prepare_geojson(bbox, geometry_types)
+        for features in self._iter_geojson_features(
+            submissions,
+            first_section_name,
+            geo_question_name,
+            bbox,
+            geometry_types,
+        ):
+            for feature in features or ():
+                yield '\x1e' + json.dumps(feature) + '\n'
+
+    def _prepare_geojson(self, bbox=None, geometry_types=None):
+        """
+        Check the filters of GeoJSON exports, set the options they need, and
+        return the name of the section they export
+        """
+        if bbox is not None and len(bbox) != 4:
+            raise ValueError(
+                f'`bbox` must be `(west, south, east, north)`, not `{bbox}`'
+            )
+        if geometry_types is not None:
+            unknown_types = set(geometry_types).difference(
+                GEOMETRY_TYPES.values()
+            )
+            if unknown_types:
+                raise ValueError(
+                    'Unknown geometry types: '
+                    f'{", ".join(sorted(unknown_types))}'
+                )
+
+        # Force to text otherwise might fail JSON serializing
+        self.xls_types_as_text = True
+        # Format as summary for multiple select question types
+        self.multiple_select = 'summary'
+        if self._section_plans is not None:
+            self._compile_section_plans()
+
+        # Consider the first section only (discard repeating groups)
+        return get_first_occurrence(self.sections.keys())
+
+    def _get_geo_plan(
+        self, version, section_name, geo_question_name, geometry_types=None
+    ):
+        """
+        Return `(geo_fields, property_columns)` for submissions of
+        `version`: the geo fields to build features from, and the
+        `(index, label)` of the columns to include in their properties
+        """
+        geo_fields = [
+            f
+            for f in version.sections[section_name].fields.values()
+            if f.data_type in GEO_QUESTION_TYPES
+        ]
+
+        # Skip all geo fields, as it's unnecessary to repeat them in the
+        # Feature's properties
+        geo_names_and_labels = set()
+        for field in geo_fields:
+            geo_names_and_labels.add(field.name)
+            geo_names_and_labels.update(field.get_labels(lang=self.lang))
+
+        labels = self.labels[section_name]
+        sections = self.sections[section_name]
+        property_columns = [
+            (index, label)
+            for index, (_, label) in enumerate(zip(sections, labels))
+            if label not in geo_names_and_labels
+        ]
+
+        # Handle the API query param of geo_question_name if present
+        if geo_question_name is not None:
+            geo_fields = [f for f in geo_fields if f.name == geo_question_name]
+        if geometry_types is not None:
+            geo_fields = [
+                f
+                for f in geo_fields
+                if GEOMETRY_TYPES[f.data_type] in geometry_types
+            ]
+
+        return geo_fields, property_columns
+
+    def _iter_geojson_features(
+        self,
+        submissions,
+        section_name,
+        geo_question_name,
+        bbox=None,
+        geometry_types=None,
+    ):
+        """
+        Yield the list of GeoJSON `Feature`s of each submission, or `None`
+        for submissions that are not exported at all. With `bbox` or
+        `geometry_types`, submissions without matching features are skipped.
+
+        Progress counts features as the rows of `section_name`.
+        """
+        with self._progress_run():
+            yield from self._iter_submission_features(
+                submissions,
+                section_name,
+                geo_question_name,
+                bbox,
+                geometry_types,
+            )
+
+    def _count_features(self, section_name, features):
+        if self.progress is not None:
+            self.progress.add_chunks({section_name: features})
+
+    def _iter_submission_features(
+        self,
+        submissions,
+        section_name,
+        geo_question_name,
+        bbox=None,
+        geometry_types=None,
+    ):
+        geo_plans = {}
+        filtered = bbox is not None or geometry_types is not None
+        if geometry_types is not None:
+            geometry_types = set(geometry_types)
 
         self.reset()  # since we're not using `parse_submissions()`
+        if self.where is not None:
+            submissions = self.where.filter(submissions)
 
-        first = True
         for submission in submissions:
-            if not flatten:
-                if first:
-                    yield feature_array_preamble
-                    first = False
-                else:
-                    yield comma_newline + feature_array_preamble
-
             # We need direct access to the field objects (available inside the
             # version) and the unformatted submission data
             version = self.get_version_for_submission(submission)
-            formatted_chunks = self.parse_one_submission(submission, version)
-            if not formatted_chunks:
+            if not version:
+                if self.progress is not None:
+                    self.progress.skip()
+                yield None
                 continue
 
-            all_fields = version.sections[first_section_name].fields.values()
-            all_geo_fields = [
-                f for f in all_fields if f.data_type in GEO_QUESTION_TYPES
-            ]
-            all_geo_field_names = [f.name for f in all_geo_fields]
-
-            all_geo_field_labels = []
-            for field in all_geo_fields:
-                all_geo_field_labels += field.get_labels(lang=self.lang)
-
-            # Iterate through all geo questions and format only those that have
-            # been answered
-            first_geo = True
-            for geo_field in all_geo_fields:
-                # Handle the API query param of geo_question_name if present by
-                # skipping all geo fields that don't match the specified
-                # question rather than filtering outside of the loop
-                if (
-                    geo_question_name is not None
-                    and geo_question_name != geo_field.name
-                ):
-                    continue
+            if version not in geo_plans:
+                geo_plans[version] = self._get_geo_plan(
+                    version, section_name, geo_question_name, geometry_types
+                )
+            geo_fields, property_columns = geo_plans[version]
 
-                rows = formatted_chunks[first_section_name]
-                for row in rows:
-                    try:
-                        geo_response = submission[geo_field.path]
-                    except KeyError:
-                        # Discard submissions with missing geo data
-                        continue
-                    try:
-                        feature_geometry = field_and_response_to_geometry(
-                            geo_field, geo_response
-                        )
-                    except FormPackGeoJsonError:
-                        # Discard submissions with invalid geo data
-                        continue
-                    except RuntimeError:
-                        # If we're here, the field has an non-geo type. Continue in
-                        # the hope that other submissions belong to better versions
-                        # of the form
-                        continue
-
-                    feature_properties = OrderedDict()
-                    for name, label, row_value in zip(sections, labels, row):
-                        # Skip all geo fields, including the current one, as
-                        # it's unnecessary to repeat in the Feature's
-                        # properties. Also skip over fields that are blank
-                        if (
-                            label in all_geo_field_names
-                            or label in all_geo_field_labels
-                            or not row_value
-                        ):
-                            continue
-
-                        feature_properties.update({label: row_value})
-
-                    feature = {
-                        'type': 'Feature',
-                        'geometry': feature_geometry,
-                        'properties': feature_properties,
-                    }
+            # Parse geo responses first: filters only need them, and
+            # formatting the other responses is by far the most expensive
+            geometries = self._get_geometries(submission, geo_fields, bbox)
+            if filtered and not geometries:
+                self._count_features(section_name, ())
+                continue
 
-                    if flatten:
-                        if first:
-                            separator = newline
-                            first = False
-                        else:
-                            separator = comma_newline
-                    else:
-                        if first_geo:
-                            separator = newline
-                            first_geo = False
-                        else:
-                            separator = comma_newline
-                    yield separator + json.dumps(feature)
+            formatted_chunks = self.parse_one_submission(submission, version)
+            if not formatted_chunks:
+                yield None
+                continue
 
-            if not flatten:
-                yield feature_array_epilogue
+            rows_properties = self._get_feature_properties(
+                formatted_chunks[section_name] if geometries else (),
+                property_columns,
+            )
+            features = [
+                {
+                    'type': 'Feature',
+                    'geometry': feature_geometry,
+                    'properties': feature_properties,
+                }
+                for feature_geometry in geometries
+                for feature_properties in rows_properties
+            ]
+            self._count_features(section_name, features)
+            yield features
 
-        if flatten:
-            yield feature_array_epilogue
-        else:
-            yield array_epilogue
+    @staticmethod
+    def _get_geometries(submission, geo_fields, bbox=None):
+        """
+        Return the GeoJSON geometries of the responses to `geo_fields` in
+        `submission` that intersect `bbox`, if given
+        """
+        geometries = []
+        for geo_field in geo_fields:
+            try:
+                geo_response = submission[geo_field.path]
+            except KeyError:
+                # Discard submissions with missing geo data
+                continue
+            try:
+                feature_geometry = field_and_response_to_geometry(
+                    geo_field, geo_response
+                )
+            except FormPackGeoJsonError:
+                # Discard submissions with invalid geo data
+                continue
+            except RuntimeError:
+                # If we're here, the field has an non-geo type. Continue in
+                # the hope that other submissions belong to better versions
+                # of the form
+                continue
+            if bbox is None or bounds_intersect_bbox(
+                get_geometry_bounds(feature_geometry), bbox
+            ):
+                geometries.append(feature_geometry)
+        return geometries
 
-    def to_table(self, submissions):
+    @staticmethod
+    def _get_feature_properties(rows, property_columns):
+        """
+        Return the `Feature` properties of each row. Properties are the same
+        for all the geo responses of a row. Skip over fields that are blank
+        """
+        rows_properties = []
+        for row in rows:
+            feature_properties = OrderedDict()
+            for index, label in property_columns:
+                if index >= len(row):
+                    break
+                row_value = row[index]
+                if row_value:
+                    feature_properties[label] = row_value
+            rows_properties.append(feature_properties)
+        return rows_properties
+
+    def to_table(self, submissions, processes=None, batch_size=1000):
+        """
+        See `parse_submissions()` for `processes` and `batch_size`.
+        """
 
         table = OrderedDict(((s, [list(l)]) for s, l in self.labels.items()))
 
         # build the table
-        for chunk in self.parse_submissions(submissions):
+        for chunk in self.parse_submissions(submissions, processes, batch_size):
             for section_name, rows in chunk.items():
                 section = table[section_name]
                 for row in rows:
@@ -834,7 +1520,61 @@ class Export:
 
         return table
 
-    def to_xlsx(self, filename, submissions):
+    def _iter_spooled_section_rows(self, chunks):
+        """
+        Consume all `chunks`, spooling the rows of each section to its own
+        temporary file, then yield `(section_name, rows)` one section after
+        the other, in order of first appearance.
+        """
+        spools = OrderedDict()
+        try:
+            for chunk in chunks:
+                for section_name, rows in chunk.items():
+                    try:
+                        spool = spools[section_name]
+                    except KeyError:
+                        spool = spools[section_name] = tempfile.TemporaryFile()
+                    pickle.dump(rows, spool, pickle.HIGHEST_PROTOCOL)
+
+            for section_name, spool in spools.items():
+                spool.seek(0)
+                while True:
+                    try:
+                        rows = pickle.load(spool)
+                    except EOFError:
+                        break
+                    yield section_name, rows
+                spool.close()
+        finally:
+            for spool in spools.values():
+                spool.close()
+
+    def to_xlsx(
+        self,
+        filename,
+        submissions,
+        processes=None,
+        batch_size=1000,
+        spool_sections=False,
+    ):
+        """
+        See `parse_submissions()` for `processes` and `batch_size`.
+
+        If `spool_sections` is true, rows are first spooled to one temporary
+        file per section, and the workbook is then written one sheet at a
+        time. Memory use no longer depends on the number of repeat group
+        sheets, at the cost of writing the data to disk twice.
+        """
+        chunks = self.parse_submissions(submissions, processes, batch_size)
+        if spool_sections:
+            section_rows = self._iter_spooled_section_rows(chunks)
+        else:
+            section_rows = (
+                (section_name, rows)
+                for chunk in chunks
+                for section_name, rows in chunk.items()
+            )
+
         workbook = xlsxwriter.Workbook(
             filename,
             {
@@ -859,35 +1599,59 @@ class Export:
             row_index += 1
             sheet_row_positions[sheet_] = row_index
 
-        for chunk in self.parse_submissions(submissions):
-            for section_name, rows in chunk.items():
-                try:
-                    sheet_name = sheet_name_mapping[section_name]
-                except KeyError:
-                    sheet_name = unique_name_for_xls(
-                        section_name, sheet_name_mapping.values()
-                    )
-                    sheet_name_mapping[section_name] = sheet_name
-                try:
-                    current_sheet = sheets[sheet_name]
-                except KeyError:
-                    current_sheet = workbook.add_worksheet(sheet_name)
-                    sheets[sheet_name] = current_sheet
+        for section_name, rows in section_rows:
+            try:
+                sheet_name = sheet_name_mapping[section_name]
+            except KeyError:
+                sheet_name = unique_name_for_xls(
+                    section_name, sheet_name_mapping.values()
+                )
+                sheet_name_mapping[section_name] = sheet_name
+            try:
+                current_sheet = sheets[sheet_name]
+            except KeyError:
+                current_sheet = workbook.add_worksheet(sheet_name)
+                sheets[sheet_name] = current_sheet
 
-                    _append_row_to_sheet(
-                        current_sheet, self.labels[section_name]
-                    )
+                _append_row_to_sheet(current_sheet, self.labels[section_name])
 
-                    # Include specified tag columns as extra header rows
-                    tag_rows = self.get_header_rows_for_tag_cols(section_name)
-                    for tag_row in tag_rows:
-                        _append_row_to_sheet(current_sheet, tag_row)
+                # Include specified tag columns as extra header rows
+                tag_rows = self.get_header_rows_for_tag_cols(section_name)
+                for tag_row in tag_rows:
+                    _append_row_to_sheet(current_sheet, tag_row)
 
-                for row in rows:
-                    _append_row_to_sheet(current_sheet, row)
+            for row in rows:
+                _append_row_to_sheet(current_sheet, row)
 
         workbook.close()
 
+    def to_arrow_batches(
+        self, submissions, batch_size=10000, processes=None
+    ) -> Generator:
+        """
+        Yield `(section_name, pyarrow.RecordBatch)` tuples, one section per
+        table. Columns are named after `self.labels` and typed after the
+        field classes (numbers, dates, timestamps, GPS components and 0/1
+        multiple select details); everything else is a string column.
+        Values that do not fit the type of their column raise `ValueError`.
+
+        Requires `pyarrow`.
+        """
+        return iter_record_batches(
+            self, submissions, batch_size, processes=processes
+        )
+
+    def to_parquet(self, path, submissions, batch_size=10000, processes=None):
+        """
+        Write one Parquet file per section into the directory `path`, typed
+        as in `to_arrow_batches()`, and return `{section_name: file_path}`.
+
+        Requires `pyarrow`.
+        """
+        return write_parquet(
+            self, path, submissions, batch_size, processes=processes
+        )
+
     def to_html(self, submissions):
         """
         Yield lines of and HTML table strings.
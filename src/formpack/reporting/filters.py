@@ -0,0 +1,138 @@
+# coding: utf-8
+import operator
+from datetime import date
+
+
+def _is_in(value, operand):
+    return value in operand
+
+
+def _is_not_in(value, operand):
+    return value not in operand
+
+
+def _contains(value, operand):
+    # Choice names of a multiple select are separated by spaces
+    return operand in value.split()
+
+
+def _exists(value, operand):
+    return (value is not None) is operand
+
+
+# Module-level functions only, so filters can be pickled for worker processes
+OPERATORS = {
+    'eq': operator.eq,
+    'ne': operator.ne,
+    'lt': operator.lt,
+    'lte': operator.le,
+    'gt': operator.gt,
+    'gte': operator.ge,
+    'in': _is_in,
+    'not_in': _is_not_in,
+    'contains': _contains,
+    'exists': _exists,
+}
+MEMBERSHIP_OPERATORS = ('in', 'not_in')
+
+
+def _normalize_operand(operand):
+    # `datetime` is a subclass of `date`
+    if isinstance(operand, date):
+        return operand.isoformat()
+    return operand
+
+
+class SubmissionFilter:
+    """
+    Predicate on raw submissions, compiled once from `where`, a mapping of
+    submission keys to conditions, which must all hold:
+
+        {
+            '_submission_time': {'gte': '2024-01-01', 'lt': '2024-01-08'},
+            'favorite_color': ['red', 'blue'],
+            '_validation_status': 'validation_status_approved',
+        }
+
+    A condition is either a mapping of operators (`eq`, `ne`, `lt`, `lte`,
+    `gt`, `gte`, `in`, `not_in`, `contains` for multiple selects, and
+    `exists`) to operands, a list, tuple or set of accepted values, or a
+    single accepted value.
+
+    Values are compared as found in submissions: dates and times are ISO
+    8601 strings, so `date` and `datetime` operands are converted with
+    `isoformat()`. Values that are dicts with a `uid`, such as
+    `_validation_status`, are compared by their `uid`. Missing values are
+    `None`; comparing values of different types never matches.
+
+    `where` can also be any callable taking a submission and returning
+    whether to keep it.
+    """
+
+    def __init__(self, where):
+        if callable(where):
+            self._predicate = where
+            self._key = None
+            return
+
+        self._key = {}
+        self._conditions = []
+        for submission_key, condition in where.items():
+            if isinstance(condition, (list, tuple, set, frozenset)):
+                condition = {'in': condition}
+            elif not isinstance(condition, dict):
+                condition = {'eq': condition}
+
+            normalized = self._key[submission_key] = {}
+            for name, operand in condition.items():
+                if name not in OPERATORS:
+                    raise ValueError(
+                        f'Unknown operator `{name}`; expected one of '
+                        f'{", ".join(OPERATORS)}'
+                    )
+                if name in MEMBERSHIP_OPERATORS:
+                    compiled_operand = frozenset(
+                        _normalize_operand(o) for o in operand
+                    )
+                    # Sorted, so equal conditions have equal keys
+                    operand = sorted(compiled_operand, key=repr)
+                elif name == 'exists':
+                    operand = compiled_operand = bool(operand)
+                else:
+                    operand = compiled_operand = _normalize_operand(operand)
+                normalized[name] = operand
+                self._conditions.append(
+                    (submission_key, OPERATORS[name], compiled_operand)
+                )
+        self._predicate = self._match
+
+    def __call__(self, submission):
+        return self._predicate(submission)
+
+    def _match(self, submission):
+        get = submission.get
+        for key, test, operand in self._conditions:
+            value = get(key)
+            if type(value) is dict:
+                value = value.get('uid')
+            try:
+                if not test(value, operand):
+                    return False
+            except (TypeError, AttributeError):
+                return False
+        return True
+
+    def get_key(self):
+        """
+        Return the conditions as plain data, e.g. to tell cached results
+        apart. Callables cannot be told apart, so they raise `ValueError`.
+        """
+        if self._key is None:
+            raise ValueError(
+                'Submissions filtered by a callable cannot be cached or '
+                'serialized'
+            )
+        return self._key
+
+    def filter(self, submissions):
+        return filter(self._predicate, submissions)
@@ -0,0 +1,126 @@
+# coding: utf-8
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from .profiler import ExportProfiler
+
+# Copy of the `Export` owned by the current worker process. It is set once by
+# `_init_worker()` so the export is pickled per worker, not per batch.
+_worker_export = None
+
+
+def _init_worker(export):
+    global _worker_export
+    _worker_export = export
+
+
+def _format_batch(submissions):
+    """
+    Format a batch of submissions with this worker's `Export`.
+
+    Indexes start over at 1 for every batch; the number of entries seen for
+    each section is returned along with the chunks so the parent process can
+    shift `_index` and `_parent_index` values afterwards, as well as the
+    number of skipped submissions and the timings of the batch if the
+    export is profiled.
+    """
+    export = _worker_export
+    export.reset()
+    if export.profiler is not None:
+        export.profiler = ExportProfiler()
+    batch_chunks = list(export._parse_runs(submissions))
+    counts = {name: index - 1 for name, index in export._indexes.items()}
+    skipped = len(submissions) - len(batch_chunks)
+    return batch_chunks, counts, skipped, export.profiler
+
+
+def _get_index_slots(export):
+    """
+    Return `{section_name: (index_slot, parent_table_slot, parent_index_slot)}`
+    for every section that has at least one of these columns
+    """
+    index_slots = {}
+    for section_name, row in export._row_cache.items():
+        columns = list(row)
+        slots = tuple(
+            columns.index(name) if name in row else None
+            for name in ('_index', '_parent_table_name', '_parent_index')
+        )
+        if slots != (None, None, None):
+            index_slots[section_name] = slots
+    return index_slots
+
+
+def _shift_indexes(chunks, offsets, index_slots):
+    for section_name, rows in chunks.items():
+        slots = index_slots.get(section_name)
+        if slots is None:
+            continue
+        index_slot, parent_table_slot, parent_index_slot = slots
+        offset = offsets[section_name]
+        for row in rows:
+            if index_slot is not None:
+                row[index_slot] += offset
+            if parent_table_slot is not None:
+                row[parent_index_slot] += offsets[row[parent_table_slot]]
+
+
+def _iter_batches(submissions, batch_size):
+    submissions = iter(submissions)
+    while True:
+        batch = list(islice(submissions, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def parse_submissions_in_parallel(export, submissions, processes, batch_size):
+    """
+    Return a generator yielding formatted 'chunks' for each submission, like
+    `Export.parse_submissions()`, but formatting batches of `batch_size`
+    submissions across `processes` worker processes.
+
+    Chunks are yielded in the order of `submissions`, with `_index` and
+    `_parent_index` values identical to a single-process export. At most
+    `2 * processes` batches are in flight at any time.
+    """
+    export.reset()
+    index_slots = _get_index_slots(export)
+    offsets = {name: 0 for name in export.sections}
+    max_pending = 2 * processes
+
+    with ProcessPoolExecutor(
+        max_workers=processes, initializer=_init_worker, initargs=(export,)
+    ) as executor:
+        pending = deque()
+        batches = _iter_batches(submissions, batch_size)
+        for batch in batches:
+            pending.append(executor.submit(_format_batch, batch))
+            if len(pending) < max_pending:
+                continue
+            yield from _merge_batch(
+                export, pending.popleft().result(), offsets, index_slots
+            )
+
+        while pending:
+            yield from _merge_batch(
+                export, pending.popleft().result(), offsets, index_slots
+            )
+
+    # Leave the export in the same state as a single-process run
+    for name, count in offsets.items():
+        export._indexes[name] = count + 1
+
+
+def _merge_batch(export, result, offsets, index_slots):
+    batch_chunks, counts, skipped, profiler = result
+    if profiler is not None:
+        export.profiler.merge(profiler)
+    if skipped and export.progress is not None:
+        export.progress.skip(skipped)
+    for chunks in batch_chunks:
+        _shift_indexes(chunks, offsets, index_slots)
+        yield chunks
+    for name, count in counts.items():
+        offsets[name] += count
@@ -0,0 +1,176 @@
+# coding: utf-8
+import re
+from collections import OrderedDict
+from functools import partial
+from typing import Dict, Optional
+
+from ..schema.fields import FormField, MediaField, TextField
+from ..utils.replace_aliases import EXTENDED_MEDIA_TYPES
+from ..utils.text import get_valid_filename
+
+
+def get_attachment(val, field, attachments):
+    """
+    Filter attachments for filenames that match the submission field's
+    value
+
+    :param attachments: AttachmentIndex or None
+    """
+    # Not all submissions will have attachments and we only want to
+    # consider media types
+    if (
+        field.data_type not in EXTENDED_MEDIA_TYPES
+        or not attachments
+        or val is None
+    ):
+        return []
+
+    return attachments.get(get_valid_filename(val))
+
+
+def get_value_from_supplemental_details(
+    field: FormField, supplemental_details: Dict
+) -> Optional[str]:
+    source, name = field.analysis_path
+    _sup_details = supplemental_details.get(source, {})
+
+    if not _sup_details:
+        return
+
+    # The names for translation and transcript fields are in the format
+    # of `translated_<language code>` which must be stripped to get the
+    # value from the supplemental details dict
+    if _name := re.match(r'^(translation|transcript)_', name):
+        name = _name.groups()[0]
+
+    val = _sup_details.get(name)
+    if val is None:
+        return ''
+
+    return val
+
+
+class FieldWriter:
+    """
+    Formatting instructions for one field of a section, resolved once.
+
+    `slot` is set when the field always produces exactly one cell equal to
+    its raw value (e.g. plain text). In that case the value can be written
+    straight into the row without calling `field.format()` at all.
+    """
+
+    __slots__ = (
+        'field',
+        'key',
+        'is_analysis',
+        'format',
+        'slot',
+        'maps_copy_field',
+        'slots',
+    )
+
+    def __init__(self, field, slots, format_kwargs, copy_field_names):
+        self.field = field
+        suffix = 'meta/' if field.data_type == 'audit' else ''
+        self.key = f'{suffix}{field.path}'
+        self.is_analysis = field.analysis_question
+        self.format = partial(field.format, **format_kwargs)
+        self.maps_copy_field = field.path in copy_field_names
+        self.slots = slots
+        self.slot = None
+
+        if (
+            not self.is_analysis
+            and not self.maps_copy_field
+            and self._formats_as_raw_value(field, format_kwargs)
+        ):
+            self.slot = slots.get(field.name)
+
+    def get_value(self, entry, supplemental_details=None):
+        """
+        Return the unformatted response to the field in `entry`
+        """
+        if self.is_analysis and supplemental_details:
+            return get_value_from_supplemental_details(
+                self.field, supplemental_details
+            )
+        return entry.get(self.key)
+
+    def write(self, row, entry, attachments=None, supplemental_details=None):
+        """
+        Write the cells of the field for `entry` into `row` and return them.
+        Return `None` instead when the raw value goes straight into `slot`.
+        """
+        val = self.get_value(entry, supplemental_details)
+        if self.slot is not None:
+            if val is not None:
+                row[self.slot] = val
+            return None
+
+        cells = self.format(
+            val=val, attachment=get_attachment(val, self.field, attachments)
+        )
+        self.write_cells(row, cells)
+        return cells
+
+    def write_cells(self, row, cells):
+        """
+        Write formatted `cells` into `row`, dropping those without a column
+        """
+        for name, cell in cells.items():
+            slot = self.slots.get(name)
+            if slot is not None:
+                row[slot] = cell
+
+    @staticmethod
+    def _formats_as_raw_value(field, format_kwargs):
+        format_func = type(field).format
+        if format_func in (FormField.format, TextField.format):
+            return True
+        if format_func is MediaField.format:
+            return not format_kwargs.get('include_media_url')
+        return False
+
+
+class SectionPlan:
+    """
+    Precompiled row layout and field writers for one `FormSection` of one
+    form version.
+
+    Built once per export so `Export.format_one_submission()` does not have
+    to re-insert analysis fields, re-filter fields, or rebuild keyword
+    arguments for every entry. `child_sections` are the repeat groups to
+    recurse into, all of `section.children` by default.
+    """
+
+    def __init__(
+        self,
+        section,
+        columns,
+        fields,
+        format_kwargs,
+        copy_field_names,
+        child_sections=None,
+    ):
+        self.section = section
+        if child_sections is None:
+            child_sections = section.children
+        self.child_sections = tuple(child_sections)
+        self.columns = list(OrderedDict.fromkeys(columns))
+        self.slots = {name: i for i, name in enumerate(self.columns)}
+        self.empty_row = [''] * len(self.columns)
+
+        self.index_slot = self.slots.get('_index')
+        self.parent_table_slot = self.slots.get('_parent_table_name')
+        self.parent_index_slot = self.slots.get('_parent_index')
+        self.copy_field_slots = [
+            (name, self.slots[f'_submission_{name}'])
+            for name in copy_field_names
+            if f'_submission_{name}' in self.slots
+        ]
+
+        self.writers = tuple(
+            FieldWriter(field, self.slots, format_kwargs, copy_field_names)
+            for field in fields
+            if field.can_format
+        )
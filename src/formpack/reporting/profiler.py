@@ -0,0 +1,120 @@
+# coding: utf-8
+from collections import OrderedDict
+
+# Steps of formatting one field, timed separately
+FIELD_STEPS = ('value', 'supplemental_details', 'attachment', 'format')
+
+
+def _sorted_by_time(timings):
+    return OrderedDict(
+        sorted(timings.items(), key=lambda item: item[1]['time'], reverse=True)
+    )
+
+
+class ExportProfiler:
+    """
+    Cumulative formatting time and call counts of an `Export`, per field
+    path, per field class and per section.
+
+    Field timings are split between the steps of `FIELD_STEPS`: reading the
+    value from the entry or from supplemental details, matching it with
+    attachments, and `field.format()`. Sections have their total time,
+    nested sections included, and their own time, without nested sections.
+    """
+
+    def __init__(self):
+        self.fields = {}
+        self.field_classes = {}
+        self.sections = {}
+        # Time spent in nested sections, for each section being formatted
+        self._nested_times = []
+
+    @staticmethod
+    def _get_field_timings(timings, key):
+        try:
+            return timings[key]
+        except KeyError:
+            field_timings = timings[key] = dict.fromkeys(FIELD_STEPS, 0.0)
+            field_timings['calls'] = 0
+            return field_timings
+
+    def add_field(self, field, **step_times):
+        """
+        Record one formatting of `field`, with the time of each step, in
+        seconds, as keyword arguments
+        """
+        field_class = type(field).__name__
+        path_timings = self._get_field_timings(self.fields, field.path)
+        path_timings['class'] = field_class
+        class_timings = self._get_field_timings(self.field_classes, field_class)
+        for timings in (path_timings, class_timings):
+            timings['calls'] += 1
+            for step, seconds in step_times.items():
+                timings[step] += seconds
+
+    def start_section(self):
+        self._nested_times.append(0.0)
+
+    def end_section(self, section, entries, seconds):
+        """
+        Record the formatting of `entries` entries of `section`, which took
+        `seconds`, since the matching `start_section()`
+        """
+        own_seconds = seconds - self._nested_times.pop()
+        if self._nested_times:
+            self._nested_times[-1] += seconds
+        try:
+            timings = self.sections[section.name]
+        except KeyError:
+            timings = self.sections[section.name] = {
+                'calls': 0,
+                'entries': 0,
+                'time': 0.0,
+                'own_time': 0.0,
+            }
+        timings['calls'] += 1
+        timings['entries'] += entries
+        timings['time'] += seconds
+        timings['own_time'] += own_seconds
+
+    def merge(self, other):
+        """
+        Add the timings of `other`, e.g. from a worker process, to these
+        ones and return `self`
+        """
+        for name in ('fields', 'field_classes', 'sections'):
+            timings = getattr(self, name)
+            for key, other_timings in getattr(other, name).items():
+                if key not in timings:
+                    timings[key] = dict(other_timings)
+                    continue
+                for step, value in other_timings.items():
+                    if step != 'class':
+                        timings[key][step] += value
+        return self
+
+    def report(self):
+        """
+        Return `{'fields': ..., 'field_classes': ..., 'sections': ...}`,
+        each one mapping paths, class names or section names to their
+        timings, slowest first. The `time` of fields is the sum of their
+        steps.
+        """
+        fields = {}
+        field_classes = {}
+        for timings, report in (
+            (self.fields, fields),
+            (self.field_classes, field_classes),
+        ):
+            for key, step_timings in timings.items():
+                report[key] = dict(step_timings)
+                report[key]['time'] = sum(
+                    step_timings[step] for step in FIELD_STEPS
+                )
+        return {
+            'fields': _sorted_by_time(fields),
+            'field_classes': _sorted_by_time(field_classes),
+            'sections': _sorted_by_time(
+                {name: dict(t) for name, t in self.sections.items()}
+            ),
+        }
@@ -0,0 +1,115 @@
+# coding: utf-8
+from collections import defaultdict
+from time import monotonic
+
+DEFAULT_PROGRESS_EVERY = 1000
+
+
+class ProgressTracker:
+    """
+    Count the submissions, rows and bytes of an export or report, and pass
+    a progress event to `callback` every `every` submissions and, if
+    `interval` is set, whenever `interval` seconds went by since the
+    previous event. A last event, with `done` set, is sent at the end.
+
+    Events are dicts with:
+
+        submissions: int. Submissions formatted or counted so far
+        skipped: int. Submissions skipped because their version is unknown
+        rows: dict. Number of rows of each section, for exports, or of
+            features, for GeoJSON exports
+        bytes_written: int. Bytes written so far, before any compression,
+            by the methods writing to files
+        elapsed: float. Seconds since the start
+        submissions_per_second: float
+        rows_per_second: float. For exports
+        done: bool
+
+    Runs can be nested, e.g. writing a file around the parsing of
+    submissions: counters start over when the outermost run begins, and
+    the last event is only sent once it ends.
+
+    The callback is not pickled, so copies of the tracker sent to worker
+    processes only count.
+    """
+
+    def __init__(self, callback, every=DEFAULT_PROGRESS_EVERY, interval=None):
+        self.callback = callback
+        self.every = every
+        self.interval = interval
+        self._depth = 0
+        self._reset()
+
+    def _reset(self):
+        self.submissions = 0
+        self.skipped = 0
+        self.rows = defaultdict(int)
+        self.bytes_written = 0
+        self._start = self._last_event = monotonic()
+        self._next_count = self.every
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['callback'] = None
+        return state
+
+    def begin(self):
+        if not self._depth:
+            self._reset()
+        self._depth += 1
+
+    def end(self):
+        self._depth -= 1
+        if not self._depth:
+            self._send(done=True)
+
+    def add(self, submissions=0, skipped=0):
+        self.submissions += submissions
+        self.skipped += skipped
+        self._check()
+
+    def skip(self, count=1):
+        self.add(skipped=count)
+
+    def add_chunks(self, chunks):
+        """
+        Count one formatted submission and its rows in `chunks`, as returned
+        by `Export.parse_one_submission()`
+        """
+        rows = self.rows
+        for section_name, section_rows in chunks.items():
+            rows[section_name] += len(section_rows)
+        self.add(submissions=1)
+
+    def add_bytes(self, count):
+        self.bytes_written += count
+
+    def _check(self):
+        count = self.submissions + self.skipped
+        if count >= self._next_count:
+            self._next_count = count - count % self.every + self.every
+            self._send()
+        elif self.interval and monotonic() - self._last_event >= self.interval:
+            self._send()
+
+    def get_event(self, done=False):
+        now = monotonic()
+        elapsed = now - self._start
+        total_rows = sum(self.rows.values())
+        return {
+            'submissions': self.submissions,
+            'skipped': self.skipped,
+            'rows': dict(self.rows),
+            'bytes_written': self.bytes_written,
+            'elapsed': elapsed,
+            'submissions_per_second': (
+                self.submissions / elapsed if elapsed else 0.0
+            ),
+            'rows_per_second': total_rows / elapsed if elapsed else 0.0,
+            'done': done,
+        }
+
+    def _send(self, done=False):
+        self._last_event = monotonic()
+        if self.callback is not None:
+            self.callback(self.get_event(done))
@@ -0,0 +1,76 @@
+# coding: utf-8
+
+
+class VersionRouter:
+    """
+    Resolve the `FormVersion` of submissions.
+
+    The version ID keys are compiled once: with a single key, the usual case,
+    resolving a version takes one `dict.get()` on the submission and one
+    lookup in `versions`.
+    """
+
+    def __init__(self, versions, version_id_keys, strict=False):
+        """
+        :param versions: mapping of version IDs to `FormVersion`s
+        :param version_id_keys: list. Keys of submissions that can hold their
+            version ID, by order of precedence
+        :param strict: bool. Raise `ValueError` for submissions with more
+            than one version ID key, instead of using the first one
+        """
+        self.versions = versions
+        self.version_id_keys = tuple(version_id_keys)
+        self.strict = strict
+        if len(self.version_id_keys) == 1:
+            self._version_id_key = self.version_id_keys[0]
+        else:
+            self._version_id_key = None
+
+    def get_version_id(self, submission):
+        """
+        Return the version ID of `submission`, or `None` if not found
+        """
+        if self._version_id_key is not None:
+            return submission.get(self._version_id_key)
+
+        present_keys = [
+            key for key in self.version_id_keys if key in submission
+        ]
+        if not present_keys:
+            return None
+        if self.strict and len(present_keys) > 1:
+            possible_versions_dict = {
+                key: submission[key] for key in present_keys
+            }
+            raise ValueError(
+                f'Submission version ambiguous. '
+                f'Multiple possible version ID keys: {possible_versions_dict}'
+            )
+        return submission[present_keys[0]]
+
+    def get_version(self, submission):
+        """
+        Return the `FormVersion` of `submission`, or `None` if not found
+        """
+        try:
+            return self.versions[self.get_version_id(submission)]
+        except KeyError:
+            return None
+
+    def iter_runs(self, submissions, max_size=1000):
+        """
+        Yield `(version_id, version, submissions)` for runs of at most
+        `max_size` consecutive submissions of the same version, keeping the
+        order of submissions.
+        """
+        run = []
+        run_version_id = None
+        for submission in submissions:
+            version_id = self.get_version_id(submission)
+            if run and (version_id != run_version_id or len(run) >= max_size):
+                yield run_version_id, self.versions.get(run_version_id), run
+                run = []
+            run_version_id = version_id
+            run.append(submission)
+        if run:
+            yield run_version_id, self.versions.get(run_version_id), run
@@ -0,0 +1,100 @@
+# coding: utf-8
+"""
+Buffered and optionally compressed binary output for text exports.
+
+`zstandard` is an optional dependency: it is only imported when zstd
+compression is requested.
+"""
+
+import bz2
+import gzip
+from contextlib import contextmanager
+
+COMPRESSIONS = ('gzip', 'bz2', 'zstd')
+
+# Characters of text collected before encoding and writing them at once
+DEFAULT_BUFFER_SIZE = 1 << 20
+
+
+def import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(
+            'zstandard is required for zstd compression; install it with '
+            '`pip install zstandard`'
+        )
+    return zstandard
+
+
+@contextmanager
+def compressed_stream(fileobj, compression=None):
+    """
+    Yield a binary file object writing to `fileobj`, compressed with
+    `compression` (one of `COMPRESSIONS`, or `None`). `fileobj` is left
+    open, but the compressed stream is complete once the block exits.
+    """
+    if compression is None:
+        yield fileobj
+        return
+    if compression == 'gzip':
+        stream = gzip.GzipFile(fileobj=fileobj, mode='wb')
+    elif compression == 'bz2':
+        stream = bz2.BZ2File(fileobj, mode='wb')
+    elif compression == 'zstd':
+        zstandard = import_zstandard()
+        stream = zstandard.ZstdCompressor().stream_writer(
+            fileobj, closefd=False
+        )
+    else:
+        raise ValueError(
+            f'Unknown compression `{compression}`; expected one of '
+            f'{", ".join(COMPRESSIONS)}'
+        )
+    try:
+        yield stream
+    finally:
+        stream.close()
+
+
+class BlockWriter:
+    """
+    Collect text written to it, and write it encoded to the binary `stream`
+    in blocks of about `buffer_size` characters, rather than making one
+    `write()` call per line.
+
+    `on_flush`, if set, is called with the size in bytes of each block.
+    """
+
+    def __init__(
+        self,
+        stream,
+        encoding='utf-8',
+        buffer_size=DEFAULT_BUFFER_SIZE,
+        on_flush=None,
+    ):
+        self.stream = stream
+        self.encoding = encoding
+        self.buffer_size = buffer_size
+        self.on_flush = on_flush
+        # Bytes written to `stream`, before any compression
+        self.bytes_written = 0
+        self._parts = []
+        self._size = 0
+
+    def write(self, text):
+        self._parts.append(text)
+        self._size += len(text)
+        if self._size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self._parts:
+            return
+        block = ''.join(self._parts).encode(self.encoding)
+        self._parts = []
+        self._size = 0
+        self.stream.write(block)
+        self.bytes_written += len(block)
+        if self.on_flush is not None:
+            self.on_flush(len(block))
@@ -0,0 +1,286 @@
+# coding: utf-8
+"""
+Write a ZIP64 archive to a file object in a single forward pass.
+
+Unlike `zipfile.ZipFile`, several members can be open for writing at the
+same time. The ZIP format needs the data of each member to be contiguous,
+so only one member at a time, the oldest still open, is written straight to
+the output; others spool their compressed data until it is their turn, in
+memory up to `spool_size` bytes per member and in a temporary file beyond.
+The output does not need to be seekable.
+"""
+
+import struct
+import time
+import zlib
+from collections import deque
+from tempfile import SpooledTemporaryFile
+
+ZIP64_VERSION = 45
+# Sizes and CRC-32 follow the data; names are UTF-8
+FLAGS = 0x08 | 0x800
+DEFLATED = 8
+ZIP64_LIMIT = 0xFFFFFFFF
+EXTERNAL_ATTRIBUTES = 0o100644 << 16
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+LOCAL_HEADER_SIGNATURE = 0x04034B50
+DATA_DESCRIPTOR = struct.Struct('<IIQQ')
+DATA_DESCRIPTOR_SIGNATURE = 0x08074B50
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+CENTRAL_HEADER_SIGNATURE = 0x02014B50
+ZIP64_EXTRA = struct.Struct('<HHQQQ')
+# Sizes are not known yet when local headers are written
+ZIP64_LOCAL_EXTRA = struct.Struct('<HHQQ')
+ZIP64_EXTRA_ID = 0x0001
+ZIP64_END = struct.Struct('<IQHHIIQQQQ')
+ZIP64_END_SIGNATURE = 0x06064B50
+ZIP64_LOCATOR = struct.Struct('<IIQI')
+ZIP64_LOCATOR_SIGNATURE = 0x07064B50
+END = struct.Struct('<IHHHHIIH')
+END_SIGNATURE = 0x06054B50
+
+# Compressed bytes a waiting member keeps in memory before spooling to disk
+DEFAULT_SPOOL_SIZE = 8 << 20
+# Bytes copied at once from spooled members to the output
+COPY_SIZE = 1 << 20
+
+
+def _dos_date_time(date_time):
+    year, month, day, hour, minute, second = date_time[:6]
+    date = (max(year, 1980) - 1980) << 9 | month << 5 | day
+    time_ = hour << 11 | minute << 5 | second // 2
+    return date, time_
+
+
+class ZipStreamMember:
+    """
+    Binary file object for one member of a `ZipStreamWriter`, compressed
+    with deflate as it is written
+    """
+
+    def __init__(self, archive, name, compresslevel, spool_size):
+        self.archive = archive
+        self.name = name
+        self.encoded_name = name.encode('utf-8')
+        self.crc = 0
+        self.size = 0
+        self.compressed_size = 0
+        self.offset = None
+        self.closed = False
+        self._compressor = zlib.compressobj(
+            compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS
+        )
+        # Compressed data waiting for the member to reach the output
+        self._pending = SpooledTemporaryFile(max_size=spool_size)
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('I/O operation on closed ZIP member')
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self._emit(self._compressor.compress(data))
+        return len(data)
+
+    def _emit(self, data):
+        if not data:
+            return
+        self.compressed_size += len(data)
+        if self._pending is None:
+            self.archive._write(data)
+        else:
+            self._pending.write(data)
+
+    def _start(self, offset):
+        """
+        Make this member the one written straight to the output, and return
+        the file object of the data written so far, to be copied first
+        """
+        self.offset = offset
+        pending, self._pending = self._pending, None
+        pending.seek(0)
+        return pending
+
+    def close(self):
+        if self.closed:
+            return
+        self._emit(self._compressor.flush())
+        self.closed = True
+        self.archive._member_closed(self)
+
+
+class ZipStreamWriter:
+    """
+    Write a ZIP64 archive to the binary file object `fileobj`, which is
+    left open.
+
+    Use `open(name)` to add members, and write bytes to them, in any order;
+    `close()` closes the remaining members and writes the central
+    directory.
+
+    :param spool_size: int. Compressed bytes a member waiting for the
+        previous ones keeps in memory before spooling to a temporary file
+    """
+
+    def __init__(
+        self,
+        fileobj,
+        compresslevel=zlib.Z_DEFAULT_COMPRESSION,
+        date_time=None,
+        spool_size=DEFAULT_SPOOL_SIZE,
+    ):
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.spool_size = spool_size
+        self.date, self.time = _dos_date_time(date_time or time.localtime())
+        self.members = []
+        self.closed = False
+        self._position = 0
+        self._current = None
+        self._queue = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self._position += len(data)
+
+    def open(self, name):
+        if self.closed:
+            raise ValueError('Cannot add members to a closed archive')
+        member = ZipStreamMember(
+            self, name, self.compresslevel, self.spool_size
+        )
+        self.members.append(member)
+        self._queue.append(member)
+        if self._current is None:
+            self._start_next()
+        return member
+
+    def _start_next(self):
+        while self._current is None and self._queue:
+            member = self._queue.popleft()
+            pending = member._start(self._position)
+            self._write(
+                LOCAL_HEADER.pack(
+                    LOCAL_HEADER_SIGNATURE,
+                    ZIP64_VERSION,
+                    FLAGS,
+                    DEFLATED,
+                    self.time,
+                    self.date,
+                    0,
+                    ZIP64_LIMIT,
+                    ZIP64_LIMIT,
+                    len(member.encoded_name),
+                    ZIP64_LOCAL_EXTRA.size,
+                )
+            )
+            self._write(member.encoded_name)
+            self._write(
+                ZIP64_LOCAL_EXTRA.pack(
+                    ZIP64_EXTRA_ID, ZIP64_LOCAL_EXTRA.size - 4, 0, 0
+                )
+            )
+            with pending:
+                for data in iter(lambda: pending.read(COPY_SIZE), b''):
+                    self._write(data)
+            self._current = member
+            if member.closed:
+                self._finish_current()
+
+    def _finish_current(self):
+        member = self._current
+        self._write(
+            DATA_DESCRIPTOR.pack(
+                DATA_DESCRIPTOR_SIGNATURE,
+                member.crc,
+                member.compressed_size,
+                member.size,
+            )
+        )
+        self._current = None
+
+    def _member_closed(self, member):
+        if member is self._current:
+            self._finish_current()
+            self._start_next()
+
+    def _write_central_directory(self):
+        start = self._position
+        for member in self.members:
+            extra = ZIP64_EXTRA.pack(
+                ZIP64_EXTRA_ID,
+                ZIP64_EXTRA.size - 4,
+                member.size,
+                member.compressed_size,
+                member.offset,
+            )
+            self._write(
+                CENTRAL_HEADER.pack(
+                    CENTRAL_HEADER_SIGNATURE,
+                    ZIP64_VERSION,
+                    ZIP64_VERSION,
+                    FLAGS,
+                    DEFLATED,
+                    self.time,
+                    self.date,
+                    member.crc,
+                    ZIP64_LIMIT,
+                    ZIP64_LIMIT,
+                    len(member.encoded_name),
+                    len(extra),
+                    0,
+                    0,
+                    0,
+                    EXTERNAL_ATTRIBUTES,
+                    ZIP64_LIMIT,
+                )
+            )
+            self._write(member.encoded_name)
+            self._write(extra)
+        size = self._position - start
+
+        end_offset = self._position
+        count = len(self.members)
+        self._write(
+            ZIP64_END.pack(
+                ZIP64_END_SIGNATURE,
+                ZIP64_END.size - 12,
+                ZIP64_VERSION,
+                ZIP64_VERSION,
+                0,
+                0,
+                count,
+                count,
+                size,
+                start,
+            )
+        )
+        self._write(
+            ZIP64_LOCATOR.pack(ZIP64_LOCATOR_SIGNATURE, 0, end_offset, 1)
+        )
+        self._write(
+            END.pack(
+                END_SIGNATURE,
+                0,
+                0,
+                min(count, 0xFFFF),
+                min(count, 0xFFFF),
+                ZIP64_LIMIT,
+                ZIP64_LIMIT,
+                0,
+            )
+        )
+
+    def close(self):
+        if self.closed:
+            return
+        for member in self.members:
+            member.close()
+        self._write_central_directory()
+        self.closed = True
@@ -15,8 +15,14 @@ from ..constants import (
     ANALYSIS_TYPE_TRANSLATION,
     UNSPECIFIED_TRANSLATION,
 )
-from ..utils import singlemode
-from ..utils.ordered_collection import OrderedDefaultdict
+from ..utils.ordered_collection import OrderedCounter, OrderedDefaultdict
+from ..utils.sketches import FrequencySketch, NumericSketch
+from ..utils.statistics import (
+    weighted_mean,
+    weighted_median,
+    weighted_singlemode,
+    weighted_stdev,
+)
 
 
 class FormField(FormDataDef):
@@ -312,6 +318,31 @@ class FormField(FormDataDef):
             'show_graph': False,
         }
 
+    def get_sketch(self, error):
+        """
+        Return the bounded-memory replacement of the metrics counter of this
+        field in approximate reports, or `None` to keep exact counts
+        """
+        return None
+
+    def get_approximate_stats(
+        self, sketch, lang=UNSPECIFIED_TRANSLATION, limit=100
+    ):
+        """
+        Like `get_stats()`, for metrics collected by the sketch returned by
+        `get_sketch()`. The sketch is not consumed.
+        """
+        not_provided = sketch[None]
+        provided = sketch['__submissions__']
+
+        return {
+            'total_count': not_provided + provided,
+            'not_provided': not_provided,
+            'provided': provided,
+            'show_graph': False,
+            'distinct_count': sketch.distinct_count(),
+        }
+
     def get_disaggregated_stats(
         self, metrics, top_splitters, lang=UNSPECIFIED_TRANSLATION, limit=100
     ):
@@ -517,6 +548,26 @@ class TextField(ExtendedFormField):
 
         return stats
 
+    def get_sketch(self, error):
+        return FrequencySketch(error)
+
+    def get_approximate_stats(
+        self, sketch, lang=UNSPECIFIED_TRANSLATION, limit=100
+    ):
+
+        stats = super().get_approximate_stats(sketch, lang, limit)
+
+        top = sketch.most_common(limit)
+        total = stats['total_count']
+
+        percentage = []
+        for key, val in top:
+            percentage.append((key, self._get_percentage(val, total)))
+
+        stats.update({'frequency': top, 'percentage': percentage})
+
+        return stats
+
     @property
     def _is_transcript(self):
         return getattr(self, 'analysis_type', '') == ANALYSIS_TYPE_TRANSCRIPT
@@ -672,16 +723,9 @@ class DateTimeField(DateField):
 
 
 class NumField(FormField):
-    def flatten_dataset(self, dataset):
-        """
-        Generate sorted numbers as listed in the given metrics counter
 
-        Cast the value to the propoer datatype in caste it's been provided
-        as text.
-        """
-        for value, freq in sorted(dataset.items()):
-            for x in range(freq):
-                yield value
+    # Reported by `get_approximate_stats()`
+    APPROXIMATE_PERCENTILES = (5, 25, 75, 95)
 
     def get_stats(self, metrics, lang=UNSPECIFIED_TRANSLATION, limit=100):
 
@@ -691,14 +735,41 @@ class NumField(FormField):
 
         try:
             # require a non empty dataset
-            stats['mean'] = statistics.mean(self.flatten_dataset(metrics))
-            stats['median'] = statistics.median(self.flatten_dataset(metrics))
+            stats['mean'] = weighted_mean(metrics)
+            stats['median'] = weighted_median(metrics)
             # requires at least 2 values in the dataset
-            stats['stdev'] = statistics.stdev(
-                self.flatten_dataset(metrics), xbar=stats['mean']
-            )
+            stats['stdev'] = weighted_stdev(metrics, xbar=stats['mean'])
+            # requires a non empty dataset and a unique mode
+            stats['mode'] = weighted_singlemode(metrics)
+        except statistics.StatisticsError:
+            pass
+
+        return stats
+
+    def get_sketch(self, error):
+        return NumericSketch(error)
+
+    def get_approximate_stats(
+        self, sketch, lang=UNSPECIFIED_TRANSLATION, limit=100
+    ):
+
+        stats = super().get_approximate_stats(sketch, lang, limit)
+
+        stats.update({'median': '*', 'mean': '*', 'mode': '*', 'stdev': '*'})
+        stats['percentiles'] = '*'
+
+        try:
+            # require a non empty dataset
+            stats['mean'] = sketch.get_mean()
+            stats['median'] = sketch.get_quantile(0.5)
+            stats['percentiles'] = [
+                (percent, sketch.get_quantile(percent / 100))
+                for percent in self.APPROXIMATE_PERCENTILES
+            ]
+            # requires at least 2 values in the dataset
+            stats['stdev'] = sketch.get_stdev()
             # requires a non empty dataset and a unique mode
-            stats['mode'] = singlemode(self.flatten_dataset(metrics))
+            stats['mode'] = sketch.get_singlemode()
         except statistics.StatisticsError:
             pass
 
@@ -716,14 +787,14 @@ class NumField(FormField):
         substats = OrderedDict()
 
         # transpose the metrics data structure to look like
-        # {splitter1: [x, y, z], splitter2...}}
-        inversed_metrics = OrderedDefaultdict(list)
+        # {splitter1: {x: count_x, y: count_y}, splitter2...}}
+        inversed_metrics = OrderedDefaultdict(OrderedCounter)
 
         for val, counter in metrics.items():
             if val is None:
                 continue
             for splitter, count in counter.items():
-                inversed_metrics[splitter].extend([val] * count)
+                inversed_metrics[splitter][val] += count
 
         for splitter, values in inversed_metrics.items():
 
@@ -736,14 +807,14 @@ class NumField(FormField):
 
             try:
                 # require a non empty dataset
-                val_stats['mean'] = statistics.mean(values)
-                val_stats['median'] = statistics.median(values)
+                val_stats['mean'] = weighted_mean(values)
+                val_stats['median'] = weighted_median(values)
                 # requires at least 2 values in the dataset
-                val_stats['stdev'] = statistics.stdev(
+                val_stats['stdev'] = weighted_stdev(
                     values, xbar=val_stats['mean']
                 )
                 # requires a non empty dataset and a unique mode
-                val_stats['mode'] = singlemode(values)
+                val_stats['mode'] = weighted_singlemode(values)
             except statistics.StatisticsError:
                 pass
 
@@ -1122,6 +1193,20 @@ class FormChoiceField(ExtendedFormField):
         combined_options.update(self.choice.options)
         self.choice.options = combined_options
 
+    def merge_choices(self, choices):
+        """
+        Same as calling `merge_choice()` with each of `choices`, from the
+        newest to the oldest, but combining all options in a single pass
+
+        :param choices: list of formpack.schema.datadef.FormChoice, from the
+            oldest to the newest
+        """
+        combined_options = OrderedDict()
+        for choice in choices:
+            combined_options.update(choice.options)
+        combined_options.update(self.choice.options)
+        self.choice.options = combined_options
+
 
 class FormChoiceFieldWithMultipleSelect(FormChoiceField):
     """
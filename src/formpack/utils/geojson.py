@@ -3,6 +3,102 @@ from geojson_rewind import rewind
 
 from .exceptions import FormPackGeoJsonError
 
+# GeoJSON geometry types of XForm geo data types
+GEOMETRY_TYPES = {
+    'geopoint': 'Point',
+    'geotrace': 'LineString',
+    'geoshape': 'Polygon',
+}
+
+
+def is_counterclockwise(ring):
+    """
+    Tell whether `ring` follows the right-hand rule, as RFC 7946 requires of
+    exterior rings. This is the test `geojson_rewind` uses, approximate
+    area and Kahan-Babuska summation included, so both always agree.
+    """
+    area = 0
+    error = 0
+    previous = ring[-1]
+    for point in ring:
+        term = (point[0] - previous[0]) * (previous[1] + point[1])
+        if abs(area) >= abs(term):
+            error += area - (area + term) + term
+        else:
+            error += term - (area + term) + area
+        area += term
+        previous = point
+    return area + error < 0
+
+
+def orient_polygon(geometry):
+    """
+    Return the `Polygon` `geometry` with its points following the right-hand
+    rule, as GeoJSON requires and XForm does not. Most shapes already do:
+    only copy and rewind the others
+    """
+    if is_counterclockwise(geometry['coordinates'][0]):
+        return geometry
+    return rewind(geometry)
+
+
+def get_geometry_bounds(geometry):
+    """
+    Return the `(west, south, east, north)` bounds of a `geometry` returned
+    by `field_and_response_to_geometry()`
+    """
+    geometry_type = geometry['type']
+    if geometry_type == 'Point':
+        points = [geometry['coordinates']]
+    elif geometry_type == 'LineString':
+        points = geometry['coordinates']
+    else:
+        points = geometry['coordinates'][0]
+    longitudes = [point[0] for point in points]
+    latitudes = [point[1] for point in points]
+    return min(longitudes), min(latitudes), max(longitudes), max(latitudes)
+
+
+def bounds_intersect_bbox(bounds, bbox):
+    """
+    Tell whether `bounds` intersect the GeoJSON bounding box `bbox`, i.e.
+    `(west, south, east, north)`. As in RFC 7946, a `bbox` whose west is
+    greater than its east crosses the antimeridian.
+    """
+    west, south, east, north = bounds
+    bbox_west, bbox_south, bbox_east, bbox_north = bbox
+    if south > bbox_north or north < bbox_south:
+        return False
+    if bbox_west <= bbox_east:
+        return west <= bbox_east and east >= bbox_west
+    return east >= bbox_west or west <= bbox_east
+
+
+def _split_geopoint_str(geopoint_str):
+    """
+    Return the GeoJSON coordinates of an XForm `geopoint` string.
+
+    From https://tools.ietf.org/html/rfc7946#section-4: "An
+    OPTIONAL third-position element SHALL be the height in meters
+    above or below the WGS 84 reference ellipsoid."
+
+    From https://tools.ietf.org/html/rfc7946#section-9: "GeoJSON
+    has no concept of uncertainty; imprecise or uncertain 'geo'
+    URIs thus cannot be mapped to GeoJSON geometries."
+    """
+
+    point_components = geopoint_str.split(' ')
+    if not 2 <= len(point_components) <= 4:
+        raise FormPackGeoJsonError('Cannot parse coordinates')
+    try:
+        coordinates = list(map(float, point_components))
+    except ValueError:
+        raise FormPackGeoJsonError('Non-numeric data for a coordinate')
+
+    # Swap the coordinates because that's what GeoJSON wants 🙄
+    latitude, longitude, altitude, accuracy = coordinates
+    return longitude, latitude, altitude
+
 
 def field_and_response_to_geometry(field, response):
     """
@@ -18,7 +114,8 @@ def field_and_response_to_geometry(field, response):
     the first position! Both agree that the third position, if included,
     specifies the altitude in meters.
 
-    The XForm types are described by  https://opendatakit.github.io/xforms-spec/:
+    The XForm types are described by
+    https://opendatakit.github.io/xforms-spec/:
 
     `geopoint` | Space-separated list of valid latitude (decimal degrees),
                  longitude (decimal degrees), altitude (decimal meters) and
@@ -30,45 +127,22 @@ def field_and_response_to_geometry(field, response):
                  last geopoint's latitude and longitude is equal to the first
     """
 
-    def split_geopoint_str(geopoint_str):
-        """
-        From https://tools.ietf.org/html/rfc7946#section-4: "An
-        OPTIONAL third-position element SHALL be the height in meters
-        above or below the WGS 84 reference ellipsoid."
-
-        From https://tools.ietf.org/html/rfc7946#section-9: "GeoJSON
-        has no concept of uncertainty; imprecise or uncertain 'geo'
-        URIs thus cannot be mapped to GeoJSON geometries."
-        """
-
-        point_components = geopoint_str.split(' ')
-        if not 2 <= len(point_components) <= 4:
-            raise FormPackGeoJsonError('Cannot parse coordinates')
-        try:
-            coordinates = list(map(float, point_components))
-        except ValueError:
-            raise FormPackGeoJsonError('Non-numeric data for a coordinate')
-
-        # Swap the coordinates because that's what GeoJSON wants 🙄
-        latitude, longitude, altitude, accuracy = coordinates
-        return longitude, latitude, altitude
-
     geometry = {}
 
     if field.data_type == 'geopoint':
         geometry['type'] = 'Point'
-        geometry['coordinates'] = split_geopoint_str(response)
+        geometry['coordinates'] = _split_geopoint_str(response)
     elif field.data_type == 'geotrace':
         geometry['type'] = 'LineString'
         geometry['coordinates'] = [
-            split_geopoint_str(point) for point in response.split(';')
+            _split_geopoint_str(point) for point in response.split(';')
         ]
         if len(geometry['coordinates']) < 2:
             raise FormPackGeoJsonError('Too few points for a line')
     elif field.data_type == 'geoshape':
         geometry['type'] = 'Polygon'
         geometry['coordinates'] = [
-            [split_geopoint_str(point) for point in response.split(';')],
+            [_split_geopoint_str(point) for point in response.split(';')],
             # We don't specify any holes in the `Polygon`, but if we did,
             # they'd go in another list here
         ]
@@ -77,9 +151,7 @@ def field_and_response_to_geometry(field, response):
         # The first point must be equal to the last
         if geometry['coordinates'][0][0] != geometry['coordinates'][0][-1]:
             raise FormPackGeoJsonError('Shape is not closed')
-        # GeoJSON requires the points to follow the right-hand rule; XForm does
-        # not
-        geometry = rewind(geometry)
+        geometry = orient_polygon(geometry)
     else:
         raise RuntimeError(
             '{field_name} is a {data_type}, which is not geographic'.format(
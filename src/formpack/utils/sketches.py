@@ -0,0 +1,451 @@
+# coding: utf-8
+"""
+Bounded-memory summaries of data streams, used by the approximate mode of
+`AutoReport.get_stats()`.
+
+All sketches are deterministic (a report computed twice gives the same
+numbers), mergeable, and serializable to JSON-compatible dicts.
+"""
+
+import heapq
+import math
+import random
+import statistics
+from hashlib import blake2b
+
+from .ordered_collection import OrderedCounter
+
+DEFAULT_ERROR = 0.01
+
+
+class HyperLogLog:
+    """
+    Estimate the number of distinct values of a stream. The relative
+    standard error of the estimate is about `error`.
+    """
+
+    HASH_BITS = 64
+
+    def __init__(self, error=DEFAULT_ERROR):
+        precision = math.ceil(2 * math.log2(1.04 / error))
+        self.precision = max(4, min(precision, 18))
+        self.registers = bytearray(1 << self.precision)
+
+    def _hash(self, value):
+        digest = blake2b(repr(value).encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'big')
+
+    def add(self, value):
+        hashed = self._hash(value)
+        bits = self.HASH_BITS - self.precision
+        index = hashed >> bits
+        rank = bits - (hashed & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError('Cannot merge sketches of different precisions')
+        self.registers = bytearray(
+            max(pair) for pair in zip(self.registers, other.registers)
+        )
+        return self
+
+    def count(self):
+        size = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = (
+            alpha * size * size / sum(2.0**-rank for rank in self.registers)
+        )
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * size and zeros:
+            # Small range correction
+            estimate = size * math.log(size / zeros)
+        return int(round(estimate))
+
+    def to_dict(self):
+        return {
+            'precision': self.precision,
+            'registers': self.registers.hex(),
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        sketch = cls.__new__(cls)
+        sketch.precision = state['precision']
+        sketch.registers = bytearray.fromhex(state['registers'])
+        return sketch
+
+
+class SpaceSaving:
+    """
+    Top-k frequent values of a stream (Metwally et al.'s Space-Saving).
+
+    At most `capacity` values are tracked. Counts are never underestimated
+    and are overestimated by at most `total / capacity`.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        # {value: [count, error]}
+        self.counters = {}
+        # Min-heap of `(count, sequence, value)`; stale entries are skipped
+        self._heap = []
+        self._sequence = 0
+
+    def _push(self, value, count):
+        if len(self._heap) > 4 * self.capacity:
+            self._rebuild_heap()
+        else:
+            self._sequence += 1
+            heapq.heappush(self._heap, (count, self._sequence, value))
+
+    def _rebuild_heap(self):
+        self._heap = []
+        for value, (count, _) in self.counters.items():
+            self._sequence += 1
+            self._heap.append((count, self._sequence, value))
+        heapq.heapify(self._heap)
+
+    def _pop_min(self):
+        while True:
+            count, _, value = heapq.heappop(self._heap)
+            counter = self.counters.get(value)
+            if counter is not None and counter[0] == count:
+                return value, count
+
+    def add(self, value, count=1):
+        counter = self.counters.get(value)
+        if counter is None:
+            if len(self.counters) < self.capacity:
+                counter = self.counters[value] = [count, 0]
+            else:
+                min_value, min_count = self._pop_min()
+                del self.counters[min_value]
+                counter = self.counters[value] = [min_count + count, min_count]
+        else:
+            counter[0] += count
+        self._push(value, counter[0])
+
+    def _min_count(self):
+        if len(self.counters) < self.capacity:
+            return 0
+        return min(count for count, _ in self.counters.values())
+
+    def merge(self, other):
+        """
+        Combine with a sketch of another stream, keeping the same error
+        guarantees for the union of both streams
+        """
+        self_min = self._min_count()
+        other_min = other._min_count()
+        counters = {}
+        for value in list(self.counters) + list(other.counters):
+            if value in counters:
+                continue
+            count, error = self.counters.get(value, (self_min, self_min))
+            other_count, other_error = other.counters.get(
+                value, (other_min, other_min)
+            )
+            counters[value] = [count + other_count, error + other_error]
+
+        kept = sorted(
+            counters.items(), key=lambda item: item[1][0], reverse=True
+        )[: self.capacity]
+        self.counters = dict(kept)
+        self._rebuild_heap()
+        return self
+
+    def most_common(self, n=None):
+        """
+        Return `[(value, estimated_count), ...]`, most frequent first
+        """
+        items = sorted(
+            self.counters.items(), key=lambda item: item[1][0], reverse=True
+        )
+        return [(value, count) for value, (count, _) in items[:n]]
+
+    def guaranteed_count(self, value):
+        count, error = self.counters.get(value, (0, 0))
+        return count - error
+
+    def to_dict(self):
+        return {
+            'capacity': self.capacity,
+            'counters': [
+                [value, count, error]
+                for value, (count, error) in self.counters.items()
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        sketch = cls(state['capacity'])
+        sketch.counters = {
+            value: [count, error] for value, count, error in state['counters']
+        }
+        sketch._rebuild_heap()
+        return sketch
+
+
+class KLLSketch:
+    """
+    Quantiles of a stream (Karnin, Lang and Liberty). With high probability,
+    the rank of returned quantiles is off by at most `error * count`.
+    """
+
+    # Capacity decay between levels
+    DECAY = 2 / 3
+
+    def __init__(self, error=DEFAULT_ERROR, seed=0):
+        # Empirical bound (99% confidence) from the Apache DataSketches
+        # implementation: error ~= 2.296 / k ** 0.9723
+        self.k = max(8, math.ceil((2.296 / error) ** (1 / 0.9723)))
+        self.count = 0
+        self.compactors = []
+        self._random = random.Random(seed)
+        self._grow()
+
+    def _grow(self):
+        self.compactors.append([])
+        self._max_size = sum(
+            self._capacity(level) for level in range(len(self.compactors))
+        )
+
+    def _capacity(self, level):
+        depth = len(self.compactors) - level - 1
+        return int(math.ceil(self.DECAY**depth * self.k)) + 1
+
+    def _size(self):
+        return sum(len(compactor) for compactor in self.compactors)
+
+    def add(self, value):
+        self.compactors[0].append(value)
+        self.count += 1
+        if len(self.compactors[0]) >= self._capacity(0):
+            self._compress()
+
+    def _compress(self):
+        for level, compactor in enumerate(self.compactors):
+            if len(compactor) < self._capacity(level):
+                continue
+            if level + 1 >= len(self.compactors):
+                self._grow()
+            compactor.sort()
+            # Keep one item of each pair, starting at a random offset, and
+            # promote it to the next level where it weighs twice as much
+            leftover = [compactor.pop()] if len(compactor) % 2 else []
+            offset = self._random.randint(0, 1)
+            self.compactors[level + 1].extend(compactor[offset::2])
+            compactor[:] = leftover
+            if self._size() < self._max_size:
+                break
+
+    def merge(self, other):
+        while len(self.compactors) < len(other.compactors):
+            self._grow()
+        for level, compactor in enumerate(other.compactors):
+            self.compactors[level].extend(compactor)
+        self.count += other.count
+        while self._size() >= self._max_size:
+            self._compress()
+        return self
+
+    def quantile(self, q):
+        """
+        Return the value whose rank is approximately `q * count`
+        """
+        if not self.count:
+            raise statistics.StatisticsError('no quantile for empty data')
+        weighted = sorted(
+            (value, 1 << level)
+            for level, compactor in enumerate(self.compactors)
+            for value in compactor
+        )
+        total = sum(weight for _, weight in weighted)
+        rank = q * total
+        seen = 0
+        for value, weight in weighted:
+            seen += weight
+            if seen > rank:
+                return value
+        return weighted[-1][0]
+
+    def to_dict(self):
+        return {
+            'k': self.k,
+            'count': self.count,
+            'compactors': self.compactors,
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        sketch = cls.__new__(cls)
+        sketch.k = state['k']
+        sketch.count = state['count']
+        sketch.compactors = []
+        sketch._random = random.Random(sketch.count)
+        for compactor in state['compactors']:
+            sketch._grow()
+            sketch.compactors[-1].extend(compactor)
+        return sketch
+
+
+class FrequencySketch:
+    """
+    Approximate replacement for the `OrderedCounter` of values kept by
+    `AutoReportMetrics` for a field.
+
+    Like a counter, it supports `update(values)`, and the bookkeeping keys
+    (`None` for blank responses and `'__submissions__'`) are counted exactly
+    with `sketch[key] += 1`. Values themselves only feed the sketches.
+    """
+
+    kind = 'frequency'
+
+    def __init__(self, error=DEFAULT_ERROR):
+        self.error = error
+        self.counts = OrderedCounter()
+        self.top = SpaceSaving(math.ceil(1 / error))
+        self.distinct = HyperLogLog(error)
+
+    def __getitem__(self, key):
+        return self.counts[key]
+
+    def __setitem__(self, key, value):
+        self.counts[key] = value
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def add(self, value):
+        self.top.add(value)
+        self.distinct.add(value)
+
+    def most_common(self, n=None):
+        return self.top.most_common(n)
+
+    def distinct_count(self):
+        return self.distinct.count()
+
+    def merge(self, other):
+        self.counts.update(other.counts)
+        self.top.merge(other.top)
+        self.distinct.merge(other.distinct)
+        return self
+
+    def to_dict(self):
+        return {
+            'kind': self.kind,
+            'error': self.error,
+            'counts': list(self.counts.items()),
+            'top': self.top.to_dict(),
+            'distinct': self.distinct.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        sketch = cls(state['error'])
+        sketch.counts.update(dict(state['counts']))
+        sketch.top = SpaceSaving.from_dict(state['top'])
+        sketch.distinct = HyperLogLog.from_dict(state['distinct'])
+        return sketch
+
+
+class NumericSketch(FrequencySketch):
+    """
+    `FrequencySketch` for numbers, also keeping quantiles and exact count,
+    mean and variance (Welford's online algorithm)
+    """
+
+    kind = 'numeric'
+
+    def __init__(self, error=DEFAULT_ERROR):
+        super().__init__(error)
+        self.quantiles = KLLSketch(error)
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        super().add(value)
+        self.quantiles.add(value)
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def get_mean(self):
+        if self.count < 1:
+            raise statistics.StatisticsError(
+                'mean requires at least one data point'
+            )
+        return self.mean
+
+    def get_stdev(self):
+        if self.count < 2:
+            raise statistics.StatisticsError(
+                'stdev requires at least two data points'
+            )
+        return math.sqrt(self.m2 / (self.count - 1))
+
+    def get_quantile(self, q):
+        return self.quantiles.quantile(q)
+
+    def get_singlemode(self):
+        """
+        Return the most frequent value, if it is certainly more frequent than
+        any other value
+        """
+        top = self.top.most_common(2)
+        if not top:
+            raise statistics.StatisticsError('no mode for empty data')
+        value, _ = top[0]
+        if len(top) > 1 and self.top.guaranteed_count(value) <= top[1][1]:
+            raise statistics.StatisticsError('no unique mode')
+        return value
+
+    def merge(self, other):
+        super().merge(other)
+        self.quantiles.merge(other.quantiles)
+        count = self.count + other.count
+        if count:
+            delta = other.mean - self.mean
+            self.m2 += (
+                other.m2 + delta * delta * self.count * other.count / count
+            )
+            self.mean += delta * other.count / count
+        self.count = count
+        return self
+
+    def to_dict(self):
+        state = super().to_dict()
+        state.update(
+            {
+                'quantiles': self.quantiles.to_dict(),
+                'count': self.count,
+                'mean': self.mean,
+                'm2': self.m2,
+            }
+        )
+        return state
+
+    @classmethod
+    def from_dict(cls, state):
+        sketch = super().from_dict(state)
+        sketch.quantiles = KLLSketch.from_dict(state['quantiles'])
+        sketch.count = state['count']
+        sketch.mean = state['mean']
+        sketch.m2 = state['m2']
+        return sketch
+
+
+SKETCH_CLASSES = {
+    sketch_class.kind: sketch_class
+    for sketch_class in (FrequencySketch, NumericSketch)
+}
+
+
+def sketch_from_dict(state):
+    return SKETCH_CLASSES[state['kind']].from_dict(state)
@@ -1,5 +1,16 @@
 # -*- coding: utf-8 -*-
+import math
 import statistics
+from fractions import Fraction
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Weighted statistics switch to NumPy, when it is installed, for frequency
+# tables with at least this many distinct values
+NUMPY_MIN_DISTINCT_VALUES = 1000
 
 
 def singlemode(data):
@@ -13,3 +24,131 @@ def singlemode(data):
             raise statistics.StatisticsError('no unique mode')
         else:
             return modes[0]
+
+
+# The `weighted_*` functions below take a mapping of `{value: frequency}`
+# (e.g. a `Counter`) and return the same result as their `statistics`
+# counterpart would on the expanded data set, without ever expanding it.
+# Time and memory depend on the number of distinct values only.
+
+
+def _use_numpy(frequencies):
+    return numpy is not None and len(frequencies) >= NUMPY_MIN_DISTINCT_VALUES
+
+
+def _count(frequencies):
+    return sum(frequencies.values())
+
+
+def _result_type(frequencies):
+    if any(isinstance(value, float) for value in frequencies):
+        return float
+    return int
+
+
+def _sorted_items(frequencies):
+    return sorted(item for item in frequencies.items() if item[1] > 0)
+
+
+def weighted_mean(frequencies):
+    n = _count(frequencies)
+    if n < 1:
+        raise statistics.StatisticsError(
+            'mean requires at least one data point'
+        )
+
+    result_type = _result_type(frequencies)
+
+    if _use_numpy(frequencies):
+        values = numpy.fromiter(frequencies.keys(), dtype=float)
+        counts = numpy.fromiter(frequencies.values(), dtype=float)
+        mean = float(numpy.dot(values, counts) / n)
+        if result_type is int and mean.is_integer():
+            return int(mean)
+        return mean
+
+    # Sum exactly, like `statistics.mean()`
+    mean = sum(Fraction(value) * freq for value, freq in frequencies.items())
+    mean /= n
+    if result_type is int and mean.denominator != 1:
+        result_type = float
+    return result_type(mean)
+
+
+def weighted_median(frequencies):
+    n = _count(frequencies)
+    if n == 0:
+        raise statistics.StatisticsError('no median for empty data')
+
+    if _use_numpy(frequencies):
+        items = _sorted_items(frequencies)
+        cumulative_counts = numpy.cumsum([freq for _, freq in items])
+
+        def value_at(position):
+            index = int(
+                numpy.searchsorted(cumulative_counts, position, side='right')
+            )
+            return items[index][0]
+
+    else:
+
+        def value_at(position):
+            seen = 0
+            for value, freq in _sorted_items(frequencies):
+                seen += freq
+                if position < seen:
+                    return value
+
+    middle = n // 2
+    if n % 2 == 1:
+        return value_at(middle)
+    return (value_at(middle - 1) + value_at(middle)) / 2
+
+
+def weighted_stdev(frequencies, xbar=None):
+    """
+    Sample standard deviation. As with `statistics.stdev()`, the sum of
+    squares is exact, but the final square root is not necessarily
+    correctly rounded, so the last digit may differ. With numpy, the sum
+    of squares is only accurate to float precision.
+    """
+    n = _count(frequencies)
+    if n < 2:
+        raise statistics.StatisticsError(
+            'stdev requires at least two data points'
+        )
+    if xbar is None:
+        xbar = weighted_mean(frequencies)
+
+    if _use_numpy(frequencies):
+        values = numpy.fromiter(frequencies.keys(), dtype=float)
+        counts = numpy.fromiter(frequencies.values(), dtype=float)
+        squares = numpy.dot(counts, (values - xbar) ** 2)
+        return math.sqrt(float(squares) / (n - 1))
+
+    xbar = Fraction(xbar)
+    squares = 0
+    for value, freq in frequencies.items():
+        deviation = Fraction(value) - xbar
+        squares += deviation * deviation * freq
+    return math.sqrt(squares / (n - 1))
+
+
+def weighted_singlemode(frequencies):
+    items = [item for item in frequencies.items() if item[1] > 0]
+    if not items:
+        raise statistics.StatisticsError('no mode for empty data')
+
+    if _use_numpy(frequencies):
+        counts = numpy.fromiter((freq for _, freq in items), dtype=float)
+        max_freq = counts.max()
+        modes = numpy.flatnonzero(counts == max_freq)
+        if len(modes) > 1:
+            raise statistics.StatisticsError('no unique mode')
+        return items[int(modes[0])][0]
+
+    max_freq = max(freq for _, freq in items)
+    modes = [value for value, freq in items if freq == max_freq]
+    if len(modes) > 1:
+        raise statistics.StatisticsError('no unique mode')
+    return modes[0]
@@ -0,0 +1,207 @@
+# coding: utf-8
+"""
+Generate realistic-looking submissions for a `FormVersion`, e.g. to
+benchmark exports and reports on large data sets.
+"""
+
+import random
+import uuid
+from datetime import datetime, timedelta
+
+from ..schema.fields import FormLiteracyTestField
+from .replace_aliases import EXTENDED_MEDIA_TYPES
+
+WORDS = (
+    'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod '
+    'tempor incididunt ut labore et dolore magna aliqua'
+).split()
+
+MEDIA_EXTENSIONS = {
+    'image': 'jpg',
+    'audio': 'm4a',
+    'background-audio': 'm4a',
+    'video': 'mp4',
+    'file': 'pdf',
+    'audit': 'csv',
+}
+
+START_TIME = datetime(2020, 1, 1)
+TIMEZONE = '-05:00'
+DOWNLOAD_URL = 'https://kc.kobo.org/media/original?media_file={}'
+
+
+class SubmissionGenerator:
+    """
+    Produce submissions for `version` by walking its sections and fields:
+    every repeat group gets between 0 and `max_repeats` entries, and each
+    response is left blank with a probability of `blank_rate`.
+
+    Values follow the shape of real submissions: strings for numbers,
+    space-separated choice names for multiple selects, `lat lon alt acc`
+    points joined by `;` for traces and shapes, ISO dates and times, and
+    file names for media fields, with matching `_attachments`.
+    """
+
+    def __init__(self, version, seed=0, max_repeats=3, blank_rate=0.1):
+        self.version = version
+        self.max_repeats = max_repeats
+        self.blank_rate = blank_rate
+        self.random = random.Random(seed)
+        self.root_section = next(iter(version.sections.values()))
+        self._count = 0
+
+    def __iter__(self):
+        while True:
+            yield self.generate()
+
+    def generate(self):
+        """
+        Return one new submission
+        """
+        self._count += 1
+        rng = self.random
+        submission_uuid = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+        submission = {
+            self.version.version_id_key: self.version.id,
+            '_id': self._count,
+            '_uuid': submission_uuid,
+            '_submission_time': self._get_time().isoformat(),
+            'meta/instanceID': f'uuid:{submission_uuid}',
+        }
+        attachments = []
+        self._fill_entry(submission, self.root_section, attachments)
+        if attachments:
+            submission['_attachments'] = attachments
+        return submission
+
+    def _fill_entry(self, entry, section, attachments):
+        rng = self.random
+        for field in section.fields.values():
+            if field.analysis_question or rng.random() < self.blank_rate:
+                continue
+            value = self._get_value(field, attachments)
+            if value is not None:
+                key = field.path
+                if field.data_type == 'audit':
+                    key = f'meta/{key}'
+                entry[key] = value
+
+        for child_section in section.children:
+            count = rng.randint(0, self.max_repeats)
+            if not count:
+                continue
+            children = entry[child_section.path] = []
+            for _ in range(count):
+                child_entry = {}
+                self._fill_entry(child_entry, child_section, attachments)
+                children.append(child_entry)
+
+    def _get_value(self, field, attachments):
+        get_value = self.VALUE_GETTERS.get(field.data_type, '_get_text')
+        return getattr(self, get_value)(field, attachments)
+
+    def _get_choices(self, field, attachments):
+        rng = self.random
+        names = list(field.choice.options)
+        if not names:
+            return None
+        if field.data_type == 'select_one':
+            return rng.choice(names)
+        words = ' '.join(rng.sample(names, rng.randint(1, len(names))))
+        if isinstance(field, FormLiteracyTestField):
+            attempted = rng.randint(1, 60)
+            parameters = [
+                str(rng.randint(1, attempted)),
+                str(rng.randint(10, 60)),
+                str(attempted),
+            ]
+            parameters += ['null'] * (
+                len(field.PREPENDED_PARAMETERS) - len(parameters)
+            )
+            return ' '.join(parameters + [words])
+        return words
+
+    def _get_integer(self, field, attachments):
+        return str(self.random.randint(0, 1000))
+
+    def _get_decimal(self, field, attachments):
+        return str(round(self.random.uniform(0, 1000), 2))
+
+    def _get_date(self, field, attachments):
+        return self._get_time().date().isoformat()
+
+    def _get_datetime(self, field, attachments):
+        time = self._get_time().isoformat(timespec='milliseconds')
+        return time + TIMEZONE
+
+    def _get_time_of_day(self, field, attachments):
+        time = self._get_time().time().isoformat('milliseconds')
+        return time + TIMEZONE
+
+    def _get_geopoint(self, field, attachments):
+        return self._get_point()
+
+    def _get_geotrace(self, field, attachments):
+        points = [self._get_point() for _ in range(self.random.randint(2, 6))]
+        if field.data_type == 'geoshape':
+            points.append(points[0])
+        return ';'.join(points)
+
+    def _get_media(self, field, attachments):
+        extension = MEDIA_EXTENSIONS.get(field.data_type, 'bin')
+        random_part = f'{self.random.getrandbits(32):08x}'
+        filename = f'{field.name}_{random_part}.{extension}'
+        path = f'user/attachments/{filename}'
+        attachments.append(
+            {
+                'download_url': DOWNLOAD_URL.format(path),
+                'filename': path,
+            }
+        )
+        return filename
+
+    def _get_text(self, field, attachments):
+        rng = self.random
+        return ' '.join(rng.choices(WORDS, k=rng.randint(1, 8)))
+
+    # Names of the methods generating the responses to each data type. Any
+    # other data type gets text
+    VALUE_GETTERS = {
+        **dict.fromkeys(EXTENDED_MEDIA_TYPES, '_get_media'),
+        'select_one': '_get_choices',
+        'select_multiple': '_get_choices',
+        'integer': '_get_integer',
+        'range': '_get_integer',
+        'decimal': '_get_decimal',
+        'date': '_get_date',
+        'today': '_get_date',
+        'datetime': '_get_datetime',
+        'start': '_get_datetime',
+        'end': '_get_datetime',
+        'time': '_get_time_of_day',
+        'geopoint': '_get_geopoint',
+        'start-geopoint': '_get_geopoint',
+        'geotrace': '_get_geotrace',
+        'geoshape': '_get_geotrace',
+    }
+
+    def _get_time(self):
+        return START_TIME + timedelta(
+            seconds=self.random.randrange(365 * 24 * 3600)
+        )
+
+    def _get_point(self):
+        rng = self.random
+        return (
+            f'{rng.uniform(-60, 60):.6f} {rng.uniform(-180, 180):.6f} '
+            f'{rng.randint(0, 500)} {rng.randint(1, 30)}'
+        )
+
+
+def generate_submissions(version, count, **kwargs):
+    """
+    Return a list of `count` submissions for `version`; see
+    `SubmissionGenerator` for the keyword arguments
+    """
+    generator = SubmissionGenerator(version, **kwargs)
+    return [generator.generate() for _ in range(count)]
@@ -9,3 +9,22 @@ def get_valid_filename(name):
     s = str(name).strip().replace(' ', '_')
     s = re.sub(r'(?u)[^-\w.]', '', s)
     return s
+
+
+def get_unique_filenames(names, extension):
+    """
+    Return `{name: filename}` with unique, filesystem-safe file names
+    ending with `extension`
+    """
+    filenames = {}
+    used = set()
+    for name in names:
+        base = get_valid_filename(name) or 'section'
+        filename = f'{base}.{extension}'
+        counter = 1
+        while filename in used:
+            counter += 1
+            filename = f'{base}_{counter}.{extension}'
+        used.add(filename)
+        filenames[name] = filename
+    return filenames
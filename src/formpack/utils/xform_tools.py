@@ -58,7 +58,11 @@ def parse_xml_to_xmljson(node):
     return out
 
 
-def parse_xmljson_to_data(data, parent_tags=[], output=[]):
+def parse_xmljson_to_data(data, parent_tags=None, output=None):
+    if parent_tags is None:
+        parent_tags = []
+    if output is None:
+        output = []
     tag = data.get('tag')
     new_parents = parent_tags + [tag]
     if len(data.get('children', [])) > 0:
@@ -1,5 +1,6 @@
 # coding: utf-8
 from collections import OrderedDict, defaultdict
+from collections.abc import MutableMapping
 from typing import (
     Dict,
     List,
@@ -448,3 +449,56 @@ class FormVersion(BaseForm):
         )
 
         return survey._to_pretty_xml()  # .encode('utf-8')
+
+
+class LazyFormVersions(MutableMapping):
+    """
+    Ordered mapping of version ids to `FormVersion`s, like
+    `FormPack.versions`, which only keeps raw schemas until a version is
+    accessed. Versions are built by `build_version(schema)` once, on first
+    access.
+    """
+
+    def __init__(self, build_version):
+        self._build_version = build_version
+        self._schemas = OrderedDict()
+        self._versions = {}
+
+    def add_schema(self, version_id, schema):
+        self._schemas[version_id] = schema
+
+    def get_schema(self, version_id):
+        """
+        Return the schema of a version without building it. The schema has
+        not been expanded yet if the version was never accessed.
+        """
+        return self._schemas[version_id]
+
+    def is_built(self, version_id):
+        return version_id in self._versions
+
+    def __getitem__(self, version_id):
+        try:
+            return self._versions[version_id]
+        except KeyError:
+            pass
+        version = self._build_version(self._schemas[version_id])
+        self._versions[version_id] = version
+        return version
+
+    def __setitem__(self, version_id, version):
+        self._schemas[version_id] = version.schema
+        self._versions[version_id] = version
+
+    def __delitem__(self, version_id):
+        del self._schemas[version_id]
+        self._versions.pop(version_id, None)
+
+    def __contains__(self, version_id):
+        return version_id in self._schemas
+
+    def __iter__(self):
+        return iter(self._schemas)
+
+    def __len__(self):
+        return len(self._schemas)
@@ -1,8 +1,13 @@
 # coding: utf-8
 import json
+import statistics
 import unittest
 
+import pytest
+from path import TempDir
+
 from formpack import FormPack
+from formpack.reporting import ReportCache
 from .fixtures import build_fixture
 
 
@@ -647,3 +652,218 @@ class TestAutoReport(unittest.TestCase):
         ]
         for i, stat in enumerate(stats):
             assert stat == expected[i]
+
+    def test_numeric_stats_on_many_distinct_values(self):
+        schemas = [
+            {
+                'content': {
+                    'survey': [
+                        {'type': 'integer', 'name': 'the_number'},
+                        {'type': 'decimal', 'name': 'the_decimal'},
+                    ]
+                }
+            }
+        ]
+        integers = [(i * 7919) % 2003 - 1000 for i in range(5000)] + [42]
+        decimals = [i / 8 for i in integers]
+        submissions = [
+            {'the_number': integer, 'the_decimal': decimal}
+            for integer, decimal in zip(integers, decimals)
+        ]
+        fp = FormPack(schemas, 'Many numbers')
+        stats = {
+            field.name: data
+            for field, _, data in fp.autoreport().get_stats(submissions)
+        }
+
+        for name, values in (
+            ('the_number', integers),
+            ('the_decimal', decimals),
+        ):
+            mean = statistics.mean(values)
+            assert stats[name]['mean'] == pytest.approx(mean)
+            assert stats[name]['median'] == statistics.median(values)
+            assert stats[name]['stdev'] == pytest.approx(
+                statistics.stdev(values, xbar=mean)
+            )
+            assert stats[name]['mode'] == statistics.mode(values)
+
+    def test_approximate_stats(self):
+        schemas = [
+            {
+                'content': {
+                    'survey': [
+                        {'type': 'integer', 'name': 'the_number'},
+                        {'type': 'text', 'name': 'the_text'},
+                    ]
+                }
+            }
+        ]
+        numbers = [(i * 7919) % 20011 for i in range(20000)]
+        submissions = [
+            {
+                'the_number': number,
+                'the_text': 'common' if number % 4 == 0 else str(number),
+            }
+            for number in numbers
+        ]
+        fp = FormPack(schemas, 'Many answers')
+        report = fp.autoreport()
+        error = 0.01
+
+        def _stats(stats):
+            return {field.name: data for field, _, data in stats}
+
+        stats = _stats(
+            report.get_stats(submissions, approximate=True, error=error)
+        )
+
+        number_stats = stats['the_number']
+        assert number_stats['provided'] == len(numbers)
+        assert number_stats['mean'] == pytest.approx(statistics.mean(numbers))
+        assert number_stats['stdev'] == pytest.approx(statistics.stdev(numbers))
+        sorted_numbers = sorted(numbers)
+        median_rank = sorted_numbers.index(number_stats['median'])
+        assert abs(median_rank - len(numbers) / 2) <= 2 * error * len(numbers)
+        assert number_stats['distinct_count'] == pytest.approx(
+            len(set(numbers)), rel=4 * error
+        )
+
+        text_stats = stats['the_text']
+        common, count = text_stats['frequency'][0]
+        assert common == 'common'
+        expected_count = len([n for n in numbers if n % 4 == 0])
+        assert expected_count <= count <= expected_count + error * len(numbers)
+        assert len(text_stats['frequency']) <= 1 / error
+
+        # Approximate metrics can be sharded too
+        first = report.get_metrics(approximate=True, error=error)
+        first.update(submissions[:5000])
+        second = report.get_metrics(approximate=True, error=error)
+        second.update(submissions[5000:])
+        merged = report.load_metrics(first.to_bytes())
+        merged.merge(report.load_metrics(second.to_bytes()))
+        merged_stats = _stats(merged.get_stats())
+        assert merged_stats['the_number']['mean'] == pytest.approx(
+            number_stats['mean']
+        )
+        assert merged_stats['the_text']['frequency'][0][0] == 'common'
+
+        with self.assertRaises(ValueError):
+            report.get_stats(submissions, split_by='the_text', approximate=True)
+
+    def test_merged_metrics_match_full_report(self):
+        title, schemas, submissions = build_fixture('auto_report')
+        fp = FormPack(schemas, title)
+        report = fp.autoreport()
+
+        def _stats(stats):
+            return [(field.name, label, data) for field, label, data in stats]
+
+        for split_by in (None, 'when'):
+            expected = _stats(report.get_stats(submissions, split_by=split_by))
+
+            half = len(submissions) // 2
+            first = report.get_metrics(split_by=split_by)
+            first.update(submissions[:half])
+            second = report.get_metrics(split_by=split_by)
+            second.update(submissions[half:])
+            # Shards can be stored and combined later
+            merged = report.load_metrics(first.to_bytes())
+            merged.merge(report.load_metrics(second.to_bytes()))
+            assert _stats(merged.get_stats()) == expected
+            # Getting the stats does not consume the metrics
+            assert _stats(merged.get_stats()) == expected
+
+            incremental = report.get_metrics(split_by=split_by)
+            incremental.update(submissions[:half])
+            incremental.get_stats()
+            incremental.update(submissions[half:])
+            assert _stats(incremental.get_stats()) == expected
+            assert incremental.submissions_count == len(submissions)
+
+    def test_cached_stats(self):
+        title, schemas, submissions = build_fixture('auto_report')
+        submissions = [
+            dict(submission, _id=_id)
+            for _id, submission in enumerate(submissions, 1)
+        ]
+        fp = FormPack(schemas, title)
+        report = fp.autoreport()
+
+        def _stats(stats):
+            return [(field.name, label, data) for field, label, data in stats]
+
+        with TempDir() as d:
+            cache = ReportCache(d)
+            for split_by in (None, 'when'):
+                expected = _stats(
+                    report.get_stats(submissions, split_by=split_by)
+                )
+                report.get_stats(
+                    submissions[:3], split_by=split_by, cache=cache
+                )
+                stats = report.get_stats(
+                    submissions, split_by=split_by, cache=cache
+                )
+                assert _stats(stats) == expected
+                assert stats.submissions_count == len(submissions)
+                # Nothing new: everything comes from the cache
+                stats = report.get_stats([], split_by=split_by, cache=cache)
+                assert _stats(stats) == expected
+
+    def test_cannot_merge_metrics_for_different_fields(self):
+        title, schemas, submissions = build_fixture('auto_report')
+        fp = FormPack(schemas, title)
+        report = fp.autoreport()
+        metrics = report.get_metrics()
+        with self.assertRaises(ValueError):
+            metrics.merge(report.get_metrics(split_by='when'))
+
+    def test_on_progress(self):
+        title, schemas, submissions = build_fixture('auto_report')
+        submissions.append({'__version__': 'unknown'})
+        fp = FormPack(schemas, title)
+
+        for split_by in (None, 'when'):
+            events = []
+            report = fp.autoreport(on_progress=events.append, progress_every=2)
+            stats = report.get_stats(submissions, split_by=split_by)
+            assert stats.submissions_count == len(submissions) - 1
+            assert [e['done'] for e in events] == [False] * 3 + [True]
+            last = events[-1]
+            assert last['submissions'] == len(submissions) - 1
+            assert last['skipped'] == 1
+            assert last['submissions_per_second'] > 0
+
+    def test_where(self):
+        title, schemas, submissions = build_fixture('auto_report')
+        submissions = [
+            dict(submission, _id=_id)
+            for _id, submission in enumerate(submissions, 1)
+        ]
+        fp = FormPack(schemas, title)
+        report = fp.autoreport()
+
+        def _stats(stats):
+            return [(field.name, label, data) for field, label, data in stats]
+
+        where = {'when': {'gte': '2002-01-01'}, 'howmany': {'in': [1, 2]}}
+        matching = [s for s in submissions if s.get('when', '') >= '2002-01-01']
+        for split_by in (None, 'restaurant_name'):
+            expected = _stats(report.get_stats(matching, split_by=split_by))
+            stats = report.get_stats(
+                submissions, split_by=split_by, where=where
+            )
+            assert _stats(stats) == expected
+            assert stats.submissions_count == len(matching)
+
+            with TempDir() as d:
+                cache = ReportCache(d)
+                # Unfiltered stats are cached apart
+                report.get_stats(submissions, split_by=split_by, cache=cache)
+                for _ in range(2):
+                    stats = report.get_stats(
+                        submissions, split_by=split_by, cache=cache, where=where
+                    )
+                    assert _stats(stats) == expected
@@ -1,18 +1,23 @@
 # coding: utf-8
+import bz2
+import gzip
 import json
 import unittest
 from collections import OrderedDict
+from datetime import datetime
 from dateutil import parser
 from io import BytesIO, TextIOWrapper
 from textwrap import dedent
 from zipfile import ZipFile
 
 import openpyxl
+import pytest
 from path import TempDir
 
 from formpack import FormPack
 from formpack.constants import UNTRANSLATED
 from formpack.errors import TranslationError
+from formpack.reporting import ReportCache
 from formpack.schema.fields import (
     ValidationStatusCopyField,
     IdCopyField,
@@ -696,6 +701,57 @@ class TestFormPackExport(unittest.TestCase):
         )
         assert export == expected_dict
 
+    def test_media_types_include_media_url_in_repeat_groups(self):
+        schemas = [
+            {
+                'content': {
+                    'survey': [
+                        {'type': 'image', 'name': 'cover', 'label': 'Cover'},
+                        {'type': 'begin_repeat', 'name': 'pages'},
+                        {'type': 'image', 'name': 'page', 'label': 'Page'},
+                        {'type': 'end_repeat'},
+                    ]
+                },
+                'version': 'v1',
+            }
+        ]
+        url = 'https://kc.kobo.org/media/original?media_file=/path/to/{}'
+        submissions = [
+            {
+                '__version__': 'v1',
+                '_id': 1,
+                'cover': 'cover.jpg',
+                'pages': [
+                    {'pages/page': 'page 1.jpg'},
+                    # `.` is not a wildcard: `page2xjpg` must not match
+                    {'pages/page': 'page2.jpg'},
+                    {'pages/page': 'missing.jpg'},
+                ],
+                '_attachments': [
+                    {'filename': '/path/to/cover.jpg'},
+                    {'filename': '/path/to/page_1.jpg'},
+                    {'filename': '/path/to/page2xjpg'},
+                    # Filenames without a directory are never matched
+                    {'filename': 'missing.jpg'},
+                ],
+            }
+        ]
+        for submission in submissions:
+            for attachment in submission['_attachments']:
+                attachment['download_url'] = url.format(
+                    attachment['filename'].rpartition('/')[-1]
+                )
+        fp = FormPack(schemas, 'Book')
+        export = fp.export(include_media_url=True).to_dict(submissions)
+        assert export['Book']['data'] == [
+            ['cover.jpg', url.format('cover.jpg'), 1]
+        ]
+        assert export['pages']['data'] == [
+            ['page 1.jpg', url.format('page_1.jpg'), 'Book', 1],
+            ['page2.jpg', '', 'Book', 1],
+            ['missing.jpg', '', 'Book', 1],
+        ]
+
     def test_select_one_from_previous_answers(self):
         title, schemas, submissions = build_fixture(
             'select_one_from_previous_answers'
@@ -1675,6 +1731,231 @@ class TestFormPackExport(unittest.TestCase):
         )
         assert rows[1] == ('"#loc+name";"#indicator+diet";"";"";""')
 
+    def test_write_csv(self):
+        title, schemas, submissions = build_fixture(
+            'quotes_newlines_and_long_urls'
+        )
+        fp = FormPack(schemas, title)
+        expected = ''.join(
+            line + '\r\n' for line in fp.export().to_csv(submissions)
+        ).encode('utf-8')
+
+        # A tiny buffer makes sure blocks are split across lines
+        output = BytesIO()
+        size = fp.export().write_csv(output, submissions, buffer_size=10)
+        assert output.getvalue() == expected
+        assert size == len(expected)
+
+        for compression, decompress in (
+            ('gzip', gzip.decompress),
+            ('bz2', bz2.decompress),
+        ):
+            output = BytesIO()
+            fp.export().write_csv(output, submissions, compression=compression)
+            assert not output.closed
+            assert decompress(output.getvalue()) == expected
+
+        with pytest.raises(ValueError):
+            fp.export().write_csv(BytesIO(), submissions, compression='zip')
+
+    def test_write_csv_zstd(self):
+        zstandard = pytest.importorskip('zstandard')
+        title, schemas, submissions = build_fixture(
+            'quotes_newlines_and_long_urls'
+        )
+        fp = FormPack(schemas, title)
+        expected = ''.join(
+            line + '\r\n' for line in fp.export().to_csv(submissions)
+        ).encode('utf-8')
+
+        output = BytesIO()
+        size = fp.export().write_csv(
+            output, submissions, compression='zstd', buffer_size=10
+        )
+        assert not output.closed
+        assert size == len(expected)
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            BytesIO(output.getvalue())
+        )
+        assert reader.read() == expected
+
+    def test_write_csv_zip(self):
+        title, schemas, submissions = build_fixture('nested_grouped_repeatable')
+        fp = FormPack(schemas, title)
+        export = fp.export(versions='bird_nests_v1')
+        expected = {
+            section_name: ''.join(
+                '"' + '";"'.join(str(value) for value in row) + '"\r\n'
+                for row in [section['fields']] + section['data']
+            )
+            for section_name, section in export.to_dict(submissions).items()
+        }
+
+        output = BytesIO()
+        filenames = fp.export(versions='bird_nests_v1').write_csv_zip(
+            output, submissions, buffer_size=10
+        )
+        assert list(filenames) == list(expected)
+
+        with ZipFile(output) as archive:
+            assert archive.testzip() is None
+            assert archive.namelist() == list(filenames.values())
+            for section_name, filename in filenames.items():
+                content = archive.read(filename).decode('utf-8')
+                assert content == expected[section_name]
+
+        # Repeat groups spooled to temporary files give the same archive
+        spooled = BytesIO()
+        fp.export(versions='bird_nests_v1').write_csv_zip(
+            spooled, submissions, buffer_size=10, spool_size=1
+        )
+        with ZipFile(output) as archive, ZipFile(spooled) as spooled_archive:
+            for filename in filenames.values():
+                assert spooled_archive.read(filename) == archive.read(filename)
+
+    def test_profile(self):
+        title, schemas, submissions = build_fixture('nested_grouped_repeatable')
+        fp = FormPack(schemas, title)
+        options = {'versions': 'bird_nests_v1'}
+        expected = fp.export(**options).to_dict(submissions)
+
+        with pytest.raises(ValueError):
+            fp.export(**options).profile()
+
+        for compile_sections in (False, True):
+            export = fp.export(
+                profile=True, compile_sections=compile_sections, **options
+            )
+            assert export.to_dict(submissions) == expected
+            profile = export.profile()
+
+            egg_path = 'group_tree/group_nest/group_egg/Describe_the_egg'
+            egg_timings = profile['fields'][egg_path]
+            assert egg_timings['class'] == 'TextField'
+            assert egg_timings['calls'] == len(expected['group_egg']['data'])
+            assert egg_timings['time'] == pytest.approx(
+                egg_timings['value']
+                + egg_timings['attachment']
+                + egg_timings['format']
+            )
+            assert profile['field_classes']['NumField']['calls'] == 2 * len(
+                expected['group_nest']['data']
+            )
+
+            sections = profile['sections']
+            assert set(sections) == set(expected)
+            for section_name, section in expected.items():
+                entries = len(section['data'])
+                assert sections[section_name]['entries'] == entries
+            assert sections[title]['calls'] == len(expected[title]['data'])
+            # Nested sections are only counted in the total time of parents
+            assert sections[title]['own_time'] < sections[title]['time']
+            assert sections['group_egg']['own_time'] == pytest.approx(
+                sections['group_egg']['time']
+            )
+
+    def test_on_progress(self):
+        title, schemas, submissions = build_fixture('nested_grouped_repeatable')
+        fp = FormPack(schemas, title)
+        expected = fp.export(versions='bird_nests_v1').to_dict(submissions)
+        rows = {name: len(s['data']) for name, s in expected.items()}
+        exported = len(expected[title]['data'])
+        skipped = len(submissions) - exported
+
+        events = []
+        export = fp.export(
+            versions='bird_nests_v1',
+            on_progress=events.append,
+            progress_every=1,
+        )
+        assert export.to_dict(submissions) == expected
+        assert len(events) == len(submissions) + 1
+        assert [e['submissions'] + e['skipped'] for e in events[:-1]] == list(
+            range(1, len(submissions) + 1)
+        )
+        assert [e['done'] for e in events] == [False] * len(submissions) + [
+            True
+        ]
+        last = events[-1]
+        assert last['submissions'] == exported
+        assert last['skipped'] == skipped
+        assert last['rows'] == rows
+        assert last['rows_per_second'] > 0
+
+        # Counters start over, and bytes are counted until the file is done
+        events.clear()
+        size = export.write_csv(BytesIO(), submissions, buffer_size=10)
+        assert [e['done'] for e in events].count(True) == 1
+        assert events[-1]['done']
+        assert events[-1]['bytes_written'] == size
+        assert events[-1]['submissions'] == exported
+
+        events.clear()
+        list(export.parse_submissions(submissions, processes=2, batch_size=1))
+        assert events[-1]['submissions'] == exported
+        assert events[-1]['skipped'] == skipped
+        assert events[-1]['rows'] == rows
+
+    def test_where(self):
+        title, schemas, submissions = build_fixture('nested_grouped_repeatable')
+        fp = FormPack(schemas, title)
+        options = {'versions': 'bird_nests_v1'}
+        approved = [
+            s
+            for s in submissions
+            if s['_validation_status']['uid'] == 'validation_status_approved'
+        ]
+
+        for where in (
+            {'_validation_status': 'validation_status_approved'},
+            {'_submission_time': {'lt': datetime(2017, 12, 27, 20, 58, 30)}},
+            {'_validation_status': ['validation_status_approved', 'other']},
+            lambda submission: submission in approved,
+        ):
+            export = fp.export(where=where, **options)
+            assert export.to_dict(submissions) == fp.export(**options).to_dict(
+                approved
+            )
+
+        export = fp.export(
+            where={'_submission_time': {'gt': '2018'}}, **options
+        )
+        assert export.to_dict(submissions)[title]['data'] == []
+
+        with pytest.raises(ValueError):
+            fp.export(where={'_id': {'like': 1}})
+
+    def test_filter_fields_prunes_sections(self):
+        title, schemas, submissions = build_fixture('nested_grouped_repeatable')
+        fp = FormPack(schemas, title)
+        full = fp.export(versions='bird_nests_v1').to_dict(submissions)
+
+        # Selecting a field of a nested repeat group keeps its ancestors
+        export = fp.export(
+            versions='bird_nests_v1',
+            filter_fields=['group_tree/group_nest/group_egg/Describe_the_egg'],
+        )
+        values = export.to_dict(submissions)
+        assert list(values) == [title, 'group_tree', 'group_nest', 'group_egg']
+        assert values['group_egg'] == full['group_egg']
+        assert values['group_nest']['fields'] == [
+            '_index',
+            '_parent_table_name',
+            '_parent_index',
+        ]
+
+        # Repeat groups without selected fields are neither exported nor read
+        export = fp.export(versions='bird_nests_v1', filter_fields=['start'])
+        assert export.get_submission_keys().isdisjoint(
+            ('group_tree', 'group_tree/group_nest')
+        )
+        values = export.to_dict(submissions)
+        assert list(values) == [title]
+        assert values[title] == {
+            'fields': ['start'],
+            'data': [[row[0]] for row in full[title]['data']],
+        }
+
     # disabled for now
     # @raises(RuntimeError)
     # def test_csv_on_repeatable_groups(self):
@@ -1899,6 +2180,68 @@ class TestFormPackExport(unittest.TestCase):
             fp.export(**options).to_xlsx(xls, submissions)
             assert xls.isfile()
 
+    def test_xlsx_spool_sections(self):
+        title, schemas, submissions = build_fixture('nested_grouped_repeatable')
+        fp = FormPack(schemas, title)
+        export = fp.export(versions=fp.versions.keys())
+
+        def _read_workbook(path):
+            book = openpyxl.load_workbook(path)
+            return OrderedDict(
+                (
+                    sheet.title,
+                    [list(row) for row in sheet.iter_rows(values_only=True)],
+                )
+                for sheet in book.worksheets
+            )
+
+        with TempDir() as d:
+            export.to_xlsx(d / 'interleaved.xlsx', submissions)
+            export.to_xlsx(d / 'spooled.xlsx', submissions, spool_sections=True)
+            expected = _read_workbook(d / 'interleaved.xlsx')
+            spooled = _read_workbook(d / 'spooled.xlsx')
+
+        assert len(spooled) == 4
+        assert spooled == expected
+
+    def test_cached_export_formats_only_new_submissions(self):
+        title, schemas, submissions = build_fixture('nested_grouped_repeatable')
+        submissions = [
+            dict(submission, _id=_id)
+            for _id, submission in enumerate(submissions, 1)
+        ]
+        fp = FormPack(schemas, title)
+        versions = fp.versions.keys()
+        expected = fp.export(versions=versions).to_dict(submissions)
+
+        with TempDir() as d:
+            cache = ReportCache(d)
+            fp.export(versions=versions, cache=cache).to_dict(submissions[:2])
+            # Rows of already cached submissions are not formatted again
+            changed = [dict(s, __version__='unknown') for s in submissions[:2]]
+            export = fp.export(versions=versions, cache=cache)
+            assert export.to_dict(changed + submissions[2:]) == expected
+
+            # Other options get their own cache entry
+            export = fp.export(versions=versions, lang=UNTRANSLATED)
+            uncached = export.to_dict(submissions)
+            export = fp.export(
+                versions=versions, lang=UNTRANSLATED, cache=cache
+            )
+            assert export.to_dict(submissions) == uncached
+            assert export.to_dict(submissions) == uncached
+            assert cache.get_export_key(export) != cache.get_export_key(
+                fp.export(
+                    versions=versions,
+                    lang=UNTRANSLATED,
+                    compile_sections=True,
+                )
+            )
+
+            with self.assertRaises(ValueError):
+                cache.clear()
+                export.to_dict([{'__version__': 'bird_nests_v1'}])
+
     def test_xlsx_long_sheet_names_and_invalid_chars(self):
         title, schemas, submissions = build_fixture('long_names')
         fp = FormPack(schemas, title)
@@ -2823,6 +3166,92 @@ class TestFormPackExport(unittest.TestCase):
             'type': 'Polygon',
         }
 
+    def test_geojson_seq(self):
+        title, schemas, submissions = build_fixture('all_geo_types')
+        fp = FormPack(schemas, title)
+        export = fp.export(versions=fp.versions.keys())
+        expected = json.loads(''.join(export.to_geojson(submissions)))
+
+        records = list(export.to_geojson_seq(submissions))
+        assert len(records) == len(expected['features'])
+        for record, feature in zip(records, expected['features']):
+            assert record.startswith('\x1e')
+            assert record.endswith('\n')
+            assert record.count('\n') == 1
+            assert json.loads(record[1:]) == feature
+
+        records = list(
+            export.to_geojson_seq(submissions, geo_question_name='Point')
+        )
+        assert [
+            json.loads(record[1:])['geometry']['type'] for record in records
+        ] == ['Point', 'Point']
+
+        # Progress counts features as rows
+        events = []
+        export = fp.export(
+            versions=fp.versions.keys(), on_progress=events.append
+        )
+        for output in (export.to_geojson, export.to_geojson_seq):
+            events.clear()
+            list(output(submissions))
+            assert [e['done'] for e in events] == [True]
+            assert events[0]['submissions'] == len(submissions)
+            assert events[0]['rows'] == {title: len(expected['features'])}
+
+    def test_geojson_bbox_and_geometry_types(self):
+        title, schemas, submissions = build_fixture('all_geo_types')
+        fp = FormPack(schemas, title)
+        export = fp.export(versions=fp.versions.keys())
+        baltimore = (-77, 39, -76, 40)
+
+        def get_features(**kwargs):
+            geojson_obj = json.loads(''.join(export.to_geojson(**kwargs)))
+            return [
+                (
+                    feature['geometry']['type'],
+                    feature['properties']['Just_a_regular_text_question'],
+                )
+                for feature in geojson_obj['features']
+            ]
+
+        assert get_features(submissions=submissions, bbox=baltimore) == [
+            ('Point', 'Greenmount'),
+            ('LineString', 'Greenmount'),
+            ('Polygon', 'Greenmount'),
+        ]
+        assert get_features(
+            submissions=submissions, geometry_types=['Point']
+        ) == [
+            ('Point', 'Greenmount'),
+            ('Point', 'Chacabuco'),
+            ('Point', 'Chacabuco'),
+        ]
+        # A box crossing the antimeridian, stopping between Baltimore and
+        # Buenos Aires
+        assert get_features(
+            submissions=submissions,
+            bbox=(170, -40, -70, 40),
+            geometry_types=['LineString', 'Polygon'],
+        ) == [
+            ('LineString', 'Greenmount'),
+            ('Polygon', 'Greenmount'),
+        ]
+
+        # Submissions without matching features are left out entirely
+        geojson_obj = json.loads(
+            ''.join(
+                export.to_geojson(submissions, flatten=False, bbox=baltimore)
+            )
+        )
+        assert len(geojson_obj) == 1
+        assert len(geojson_obj[0]['features']) == 3
+
+        with pytest.raises(ValueError):
+            list(export.to_geojson(submissions, bbox=(0, 0, 1)))
+        with pytest.raises(ValueError):
+            list(export.to_geojson(submissions, geometry_types=['Circle']))
+
     def test_geojson_unflattened(self):
         title, schemas, submissions = build_fixture('all_geo_types')
         fp = FormPack(schemas, title)
@@ -2967,3 +3396,146 @@ class TestFormPackExport(unittest.TestCase):
                 ],
             },
         ]
+
+    def test_compiled_sections_match_default_export(self):
+        scenarios = (
+            ('grouped_repeatable', {'versions': 'rgv1'}),
+            (
+                'nested_grouped_repeatable',
+                {
+                    'versions': 'bird_nests_v1',
+                    'copy_fields': ('_id', '_uuid', ValidationStatusCopyField),
+                    'force_index': True,
+                },
+            ),
+            (
+                'media_types',
+                {'versions': 'romev1', 'include_media_url': True},
+            ),
+            (
+                'favorite_coffee',
+                {
+                    'versions': ['fcv1', 'fcv2'],
+                    'xls_types_as_text': False,
+                },
+            ),
+        )
+        for fixture_name, options in scenarios:
+            title, schemas, submissions = build_fixture(fixture_name)
+            expected = (
+                FormPack(schemas, title).export(**options).to_table(submissions)
+            )
+            title, schemas, submissions = build_fixture(fixture_name)
+            compiled = (
+                FormPack(schemas, title)
+                .export(compile_sections=True, **options)
+                .to_table(submissions)
+            )
+            self.assertEqual(compiled, expected)
+
+    def test_parallel_export_matches_single_process(self):
+        title, schemas, submissions = build_fixture('nested_grouped_repeatable')
+        # Enough submissions to spread them over several batches
+        submissions = submissions * 5
+        fp = FormPack(schemas, title)
+        export = fp.export(
+            versions=fp.versions.keys(),
+            copy_fields=('_id',),
+            force_index=True,
+        )
+        expected_table = export.to_table(submissions)
+        expected_csv = list(export.to_csv(submissions))
+
+        table = export.to_table(submissions, processes=2, batch_size=2)
+        csv = list(export.to_csv(submissions, processes=2, batch_size=3))
+
+        self.assertEqual(table, expected_table)
+        self.assertEqual(csv, expected_csv)
+
+        # Cells without a column, left over in the row cache of the legacy
+        # path, are dropped by compiled plans in every process
+        title, schemas, submissions = restaurant_profile
+        fp = FormPack(schemas, title)
+        export = fp.export(
+            versions=fp.versions.keys(),
+            multiple_select='details',
+            compile_sections=True,
+        )
+        self.assertEqual(
+            export.to_table(submissions, processes=2, batch_size=1),
+            export.to_table(submissions),
+        )
+
+    def test_parquet_export_types(self):
+        pq = pytest.importorskip('pyarrow.parquet')
+        title, schemas, submissions = restaurant_profile
+        fp = FormPack(schemas, title)
+        export = fp.export(versions=fp.versions.keys(), copy_fields=('_id',))
+
+        with TempDir() as d:
+            paths = export.to_parquet(d, submissions)
+            table = pq.read_table(paths['Restaurant profile'])
+
+        types = {field.name: str(field.type) for field in table.schema}
+        self.assertEqual(types['restaurant_name'], 'string')
+        self.assertEqual(types['_location_latitude'], 'double')
+        self.assertEqual(types['eatery_type'], 'string')
+        self.assertEqual(types['eatery_type/takeaway'], 'uint8')
+        self.assertEqual(table.num_rows, len(submissions))
+        self.assertEqual(
+            table.column('_location_latitude').to_pylist()[0], 12.34
+        )
+
+    def test_arrow_batches_conversion_errors(self):
+        pytest.importorskip('pyarrow')
+        schemas = [
+            {
+                'content': {
+                    'survey': [
+                        {'type': 'integer', 'name': 'count', 'label': 'Count'}
+                    ]
+                },
+                'version': 'v1',
+            }
+        ]
+        fp = FormPack(schemas, 'Counts')
+        export = fp.export(versions='v1')
+        submissions = [
+            {'__version__': 'v1', 'count': count}
+            for count in ('5', '5.0', '1e3', '')
+        ]
+        ((_, batch),) = export.to_arrow_batches(submissions)
+        self.assertEqual(batch.column('count').to_pylist(), [5, 5, 1000, None])
+
+        # Values that do not fit the column type are not silently dropped
+        for count in ('5.5', 'five'):
+            submissions = [{'__version__': 'v1', 'count': count}]
+            with self.assertRaisesRegex(ValueError, '`count`'):
+                list(export.to_arrow_batches(submissions))
+
+    def test_arrow_batches_one_table_per_section(self):
+        pytest.importorskip('pyarrow')
+        title, schemas, submissions = build_fixture('nested_grouped_repeatable')
+        fp = FormPack(schemas, title)
+        export = fp.export(versions=fp.versions.keys())
+        table = export.to_table(submissions)
+
+        rows_by_section = {}
+        schemas = {}
+        for section_name, batch in export.to_arrow_batches(
+            submissions, batch_size=2
+        ):
+            self.assertLessEqual(batch.num_rows, 2)
+            rows_by_section.setdefault(section_name, 0)
+            rows_by_section[section_name] += batch.num_rows
+            schemas[section_name] = batch.schema
+
+        self.assertEqual(
+            rows_by_section,
+            {name: len(rows) - 1 for name, rows in table.items()},
+        )
+        for section_name, schema in schemas.items():
+            self.assertEqual(schema.names, table[section_name][0])
+        self.assertEqual(
+            str(schemas['group_nest'].field('_parent_index').type), 'int64'
+        )
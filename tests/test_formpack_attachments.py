@@ -1,5 +1,7 @@
 # coding: utf-8
 import unittest
+
+from formpack import FormPack
 from formpack.b64_attachment import B64Attachment
 
 from .fixtures.load_fixture_json import load_fixture_json
@@ -34,3 +36,33 @@ class TestB64Attachment(unittest.TestCase):
         ) = B64Attachment.write_to_tempfile(attachment)
         self.assertTrue(len(filename) > 1)
         self.assertTrue(len(filepath) > 1)
+
+
+class TestReportsWithAttachments(unittest.TestCase):
+    def test_reports_do_not_modify_submissions(self):
+        schemas = [
+            {
+                'content': {
+                    'survey': [
+                        {'type': 'image', 'name': 'photo', 'label': 'Photo'},
+                    ]
+                },
+                'version': 'v1',
+            }
+        ]
+        title = 'Restaurant photos'
+        fp = FormPack(schemas, title)
+        photos = load_fixture_json('restaurant_photo/images')
+        submissions = [{'__version__': 'v1', 'photo': p} for p in photos]
+
+        export = fp.export(versions=fp.versions.keys()).to_dict(submissions)
+        self.assertEqual(
+            [row[0] for row in export[title]['data']],
+            photos,
+        )
+        list(fp.autoreport().get_stats(submissions))
+        list(fp.autoreport().get_stats(submissions, split_by='photo'))
+
+        self.assertEqual([s['photo'] for s in submissions], photos)
+        for submission in submissions:
+            self.assertIs(type(submission['photo']), str)
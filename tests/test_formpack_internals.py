@@ -6,7 +6,9 @@ import pytest
 import pyxform
 
 from formpack import FormPack, constants
+from formpack.reporting import VersionRouter
 from formpack.utils.iterator import get_first_occurrence
+from formpack.utils.synthetic import generate_submissions
 from .fixtures import build_fixture
 
 
@@ -484,6 +486,56 @@ def test_get_fields_for_versions_returns_all_choices():
     assert 'second_version_choice_name' in choice_names
 
 
+def test_get_fields_for_versions_merges_choices_of_all_versions_in_order():
+    schemas = [
+        {
+            'version': f'v{version}',
+            'content': {
+                'survey': [{'name': 'q', 'type': 'select_one choice'}],
+                'choices': [
+                    {'list_name': 'choice', 'name': name, 'label': label}
+                    for name, label in choices
+                ],
+            },
+        }
+        for version, choices in enumerate(
+            [
+                [('a', 'A1'), ('b', 'B1')],
+                [('c', 'C2'), ('b', 'B2')],
+                [('d', 'D3'), ('a', 'A3')],
+            ],
+            1,
+        )
+    ]
+    fp = FormPack(schemas)
+    fields = fp.get_fields_for_versions(fp.versions)
+    options = fields[0].choice.options
+    assert list(options) == ['a', 'b', 'c', 'd']
+    # The most recent label wins
+    assert [option['labels'][None] for option in options.values()] == [
+        'A3',
+        'B2',
+        'C2',
+        'D3',
+    ]
+
+
+def test_get_fields_for_versions_is_memoized():
+    title, schemas, submissions = build_fixture('favorite_coffee')
+    fp = FormPack(schemas, title)
+    fields = fp.get_fields_for_versions(fp.versions)
+    again = fp.get_fields_for_versions(list(fp.versions))
+    assert again == fields
+    assert all(a is b for a, b in zip(fields, again))
+    integer_fields = fp.get_fields_for_versions(fp.versions, 'integer')
+    assert len(integer_fields) < len(fields)
+
+    # Adding copy fields to the versions invalidates previous results
+    fp.export(versions=fp.versions, copy_fields=('_id',))
+    fields = fp.get_fields_for_versions(fp.versions)
+    assert fields[-1].name == '_id'
+
+
 def test_field_position_with_multiple_versions():
     title, schemas, submissions = build_fixture(
         'field_position_with_multiple_versions'
@@ -518,3 +570,141 @@ def test_fields_for_versions_list_index_out_of_range():
     field_names = [field.name for field in all_fields]
     assert len(all_fields) == 3
     assert field_names == expected
+
+
+def test_lazy_versions_are_built_on_access():
+    title, schemas, submissions = build_fixture('favorite_coffee')
+    original_schemas = deepcopy(schemas)
+    fp = FormPack(schemas, title, lazy=True)
+    assert list(fp.versions) == ['fcv1', 'fcv2']
+    assert fp.version_id_keys() == ['__version__']
+    assert not fp.versions.is_built('fcv1')
+    assert not fp.versions.is_built('fcv2')
+
+    export = fp.export().to_dict(submissions)
+    assert not fp.versions.is_built('fcv1')
+    assert fp.versions.is_built('fcv2')
+    assert export == FormPack(original_schemas, title).export().to_dict(
+        submissions
+    )
+    assert fp[0] is fp.versions['fcv1']
+    # Schemas passed to the FormPack are left untouched
+    assert schemas == original_schemas
+
+
+def test_lazy_versions_ids_are_checked_upfront():
+    title, schemas, submissions = build_fixture('favorite_coffee')
+    with pytest.raises(ValueError):
+        FormPack([schemas[0], schemas[0]], title, lazy=True)
+
+    other_form = dict(schemas[1], id_string='other_form')
+    with pytest.raises(ValueError):
+        FormPack([dict(schemas[0], id_string='form'), other_form], lazy=True)
+
+
+def test_snapshot_roundtrip():
+    title, schemas, submissions = build_fixture('nested_grouped_repeatable')
+    fp = FormPack(schemas, title)
+    versions = list(fp.versions)
+    snapshot = fp.snapshot()
+
+    content_hash = FormPack.get_content_hash(schemas, title)
+    assert content_hash == fp.content_hash
+    # Later changes to the schemas passed in do not change the hash
+    changed_schemas = deepcopy(schemas)
+    changed_fp = FormPack(changed_schemas, title)
+    changed_schemas[0]['content']['survey'].clear()
+    assert changed_fp.content_hash == content_hash
+    assert content_hash != FormPack.get_content_hash(schemas, 'Other title')
+
+    restored = FormPack.from_snapshot(snapshot, content_hash=content_hash)
+    assert restored.title == fp.title
+    assert list(restored.versions) == versions
+    expected = fp.export(versions=versions).to_dict(submissions)
+    assert restored.export(versions=versions).to_dict(submissions) == expected
+
+    # Lazy versions are compiled into the snapshot
+    lazy_fp = FormPack(schemas, title, lazy=True)
+    assert lazy_fp._content_hash is None
+    assert lazy_fp.content_hash == content_hash
+    restored = FormPack.from_snapshot(lazy_fp.snapshot())
+    assert all(restored.versions.is_built(v) for v in versions)
+
+    with pytest.raises(ValueError):
+        FormPack.from_snapshot(snapshot, content_hash='0' * 32)
+    with pytest.raises(ValueError):
+        FormPack.from_snapshot(b'not a snapshot')
+
+
+def test_version_router():
+    title, schemas, submissions = build_fixture('favorite_coffee')
+    fp = FormPack(schemas, title)
+    router = VersionRouter(fp.versions, ['__version__', '_version_'])
+    fcv1, fcv2 = fp.versions['fcv1'], fp.versions['fcv2']
+
+    submissions = [
+        {'__version__': 'fcv1', 'n': 1},
+        {'_version_': 'fcv1', 'n': 2},
+        {'__version__': 'fcv2', 'n': 3},
+        {'n': 4},
+        {'__version__': 'fcv1', 'n': 5},
+    ]
+    assert router.get_version(submissions[1]) is fcv1
+    assert router.get_version(submissions[3]) is None
+    assert router.get_version({'__version__': 'unknown'}) is None
+
+    runs = router.iter_runs(submissions, max_size=1)
+    assert [[s['n'] for s in run] for _, _, run in runs] == [
+        [1],
+        [2],
+        [3],
+        [4],
+        [5],
+    ]
+    runs = router.iter_runs(submissions)
+    assert [(version, [s['n'] for s in run]) for _, version, run in runs] == [
+        (fcv1, [1, 2]),
+        (fcv2, [3]),
+        (None, [4]),
+        (fcv1, [5]),
+    ]
+
+    # The first key wins, unless the router is strict
+    ambiguous = {'__version__': 'fcv2', '_version_': 'fcv1'}
+    assert router.get_version(ambiguous) is fcv2
+    strict_router = VersionRouter(
+        fp.versions, ['__version__', '_version_'], strict=True
+    )
+    with pytest.raises(ValueError):
+        strict_router.get_version(ambiguous)
+
+
+def test_generate_submissions():
+    title, schemas, submissions = build_fixture('nested_grouped_repeatable')
+    fp = FormPack(schemas, title)
+    version = fp[0]
+    generated = generate_submissions(version, 50, seed=1, blank_rate=0)
+    assert generated == generate_submissions(version, 50, seed=1, blank_rate=0)
+    assert len({s['_uuid'] for s in generated}) == 50
+    assert all(s['__version__'] == version.id for s in generated)
+
+    tree_choices = set(
+        version.sections['group_tree']
+        .fields['What_kind_of_tree_is_this']
+        .choice.options
+    )
+    trees = [tree for s in generated for tree in s.get('group_tree', [])]
+    nests = [nest for t in trees for nest in t.get('group_tree/group_nest', [])]
+    assert trees and nests
+    assert all(
+        t['group_tree/What_kind_of_tree_is_this'] in tree_choices for t in trees
+    )
+    assert all(
+        n['group_tree/group_nest/How_many_eggs_are_in_the_nest'].isdigit()
+        for n in nests
+    )
+
+    export = fp.export(versions=fp.versions.keys()).to_dict(generated)
+    assert len(export[title]['data']) == 50
+    assert len(export['group_tree']['data']) == len(trees)
+    assert len(export['group_nest']['data']) == len(nests)
@@ -0,0 +1,148 @@
+# coding: utf-8
+import gzip
+import json
+from io import BytesIO
+
+import pytest
+from path import TempDir
+
+from formpack import FormPack
+from formpack.io import (
+    get_repeat_paths,
+    read_json_array,
+    read_ndjson,
+    read_submissions,
+    read_xml_submissions,
+)
+from .fixtures import build_fixture
+
+
+def _to_ndjson(submissions):
+    return ''.join(json.dumps(s) + '\n' for s in submissions).encode('utf-8')
+
+
+def test_read_submissions_formats():
+    title, schemas, submissions = build_fixture('nested_grouped_repeatable')
+    as_array = json.dumps(submissions, indent=2).encode('utf-8')
+    as_ndjson = _to_ndjson(submissions)
+
+    # Tiny blocks make sure submissions are split across blocks
+    for block_size in (1, 7, 1 << 20):
+        assert (
+            list(read_json_array(BytesIO(as_array), block_size=block_size))
+            == submissions
+        )
+        assert (
+            list(read_ndjson(BytesIO(as_ndjson), block_size=block_size))
+            == submissions
+        )
+        for data in (as_array, as_ndjson):
+            assert (
+                list(read_submissions(BytesIO(data), block_size=block_size))
+                == submissions
+            )
+
+    with TempDir() as d:
+        for filename, data in (
+            ('submissions.json', as_array),
+            ('submissions.json.gz', gzip.compress(as_array)),
+            ('submissions.ndjson.gz', gzip.compress(as_ndjson)),
+        ):
+            path = d / filename
+            path.write_bytes(data)
+            assert list(read_submissions(path)) == submissions
+            assert list(read_submissions(path, use_mmap=True)) == submissions
+
+
+def test_read_submissions_invalid_array():
+    for data in (b'[{}', b'[{} {}]', b'[{}] {}', b'{}]'):
+        with pytest.raises(ValueError):
+            list(read_json_array(BytesIO(data), block_size=1))
+
+    # A malformed submission fails without reading the rest of the file
+    data = BytesIO(b'[{"a": 1, oops}, ' + b'{"b": 2}, ' * 10000 + b'{}]')
+    with pytest.raises(ValueError):
+        list(read_json_array(data, block_size=64))
+    assert data.tell() == 64
+
+
+def test_read_submissions_for_export_and_report():
+    title, schemas, submissions = build_fixture('restaurant_profile')
+    fp = FormPack(schemas, title)
+    extra = {'_notes': ['not exported'], '_geolocation': [None, None]}
+    data = _to_ndjson([dict(s, **extra) for s in submissions])
+
+    export = fp.export(versions=fp.versions.keys())
+    keys = export.get_submission_keys()
+    assert not keys.intersection(extra)
+    projected = list(read_submissions(BytesIO(data), keys=keys))
+    assert all(set(s).issubset(keys) for s in projected)
+    assert export.to_dict(projected) == fp.export(
+        versions=fp.versions.keys()
+    ).to_dict(submissions)
+
+    report = fp.autoreport()
+    keys = report.get_submission_keys()
+    projected = read_submissions(BytesIO(data), keys=keys)
+    stats = [(f.name, s) for f, _, s in report.get_stats(projected)]
+    expected = [(f.name, s) for f, _, s in report.get_stats(submissions)]
+    assert stats == expected
+
+
+def test_read_xml_submissions():
+    title, schemas, submissions = build_fixture('nested_grouped_repeatable')
+    fp = FormPack(schemas, title)
+    repeat_paths = get_repeat_paths(fp.versions)
+    assert repeat_paths == {
+        'group_tree',
+        'group_tree/group_nest',
+        'group_tree/group_nest/group_egg',
+    }
+
+    xml = b"""<?xml version="1.0"?>
+    <instances xmlns:orx="http://openrosa.org/xforms">
+      <data id="bird_nests" version="bird_nests_v1">
+        <start>2017-12-27T15:53:26.000-05:00</start>
+        <!-- Repeat groups with a single entry are still lists -->
+        <group_tree>
+          <group_nest>
+            <How_high_above_the_ground_is_the_nest>13</How_high_above_the_ground_is_the_nest>
+            <group_egg><Describe_the_egg>brown</Describe_the_egg></group_egg>
+            <group_egg><Describe_the_egg>white</Describe_the_egg></group_egg>
+          </group_nest>
+        </group_tree>
+        <unanswered/>
+        <orx:meta><orx:instanceID>uuid:1</orx:instanceID></orx:meta>
+      </data>
+      <data id="bird_nests" version="bird_nests_v1">
+        <start>2017-12-28T10:00:00.000-05:00</start>
+      </data>
+    </instances>
+    """
+    nest = 'group_tree/group_nest'
+    height = f'{nest}/How_high_above_the_ground_is_the_nest'
+    egg = f'{nest}/group_egg'
+    assert list(read_xml_submissions(BytesIO(xml), repeat_paths)) == [
+        {
+            '__version__': 'bird_nests_v1',
+            'start': '2017-12-27T15:53:26.000-05:00',
+            'group_tree': [
+                {
+                    nest: [
+                        {
+                            height: '13',
+                            egg: [
+                                {f'{egg}/Describe_the_egg': 'brown'},
+                                {f'{egg}/Describe_the_egg': 'white'},
+                            ],
+                        }
+                    ]
+                }
+            ],
+            'meta/instanceID': 'uuid:1',
+        },
+        {
+            '__version__': 'bird_nests_v1',
+            'start': '2017-12-28T10:00:00.000-05:00',
+        },
+    ]